@@ -0,0 +1,294 @@
+# aio_dispatch.py
+# Background delivery of side effects (MQTT, ntfy) for the FastAPI server.
+#
+# The same queues as ../flask/dispatch.py (coalesced MQTT state, ntfy digests
+# that drop the oldest batch when full, retries with exponential backoff),
+# but each Dispatcher's worker is an asyncio task and the handlers are
+# coroutines:
+#   MQTT  one aiomqtt connection per worker process; reconnects on the next
+#         publish (backing off 1s to 60s) and buffers in a bounded offline
+#         queue meanwhile, re-announcing discovery after every (re)connect
+#   ntfy  a pooled keep-alive httpx.AsyncClient
+# Topics, payloads and the alert rules are shared with the Flask modules;
+# alert state still lives in alerts.py's flock'd file, read and written in
+# the threadpool, so digests are coalesced across every worker of both servers.
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+import aiomqtt
+import httpx
+from starlette.concurrency import run_in_threadpool
+
+import alerts
+import dispatch
+import metrics
+from dispatch import QUEUE_SIZE, RETRIES, Dispatcher
+from mqtt_handler import _env_flag, discovery_messages, reading_messages
+from ntfy_handler import NTFY_TOPIC, ntfy_request
+from storage import DEFAULT_DEVICE
+
+logger = logging.getLogger("dashboard")
+mqtt_logger = logging.getLogger("mqtt")
+ntfy_logger = logging.getLogger("ntfy")
+
+MQTT_TIMEOUT = 10
+NTFY_TIMEOUT = 10
+
+
+class AsyncDispatcher(Dispatcher):
+    """A Dispatcher whose worker is a task on the running event loop and whose
+    handler is a coroutine function. `submit` must be called on that loop."""
+
+    def _ensure_worker(self):
+        if self._thread is not None and not self._thread.done():
+            return
+        self._ready = asyncio.Event()
+        self._thread = asyncio.get_running_loop().create_task(self._run(), name=f"dispatch-{self.name}")
+
+    def _wake(self):
+        self._ready.set()
+
+    async def _run(self):
+        while True:
+            while not self._items:
+                self._ready.clear()
+                await self._ready.wait()
+            _, item = self._items.popitem(last=False)
+            await self._deliver(item)
+
+    async def _deliver(self, item):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                await self.handler(item)
+                return self._delivered()
+            except Exception as e:
+                if not self._retry(attempt, e, delay):
+                    return
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+
+    async def close(self):
+        if self._thread is not None:
+            self._thread.cancel()
+            self._thread = None
+
+
+# -- MQTT -----------------------------------------------------------------------
+
+class AsyncMqttPublisher:
+    def __init__(self):
+        self.broker = os.getenv("MQTT_BROKER")
+        self.port = int(os.getenv("MQTT_PORT", 1883))
+        self.topic = os.getenv("MQTT_TOPIC", "garden/sensors").rstrip("/")
+        self.qos = int(os.getenv("MQTT_QOS", 0))
+        self.user = os.getenv("MQTT_USER")
+        self.password = os.getenv("MQTT_PASSWORD")
+
+        self.client = None
+        self._lock = asyncio.Lock()
+        self._offline = deque(maxlen=int(os.getenv("MQTT_OFFLINE_QUEUE", 500)))
+        self._discovery_enabled = _env_flag("MQTT_DISCOVERY", "true")
+        self._discovery = {}  # device_id -> discovery messages, built once per device
+        if self._discovery_enabled:
+            self._discovery[DEFAULT_DEVICE] = discovery_messages(self.topic, DEFAULT_DEVICE)
+        self._retry_at = 0.0
+        self._retry_delay = 1.0
+
+    async def _connect(self):
+        mqtt_logger.info(f"[MQTT] Connecting to {self.broker}:{self.port}, topic={self.topic}, qos={self.qos}")
+        client = aiomqtt.Client(
+            self.broker, self.port, client_id=f"garden-dashboard-{os.getpid()}", keepalive=60, timeout=MQTT_TIMEOUT,
+            username=self.user if self.user and self.password else None,
+            password=self.password if self.user and self.password else None,
+        )
+        # the context manager's enter/exit are aiomqtt's supported connect/disconnect
+        await client.__aenter__()
+        self.client = client
+        for messages in self._discovery.values():
+            for msg in messages:
+                await self._send(*msg)
+        backlog = len(self._offline)
+        while self._offline and await self._send(*self._offline[0]):
+            self._offline.popleft()
+        mqtt_logger.info(f"[MQTT] Connected; flushed {backlog - len(self._offline)} queued messages")
+
+    async def _ensure_connected(self):
+        if self.client is not None or time.monotonic() < self._retry_at:
+            return
+        try:
+            await self._connect()
+            self._retry_delay = 1.0
+        except (aiomqtt.MqttError, OSError) as e:
+            mqtt_logger.warning(f"[MQTT] Connect failed: {e}; retrying in {self._retry_delay:.0f}s")
+            self._retry_at = time.monotonic() + self._retry_delay
+            self._retry_delay = min(self._retry_delay * 2, 60.0)
+
+    async def _send(self, topic, payload, retain):
+        if self.client is None:
+            return False
+        try:
+            await self.client.publish(topic, payload=payload, qos=self.qos, retain=retain, timeout=MQTT_TIMEOUT)
+            return True
+        except aiomqtt.MqttError as e:
+            mqtt_logger.warning(f"[MQTT] Disconnected unexpectedly ({e}); will reconnect")
+            await self._drop()
+            return False
+
+    def _messages(self, reading):
+        device_id = reading.get("device_id") or DEFAULT_DEVICE
+        if self._discovery_enabled and device_id not in self._discovery:
+            # first reading from a new device: announce it once
+            self._discovery[device_id] = discovery_messages(self.topic, device_id)
+            yield from self._discovery[device_id]
+        yield from reading_messages(self.topic, reading)
+
+    async def publish(self, readings):
+        """Publish one reading or a batch; queues offline while disconnected."""
+        if isinstance(readings, dict):
+            readings = [readings]
+        async with self._lock:
+            await self._ensure_connected()
+            for reading in readings:
+                for msg in self._messages(reading):
+                    if not await self._send(*msg):
+                        if len(self._offline) == self._offline.maxlen:
+                            mqtt_logger.warning("[MQTT] Offline queue full, dropping oldest message")
+                        self._offline.append(msg)
+
+    async def _drop(self):
+        client, self.client = self.client, None
+        if client is not None:
+            try:
+                await client.__aexit__(None, None, None)
+            except Exception:
+                pass
+
+    async def stop(self):
+        await self._drop()
+
+
+_publisher = None
+
+
+def get_publisher():
+    global _publisher
+    if _publisher is None:
+        _publisher = AsyncMqttPublisher()
+    return _publisher
+
+
+async def publish_mqtt(data):
+    if _env_flag("DISABLE_MQTT"):
+        return
+    publisher = get_publisher()
+    if not publisher.broker:
+        mqtt_logger.error("[MQTT] env variable missing!")
+        return
+    with metrics.timer("garden_ingest_stage_duration_seconds", stage="mqtt"):
+        await publisher.publish(data)
+
+
+# -- ntfy -----------------------------------------------------------------------
+
+_http = None
+
+
+def _client():
+    # keep-alive connection pool reused across notifications, per worker
+    global _http
+    if _http is None:
+        _http = httpx.AsyncClient(timeout=NTFY_TIMEOUT,
+                                  limits=httpx.Limits(max_connections=4, max_keepalive_connections=4))
+    return _http
+
+
+async def send_ntfy_message(message, topic=NTFY_TOPIC, title="Garden Alert", priority="default"):
+    request = ntfy_request(topic, title, priority)
+    if request is None:
+        return
+    url, headers = request
+    try:
+        ntfy_logger.debug(f"[ntfy] Sending POST to {url}: {message}")
+        with metrics.timer("garden_ingest_stage_duration_seconds", stage="ntfy"):
+            resp = await _client().post(url, content=message.encode("utf-8"), headers=headers)
+        if resp.status_code != 200:
+            ntfy_logger.error(f"[ntfy] Failed with {resp.status_code}: {resp.text}")
+        else:
+            ntfy_logger.info(f"[ntfy] Sent '{title}' to {topic}")
+        resp.raise_for_status()
+    except Exception as e:
+        ntfy_logger.error(f"[ntfy] Error: {e}")
+        raise  # let the dispatcher retry
+
+
+# -- alert digests (see alerts.py) ----------------------------------------------
+
+_timer = None
+
+
+async def process_alerts(readings):
+    """alerts.process for the event loop: record transitions, send a digest if due."""
+    await run_in_threadpool(alerts.record, readings)
+    await flush_alerts()
+
+
+async def flush_alerts(force=False):
+    digest, wait = await run_in_threadpool(alerts.claim_digest, force)
+    if digest is None:
+        if wait is not None:
+            _schedule(wait)
+        return
+    try:
+        await send_ntfy_message(digest["message"], title=digest["title"], priority=digest["priority"])
+    except Exception:
+        # leave the digest pending for the retry
+        await run_in_threadpool(alerts.restore, digest)
+        raise
+
+
+def _schedule(delay):
+    global _timer
+    if _timer is not None and not _timer.done():
+        return
+    _timer = asyncio.get_running_loop().create_task(_flush_later(delay))
+
+
+async def _flush_later(delay):
+    global _timer
+    await asyncio.sleep(delay + 0.5)
+    _timer = None
+    try:
+        await flush_alerts()
+    except Exception as e:
+        ntfy_logger.error(f"[ntfy] digest send failed: {e}; retrying in 60s")
+        _schedule(60)
+
+
+# -- queues ---------------------------------------------------------------------
+
+mqtt_dispatcher = AsyncDispatcher("mqtt", publish_mqtt, maxsize=QUEUE_SIZE, policy="coalesce", retries=RETRIES)
+ntfy_dispatcher = AsyncDispatcher("ntfy", process_alerts, maxsize=QUEUE_SIZE, policy="drop_oldest", retries=RETRIES)
+
+
+def dispatch_readings(readings):
+    """Hand accepted readings to the async queues; never blocks."""
+    dispatch.dispatch_readings(readings, mqtt_dispatcher, ntfy_dispatcher)
+
+
+async def close():
+    """Stop the queues and close the connections (on worker shutdown)."""
+    global _http, _timer
+    for d in (mqtt_dispatcher, ntfy_dispatcher):
+        await d.close()
+    if _timer is not None:
+        _timer.cancel()  # the digest stays pending in the state file
+        _timer = None
+    if _publisher is not None:
+        await _publisher.stop()
+    if _http is not None:
+        await _http.aclose()
+        _http = None
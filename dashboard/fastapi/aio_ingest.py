@@ -0,0 +1,96 @@
+# aio_ingest.py
+# Async client of the ingest writer sidecar (see ../flask/ingest_writer.py)
+# for the FastAPI server: same protocol, one JSON line {"rows": [...]} ->
+# {"ok": true}, over pooled asyncio Unix socket connections, so a request
+# waiting for its group commit holds no thread. Like the sync client it only
+# times out connecting, never waiting for the commit. With INGEST_WRITER=direct, or
+# while the sidecar isn't reachable, rows go through storage.append in the
+# threadpool instead.
+import asyncio
+import json
+import logging
+
+from starlette.concurrency import run_in_threadpool
+
+import storage
+from ingest_writer import CLIENT_TIMEOUT, skip_rows
+from settings import INGEST_SOCKET, INGEST_WRITER
+
+logger = logging.getLogger("dashboard")
+
+_idle = []  # connected (reader, writer) pairs not in use
+_warned = False
+
+
+async def _checkout():
+    while _idle:
+        reader, writer = _idle.pop()
+        # the writer closed it (a restart) while it sat in the pool
+        if not (reader.at_eof() or writer.is_closing()):
+            return reader, writer
+        writer.close()
+    return await asyncio.wait_for(asyncio.open_unix_connection(INGEST_SOCKET), CLIENT_TIMEOUT)
+
+
+def _discard(conn):
+    conn[1].close()
+
+
+async def _direct(rows, reason):
+    global _warned
+    if not _warned:
+        logger.warning(f"[ingest] writer not reachable on {INGEST_SOCKET} ({reason}); writing directly")
+        _warned = True
+    return await run_in_threadpool(storage.append, rows)
+
+
+async def append(rows):
+    """Persist one reading (dict) or a list of readings through the ingest
+    writer, or directly when it is disabled or unreachable. Returns the rows
+    stored."""
+    global _warned
+    if isinstance(rows, dict):
+        rows = [rows]
+    if INGEST_WRITER != "sidecar":
+        return await run_in_threadpool(storage.append, rows)
+
+    payload = json.dumps({"rows": rows}, default=float).encode() + b"\n"
+    for attempt in range(2):
+        try:
+            conn = await _checkout()
+        except (OSError, asyncio.TimeoutError) as e:
+            return await _direct(rows, str(e) or "timeout")
+        try:
+            conn[1].write(payload)
+            await conn[1].drain()
+            break
+        except OSError as e:
+            # a pooled connection from before a writer restart; nothing was read yet
+            _discard(conn)
+            if attempt:
+                return await _direct(rows, e)
+        except BaseException:
+            _discard(conn)
+            raise
+
+    try:
+        # no timeout once sent: the rows may be committing (see ingest_writer.py)
+        line = await conn[0].readline()
+    except BaseException:
+        # cancelled or reset mid-reply: the stream is in an unknown state
+        _discard(conn)
+        raise
+    if not line:
+        _discard(conn)
+        raise ConnectionError("ingest writer closed the connection")
+    _idle.append(conn)
+    _warned = False
+    reply = json.loads(line)
+    if not reply.get("ok"):
+        raise RuntimeError(f"ingest writer: {reply.get('error')}")
+    return skip_rows(rows, reply.get("skipped"))
+
+
+def close():
+    while _idle:
+        _discard(_idle.pop())
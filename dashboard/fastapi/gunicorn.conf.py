@@ -0,0 +1,60 @@
+# gunicorn.conf.py
+# The FastAPI server (main.py) under gunicorn with uvicorn workers:
+#   gunicorn -c gunicorn.conf.py main:app
+# Each worker runs one event loop; MQTT, ntfy, ingest writes and /api/stream
+# wait on it, so a worker needs no extra threads per request.
+import gc
+import os
+import sys
+
+FLASK_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "flask")
+sys.path.insert(0, FLASK_DIR)
+
+# Logging
+loglevel = 'info'
+capture_output = True
+accesslog = os.path.join(FLASK_DIR, 'logs/gunicorn-access.log')
+errorlog = os.path.join(FLASK_DIR, 'logs/gunicorn-error.log')
+
+# Workers and performance
+workers = 2
+worker_class = 'uvicorn.workers.UvicornWorker'  # uvloop and httptools when installed
+graceful_timeout = 10  # /api/stream connections stay open until the worker gives up on them
+
+# Import the app once in the master and fork workers from it (set
+# GUNICORN_PRELOAD=false to import per worker). Connections, dispatcher
+# tasks and the latest-reading mmap are created lazily in each worker.
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").strip().lower() in ("1", "true", "yes", "on")
+
+# Binding
+bind = '0.0.0.0:8000'
+
+
+# Ingest writer sidecar, shared with the Flask deployment (see ingest_writer.py;
+# INGEST_WRITER=direct disables it)
+def on_starting(server):
+    import subprocess
+    import metrics
+    metrics.reset()  # counters restart with the server; workers and the writer repopulate them
+    if os.getenv("INGEST_WRITER", "sidecar") != "sidecar":
+        return
+    server.ingest_writer = subprocess.Popen([sys.executable, os.path.join(FLASK_DIR, "ingest_writer.py")], cwd=FLASK_DIR)
+
+
+def on_exit(server):
+    proc = getattr(server, "ingest_writer", None)
+    if proc is not None:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+
+def child_exit(server, worker):
+    # fold the worker's counters into the retired total, also if it was
+    # killed before its atexit hook could (see metrics.py)
+    import metrics
+    metrics.retire(worker.pid)
+
+
+def pre_fork(server, worker):
+    # keep the preloaded heap shared copy-on-write (see ../flask/gunicorn.conf.py)
+    gc.freeze()
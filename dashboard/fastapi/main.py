@@ -0,0 +1,471 @@
+# main.py
+# Async FastAPI server for the garden dashboard: the same endpoints, storage
+# layer, validation and ingest pipeline as the Flask app in ../flask (whose
+# modules it imports), so either server can run against the same logs and
+# config.json, and both can be benchmarked head to head
+# (../flask/utils/bench-load.py --server fastapi).
+#
+# Run from dashboard/fastapi:
+#   gunicorn -c gunicorn.conf.py main:app   # uvicorn workers + the ingest writer sidecar
+#   uvicorn main:app --reload               # development (set INGEST_WRITER=direct)
+#
+# Where a request waits, it waits on the event loop, not in a worker:
+#   - writes go to the ingest writer over pooled asyncio Unix sockets (aio_ingest.py)
+#   - MQTT (aiomqtt) and ntfy (httpx.AsyncClient) run as asyncio tasks (aio_dispatch.py)
+#   - /api/stream clients are asyncio subscribers of stream_hub
+#   - file-bound work (history and stats queries, the flock'd anomaly and alert
+#     state, rollups) runs in the threadpool
+import os
+import sys
+
+FLASK_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "flask")
+sys.path.insert(0, FLASK_DIR)
+# config.json is shared with the Flask app, which runs from its own directory
+os.environ.setdefault("CONFIG_FILE", os.path.join(FLASK_DIR, "config.json"))
+
+import json
+import logging
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from dotenv import load_dotenv
+from fastapi import FastAPI, Request
+from fastapi.responses import Response, StreamingResponse
+from fastapi.staticfiles import StaticFiles
+from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
+
+load_dotenv(os.path.join(FLASK_DIR, ".env"))
+
+import aio_dispatch
+import aio_ingest
+import anomaly
+import daily_stats
+import latest_store
+import metrics
+import pipeline
+from logging_config import setup_loggers
+from sensor_utils import history_etag, parse_history_args, query_history
+from settings import LOG_DIR, STORAGE_BACKEND
+from shared import apply_config_update, config_etag, config_version, dumps, encode_body, load_config, validate_config_update
+from storage import DEFAULT_DEVICE, list_devices, valid_device
+from stream_hub import KEEPALIVE as STREAM_KEEPALIVE, frame as sse_frame, hub as stream_hub
+
+logger = logging.getLogger("dashboard")
+os.makedirs(LOG_DIR, exist_ok=True)
+setup_loggers()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    await aio_dispatch.close()
+    aio_ingest.close()
+
+
+app = FastAPI(title="Garden Environment Sensor", lifespan=lifespan)
+app.mount("/static", StaticFiles(directory=os.path.join(FLASK_DIR, "static")), name="static")
+templates = Jinja2Templates(directory=os.path.join(FLASK_DIR, "templates"))
+# the templates are written for Flask: url_for('static', filename=...)
+templates.env.globals["url_for"] = lambda endpoint, filename: app.url_path_for(endpoint, path=filename)
+
+
+# -- responses ------------------------------------------------------------------
+
+def api_response(status="ok", message=None, data=None, http_status=200, **extra):
+    resp = {"status": status}
+    if message: resp["message"] = message
+    if data is not None: resp["data"] = data
+    resp.update({k: v for k, v in extra.items() if v is not None})
+    return Response(dumps(resp), status_code=http_status, media_type="application/json")
+
+
+def _etag_matches(request, etag, weak=True):
+    """If-None-Match contains `etag` (weak comparison unless weak=False)."""
+    for tag in request.headers.get("if-none-match", "").split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            if not weak:
+                continue
+            tag = tag[2:]
+        if tag.strip('"') == etag:
+            return True
+    return False
+
+
+def _not_modified(etag, weak=True):
+    headers = {"ETag": f'W/"{etag}"' if weak else f'"{etag}"'}
+    if weak:
+        headers["Cache-Control"] = "no-cache"
+    return Response(status_code=304, headers=headers)
+
+
+def _with_etag(resp, etag):
+    resp.headers["ETag"] = f'W/"{etag}"'
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+
+def _accepts(header):
+    """Accept-Encoding -> predicate for shared.encode_body."""
+    quality = {}
+    for part in header.split(","):
+        name, _, params = part.partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name.strip():
+            quality[name.strip().lower()] = q
+    return lambda name: quality.get(name, quality.get("*", 0)) > 0
+
+
+class Instrumented:
+    """Per-request metrics and Brotli/gzip encoding of JSON responses, like the
+    Flask app's before/after_request hooks (a plain ASGI middleware, so streamed
+    responses pass straight through)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        held = None
+
+        def record(status):
+            # for /api/stream this covers only setting up the stream
+            route = scope["route"].path if "route" in scope else "unmatched"
+            metrics.observe("garden_http_request_duration_seconds", time.perf_counter() - start,
+                            route=route, method=scope["method"])
+            metrics.inc("garden_http_requests_total", route=route, method=scope["method"], status=status)
+
+        async def wrapped_send(message):
+            nonlocal held
+            if message["type"] == "http.response.start":
+                headers = dict(message.get("headers", ()))
+                if (message["status"] == 200 and b"content-encoding" not in headers
+                        and headers.get(b"content-type", b"").startswith(b"application/json")):
+                    held = message  # wait for the body
+                    return
+                record(message["status"])
+            elif held is not None and message["type"] == "http.response.body":
+                start_message, held = held, None
+                if not message.get("more_body"):
+                    message, start_message = self._encode(scope, start_message, message)
+                record(start_message["status"])
+                await send(start_message)
+            await send(message)
+
+        await self.app(scope, receive, wrapped_send)
+
+    @staticmethod
+    def _encode(scope, start, message):
+        request_headers = dict(scope["headers"])
+        accepts = _accepts(request_headers.get(b"accept-encoding", b"").decode("latin-1"))
+        body, encoding = encode_body(message.get("body", b""), accepts)
+        headers = [(k, v) for k, v in start.get("headers", ()) if k != b"content-length"]
+        headers += [(b"content-length", str(len(body)).encode()), (b"vary", b"Accept-Encoding")]
+        if encoding:
+            headers.append((b"content-encoding", encoding.encode()))
+        return {**message, "body": body}, {**start, "headers": headers}
+
+
+app.add_middleware(Instrumented)
+
+
+def _mimetype(request):
+    return request.headers.get("content-type", "").split(";")[0].strip().lower()
+
+
+def _is_json(mimetype):
+    return mimetype == "application/json" or (mimetype.startswith("application/") and mimetype.endswith("+json"))
+
+
+async def _after_write(rows):
+    """pipeline.after_write with the async dispatcher."""
+    await run_in_threadpool(pipeline.update_derived, rows)
+    pipeline.publish(rows)
+    # side-effects run in the background and should not crash the request
+    try:
+        aio_dispatch.dispatch_readings(rows)
+    except Exception as e:
+        logger.error(f"[DISPATCH] enqueue failed: {e}")
+
+
+# -- routes -----------------------------------------------------------------------
+
+# [GET] /dashboard ---------------------------------------------------------
+@app.get("/dashboard")
+async def dashboard(request: Request):
+    # the page fetches its data from /api/history; nothing to read here
+    return templates.TemplateResponse(request, "dashboard.html", {"year": datetime.now().year})
+
+
+# [GET] /api/sensor  --------------------------------------------------------
+@app.get("/api/sensor")
+async def get_sensor_data(device: str = DEFAULT_DEVICE):
+    latest_data = latest_store.read(device)
+    if latest_data is None:
+        return api_response("error", "No data received yet")
+
+    try:
+        dt = datetime.fromisoformat(latest_data["timestamp"].replace("Z", ""))
+        formatted = {
+            "timestamp": dt.isoformat(),
+            "device_id": latest_data["device_id"],
+            "display_time": dt.strftime("%-m/%-d/%y %I:%M %p"),
+            "temp_f": float(latest_data["temp_f"]),
+            "humidity": float(latest_data["humidity"]),
+            "lux": float(latest_data["lux"]),
+            "moisture": float(latest_data.get("moisture", 0))
+        }
+        return api_response(data=formatted)
+    except (ValueError, KeyError) as e:
+        return api_response("error", str(e), http_status=500)
+
+
+# [POST] /api/sensor  -------------------------------------------------------
+@app.post("/api/sensor")
+async def post_sensor_data(request: Request):
+    try:
+        if not _is_json(_mimetype(request)):
+            return api_response("error", "Content-Type must be application/json", http_status=400)
+
+        try:
+            data = json.loads(await request.body())
+        except ValueError:
+            data = None
+        if not data or not isinstance(data, dict):
+            return api_response("error", "Invalid or missing JSON payload", http_status=400)
+
+        started = time.perf_counter()
+        device_id = data.get("device_id") or DEFAULT_DEVICE
+        if not valid_device(device_id):
+            return api_response("error", "device_id must be 1-32 letters, digits, '-' or '_'", http_status=400)
+
+        try:
+            latest_data = pipeline.parse_reading(data)
+        except ValueError as ve:
+            logger.error(f"[API] /api/sensor validation error: {ve}; payload={data}")
+            metrics.inc("garden_ingest_rows_total", outcome="rejected")
+            return api_response("error", str(ve), http_status=400)
+        metrics.observe("garden_ingest_stage_duration_seconds", time.perf_counter() - started, stage="validate")
+
+        kept, flagged = await run_in_threadpool(pipeline.detect, [latest_data])
+        anomalies = flagged[0][1] if flagged else None
+        if not kept:
+            return api_response("ok", data={"received": True, "quarantined": True, "anomalies": anomalies})
+
+        try:
+            with pipeline.stage("write"):
+                stored = await aio_ingest.append(latest_data)
+        except Exception as e:
+            logger.error(f"[CSV] write failed: {e}")
+            return api_response("error", "Failed to write log", http_status=500)
+
+        if not stored:
+            metrics.inc("garden_ingest_rows_total", outcome="duplicate")
+            return api_response("ok", data={"received": True, "duplicate": True})
+        await _after_write(stored)
+        metrics.inc("garden_ingest_rows_total", outcome="accepted")
+        return api_response("ok", data={"received": True, "anomalies": anomalies} if anomalies else {"received": True})
+    except Exception:
+        logger.exception("[API] /api/sensor unhandled")
+        return api_response("error", "internal error", http_status=500)
+
+
+# [POST] /api/sensor/batch  -------------------------------------------------
+@app.post("/api/sensor/batch")
+async def post_sensor_batch(request: Request):
+    """Accept a JSON array (or {"readings": [...]}) or an NDJSON body of readings."""
+    try:
+        mimetype = _mimetype(request)
+        if mimetype not in pipeline.NDJSON_TYPES and not _is_json(mimetype):
+            return api_response("error", "Content-Type must be application/json or application/x-ndjson", http_status=400)
+        try:
+            items, rejected = pipeline.parse_batch(await request.body(), ndjson=mimetype in pipeline.NDJSON_TYPES)
+        except ValueError as e:
+            return api_response("error", str(e), http_status=400)
+
+        if not items:
+            return api_response("error", "No readings in batch", http_status=400)
+        if len(items) > pipeline.BATCH_MAX:
+            return api_response("error", f"Batch too large (max {pipeline.BATCH_MAX} readings)", http_status=413)
+
+        rows, rejected = await run_in_threadpool(pipeline.validate_batch, items, rejected)
+        if not rows:
+            return api_response("error", "No valid readings in batch", http_status=400, data={"accepted": 0, "rejected": rejected})
+        if rejected:
+            logger.warning(f"[API] /api/sensor/batch rejected {len(rejected)} of {len(items)} readings")
+
+        rows, flagged = await run_in_threadpool(pipeline.detect, rows)
+        stored = rows
+        if rows:
+            try:
+                with pipeline.stage("write"):
+                    stored = await aio_ingest.append(rows)
+            except Exception as e:
+                logger.error(f"[CSV] batch write failed: {e}")
+                return api_response("error", "Failed to write log", http_status=500)
+
+            if stored:
+                await _after_write(stored)
+            metrics.inc("garden_ingest_rows_total", len(stored), outcome="accepted")
+            if len(stored) < len(rows):
+                metrics.inc("garden_ingest_rows_total", len(rows) - len(stored), outcome="duplicate")
+        return api_response("ok", data=pipeline.batch_result(stored, rejected, flagged, len(rows) - len(stored)))
+    except Exception:
+        logger.exception("[API] /api/sensor/batch unhandled")
+        return api_response("error", "internal error", http_status=500)
+
+
+# [GET|POST] /api/config  ---------------------------------------------------
+@app.get("/api/config")
+async def get_config(request: Request, version: str = None):
+    # sleeping devices revalidate with If-None-Match (or ?version=N) and get
+    # an empty 304 while nothing changed
+    etag = config_etag()
+    if _etag_matches(request, etag, weak=False) or version == str(config_version()):
+        return _not_modified(etag, weak=False)
+    resp = api_response(data=load_config())
+    resp.headers["ETag"] = f'"{etag}"'
+    return resp
+
+
+@app.post("/api/config")
+async def post_config(request: Request):
+    try:
+        try:
+            new_cfg = json.loads(await request.body())
+        except ValueError:
+            new_cfg = None
+        if not new_cfg or not isinstance(new_cfg, dict):
+            logger.error("[API] /api/config: No JSON body found")
+            return api_response("error", "No JSON Found", http_status=400)
+
+        try:
+            validated = validate_config_update(new_cfg)
+        except ValueError as e:
+            return api_response("error", str(e), http_status=400)
+        config = await run_in_threadpool(apply_config_update, validated)
+
+        return api_response("ok", data=config)
+
+    except Exception as e:
+        logger.error(f"[API] Exception in /api/config: {e}")
+        return api_response("error", str(e), http_status=500)
+
+
+# [GET] /api/config/version  ------------------------------------------------
+@app.get("/api/config/version")
+async def config_version_handler():
+    resp = api_response(data={"config_version": config_version()})
+    resp.headers["ETag"] = f'"{config_etag()}"'
+    return resp
+
+
+# /api/devices  -------------------------------------------------------------
+def _devices():
+    latest = latest_store.read_all()
+    devices = sorted(set(list_devices()) | set(latest))
+    return [{"device_id": d, "latest": latest.get(d)} for d in devices]
+
+
+@app.get("/api/devices")
+async def get_devices():
+    return api_response(data=await run_in_threadpool(_devices))
+
+
+# /api/stats  --------------------------------------------------------------
+# Daily VPD, DLI, GDD and per-metric stats; see the Flask route for the args
+@app.get("/api/stats")
+async def get_stats(request: Request):
+    try:
+        q = daily_stats.parse_query(request.query_params)
+    except ValueError as e:
+        return api_response("error", str(e), http_status=400)
+
+    etag = history_etag(request.url.query, [q["device"]], relative=True)
+    if _etag_matches(request, etag):
+        return _not_modified(etag)
+    return _with_etag(api_response(data=await run_in_threadpool(daily_stats.query, q)), etag)
+
+
+# /api/anomalies  ----------------------------------------------------------
+@app.get("/api/anomalies")
+async def get_anomalies(device: str = None):
+    if device is not None and not valid_device(device):
+        return api_response("error", "device must be 1-32 letters, digits, '-' or '_'", http_status=400)
+    return api_response(data={"mode": anomaly.MODE, "devices": await run_in_threadpool(anomaly.summary, device)})
+
+
+# /api/stream  --------------------------------------------------------------
+# Server-Sent Events, as in the Flask app; each connection is a coroutine
+# waiting on an asyncio subscriber
+@app.get("/api/stream")
+async def stream(device: str = None):
+    if device is not None and not valid_device(device):
+        return api_response("error", "invalid device", http_status=400)
+
+    sub = stream_hub.subscribe_async(device)
+    current = latest_store.read_all()
+    if device is not None:
+        current = {device: current[device]} if device in current else {}
+
+    async def events():
+        try:
+            yield b"retry: 5000\n\n"
+            for reading in current.values():
+                yield sse_frame("reading", json.dumps(reading))
+            while True:
+                frames = await sub.get(timeout=STREAM_KEEPALIVE)
+                # a comment line keeps proxies from timing out idle streams
+                yield b"".join(frames) if frames else b": keepalive\n\n"
+        finally:
+            sub.close()
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# /metrics  -----------------------------------------------------------------
+@app.get("/metrics")
+async def metrics_handler():
+    return Response(await run_in_threadpool(metrics.render), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# /api/status
+@app.get("/api/status")
+async def status():
+    return api_response(message="API is running!")
+
+
+# /api/history  -------------------------------------------------------------
+@app.get("/api/history")
+async def get_history(request: Request):
+    try:
+        q = parse_history_args(request.query_params)
+    except ValueError as e:
+        return api_response("error", str(e), http_status=400)
+
+    logger.info(f"[API] /history backend={STORAGE_BACKEND}, filter_range={q['filter_range']}, day={q['day']}, device={','.join(q['devices'])}")
+
+    # answered from the write version alone: no log read for unchanged data
+    etag = history_etag(request.url.query, q["devices"], relative=q["relative"])
+    if _etag_matches(request, etag):
+        return _not_modified(etag)
+
+    data, extra, error = await run_in_threadpool(query_history, q)
+    if error:
+        logger.error(f"[API] /api/history error: {error}")
+        return api_response("error", error, http_status=404)
+    return _with_etag(api_response(data=data, **extra), etag)
@@ -0,0 +1,198 @@
+# alerts.py
+# Threshold alerting for ntfy: notify on rule transitions, not on every reading.
+#
+# Rules come from the "alerts" section of config.json, e.g.
+#   "alerts": {
+#     "window": 900,
+#     "rules": [
+#       {"metric": "moisture", "min": 20, "hysteresis": 2},
+#       {"metric": "temp_f", "min": 35, "max": 100}
+#     ]
+#   }
+# A rule is active while the value is outside [min, max]. It clears once the
+# value is back inside by `hysteresis`. Only the transitions are recorded.
+# Transitions within `window` seconds are coalesced into one digest message.
+# Rule state lives in a small JSON file under flock so every gunicorn worker
+# agrees on it.
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from ntfy_handler import send_ntfy_message
+from sensor_utils import format_sensor_data
+from settings import ALERT_STATE_FILE
+from shared import load_config
+from storage import DEFAULT_DEVICE
+
+logger = logging.getLogger("ntfy")
+
+DEFAULT_ALERTS = {
+    "window": 900,
+    "rules": [
+        {"metric": "moisture", "min": 20, "hysteresis": 2},
+        {"metric": "temp_f", "min": 35, "max": 100, "hysteresis": 1},
+    ],
+}
+
+_timer = None
+_timer_lock = threading.Lock()
+
+
+def _rule_id(rule, device=DEFAULT_DEVICE):
+    return f"{device}:{rule['metric']}:{rule.get('min')}:{rule.get('max')}"
+
+
+def evaluate(rule, value, active):
+    """Return the rule's new active state for `value`."""
+    lo, hi = rule.get("min"), rule.get("max")
+    if not active:
+        return (lo is not None and value < lo) or (hi is not None and value > hi)
+    h = rule.get("hysteresis", 0)
+    return (lo is not None and value < lo + h) or (hi is not None and value > hi - h)
+
+
+def describe(rule, value, active, device=DEFAULT_DEVICE):
+    metric = rule["metric"] if device == DEFAULT_DEVICE else f"{device} {rule['metric']}"
+    if not active:
+        return f"✅ {metric} back to normal ({value})"
+    if rule.get("min") is not None and value < rule["min"]:
+        return f"⚠️ {metric} below {rule['min']} ({value})"
+    return f"⚠️ {metric} above {rule['max']} ({value})"
+
+
+@contextmanager
+def _state():
+    os.makedirs(os.path.dirname(ALERT_STATE_FILE), exist_ok=True)
+    with open(ALERT_STATE_FILE, "a+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            try:
+                state = json.loads(f.read() or "{}")
+            except ValueError:
+                state = {}
+            state.setdefault("active", {})
+            state.setdefault("pending", [])
+            state.setdefault("last_sent", 0)
+            yield state
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(state))
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _settings():
+    return {**DEFAULT_ALERTS, **(load_config().get("alerts") or {})}
+
+
+def process(readings):
+    """Record rule transitions for one reading (or a time-sorted batch) and
+    send a digest if one is due.
+
+    Safe to call again with the same readings (the dispatcher retries on
+    failure): an unchanged state records nothing new.
+    """
+    record(readings)
+    flush()
+
+
+def record(readings):
+    """Record the rule transitions of one reading or a time-sorted batch."""
+    if isinstance(readings, dict):
+        readings = [readings]
+    cfg = _settings()
+    with _state() as state:
+        for reading in readings:
+            for rule in cfg["rules"]:
+                metric = rule.get("metric")
+                if metric not in reading:
+                    continue
+                device = reading.get("device_id") or DEFAULT_DEVICE
+                value = float(reading[metric])
+                rid = _rule_id(rule, device)
+                was = state["active"].get(rid, False)
+                now_active = evaluate(rule, value, was)
+                if now_active != was:
+                    state["active"][rid] = now_active
+                    state["pending"].append(describe(rule, value, now_active, device))
+        if state["pending"] and readings:
+            state["reading"] = readings[-1]
+
+
+def claim_digest(force=False):
+    """Take the pending transitions as one digest once the window has elapsed.
+
+    Returns (digest, wait): the digest (message, title, priority and what
+    `restore` needs) or None, and the seconds until one is due (None when
+    nothing is pending). Claiming marks the digest sent, so concurrent
+    workers don't send it twice; `restore` it if sending fails.
+    """
+    window = float(_settings()["window"])
+    with _state() as state:
+        if not state["pending"]:
+            return None, None
+        wait = state["last_sent"] + window - time.time()
+        if wait > 0 and not force:
+            return None, wait
+        lines = state["pending"]
+        body = "\n".join(lines)
+        if state.get("reading"):
+            body += "\n\n" + format_sensor_data(state["reading"])
+        digest = {
+            "message": body,
+            "title": "Garden Alert" if len(lines) == 1 else f"Garden Alert ({len(lines)} changes)",
+            "priority": "high" if any(l.startswith("⚠️") for l in lines) else "default",
+            "lines": lines,
+            "last_sent": state["last_sent"],
+        }
+        state["pending"] = []
+        state["last_sent"] = time.time()
+        return digest, 0
+
+
+def restore(digest):
+    """Put a claimed digest that couldn't be sent back in front of the pending transitions."""
+    with _state() as state:
+        state["pending"] = digest["lines"] + state["pending"]
+        state["last_sent"] = digest["last_sent"]
+
+
+def flush(force=False):
+    """Send pending transitions as one digest once the window has elapsed."""
+    digest, wait = claim_digest(force)
+    if digest is None:
+        if wait is not None:
+            _schedule(wait)
+        return
+    try:
+        send_ntfy_message(digest["message"], title=digest["title"], priority=digest["priority"])
+    except Exception:
+        # leave the digest pending for the retry
+        restore(digest)
+        raise
+
+
+def _schedule(delay):
+    global _timer
+    with _timer_lock:
+        if _timer is not None and _timer.is_alive():
+            return
+        _timer = threading.Timer(delay + 0.5, _flush_quietly)
+        _timer.daemon = True
+        _timer.start()
+
+
+def _flush_quietly():
+    global _timer
+    try:
+        flush()
+    except Exception as e:
+        logger.error(f"[ntfy] digest send failed: {e}; retrying in 60s")
+        with _timer_lock:
+            _timer = None
+        _schedule(60)
@@ -0,0 +1,336 @@
+# anomaly.py
+# Streaming sensor-fault detection on ingest, O(1) per reading.
+#
+# Every (device, metric) keeps a few numbers: an EWMA mean and variance, the
+# last accepted value and time, the current run of identical values and
+# counts per kind. A reading is checked against them before it's written:
+#   spike  more than `z` standard deviations (at least `floor`) from the
+#          EWMA mean, once `warmup` readings have been seen
+#   rate   changed faster than `rate` units per minute (plus `floor`) since
+#          the last accepted reading
+#   stuck  the same value for `stuck` seconds or more (values listed in
+#          `stuck_ignore`, like lux 0 at night, are fine)
+#   zero   exactly 0 while the metric's mean is above `floor` (a failed read)
+# Anomalous values don't move the EWMA, so one bad reading can't widen the
+# band for the next; after `reseed` spikes/jumps in a row the new level is
+# taken as real and the model restarts from it, as it does after a gap of
+# more than `stale` seconds (a sensor back from a long outage).
+#
+# ANOMALY_MODE: "flag" writes anomalous readings as usual and only counts
+# them, "quarantine" appends them to logs/quarantine.csv (with the reasons)
+# instead of storage, "off" skips the stage. Thresholds come from the
+# "anomaly" section of config.json, merged over DEFAULT_ANOMALY per metric:
+#   "anomaly": {"metrics": {"humidity": {"rate": 30}, "moisture": {"zero": false}}}
+# The state is a memory-mapped table of fixed-size records (one slot per
+# device, one record per metric, like latest_store.py), updated in place under
+# a flock, so every gunicorn worker sees the same history and a reading costs
+# a few field writes rather than a rewrite of the whole state.
+import argparse
+import copy
+import csv
+import fcntl
+import logging
+import math
+import os
+import sys
+from contextlib import contextmanager
+
+import numpy as np
+
+import metrics
+from latest_store import MAX_DEVICES
+from settings import ANOMALY_STATE_FILE, QUARANTINE_FILE
+from shared import load_config
+from storage import DEFAULT_DEVICE, METRICS, format_ts, to_epoch
+
+logger = logging.getLogger("dashboard")
+
+MODES = ("flag", "quarantine", "off")
+MODE = os.getenv("ANOMALY_MODE", "flag").strip().lower()
+KINDS = ("spike", "rate", "stuck", "zero")
+if MODE not in MODES:
+    logger.warning(f"[ANOMALY] unknown ANOMALY_MODE={MODE!r}, using flag")
+    MODE = "flag"
+
+DEFAULT_ANOMALY = {
+    "alpha": 0.05,  # EWMA weight of a new reading
+    "warmup": 20,   # readings before the spike check applies
+    "reseed": 5,    # consecutive spikes/jumps taken as a new level
+    "stale": 3600,  # seconds without an accepted reading before the model restarts
+    "metrics": {
+        "temp_f":   {"z": 6, "floor": 0.5, "rate": 5, "stuck": 7200, "zero": True},
+        "humidity": {"z": 6, "floor": 2, "rate": 15, "stuck": 7200, "zero": True},
+        # light legitimately jumps (clouds, grow lights) and sits at 0 all night
+        "lux":      {"z": None, "floor": 0, "rate": None, "stuck": 7200, "stuck_ignore": [0], "zero": False},
+        # watering is a legitimate jump; a probe out of the soil reads 0
+        "moisture": {"z": None, "floor": 2, "rate": None, "stuck": None, "zero": True},
+    },
+}
+
+
+def _settings():
+    cfg = copy.deepcopy(DEFAULT_ANOMALY)
+    custom = load_config().get("anomaly") or {}
+    cfg.update({k: v for k, v in custom.items() if k != "metrics"})
+    for m, rules in (custom.get("metrics") or {}).items():
+        if m in cfg["metrics"]:
+            cfg["metrics"][m].update(rules)
+    return cfg
+
+
+# -- state ----------------------------------------------------------------------
+#
+# Layout: MAGIC, then MAX_DEVICES slots of (device_id, one STATE record per
+# metric in METRICS order). Unset floats are NaN; an unused slot has an
+# empty device_id.
+
+MAGIC = b"GEANOM01"
+STATE = np.dtype([
+    ("n", "<i8"), ("mean", "<f8"), ("var", "<f8"),       # EWMA model
+    ("last", "<f8"), ("last_t", "<i8"),                  # last accepted reading
+    ("same", "<f8"), ("same_since", "<i8"), ("same_n", "<i8"),
+    ("run", "<i8"),                                      # spikes/jumps in a row
+    ("counts", "<i8", (len(KINDS),)),
+    ("anomaly_t", "<i8"), ("anomaly_kind", "<i8"), ("anomaly_value", "<f8"),  # kind -1: none yet
+])
+SLOT = np.dtype([("device", "S32"), ("metrics", STATE, (len(METRICS),))])
+
+_table = None
+_slots = {}  # device_id -> slot index, cached per process
+
+
+def _mapping():
+    global _table
+    if _table is None:
+        os.makedirs(os.path.dirname(ANOMALY_STATE_FILE), exist_ok=True)
+        size = len(MAGIC) + MAX_DEVICES * SLOT.itemsize
+        with open(ANOMALY_STATE_FILE, "ab") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                with open(ANOMALY_STATE_FILE, "rb") as r:
+                    magic = r.read(len(MAGIC))
+                if os.fstat(f.fileno()).st_size != size or magic != MAGIC:
+                    # new file or an older layout: start fresh
+                    f.truncate(0)
+                    f.write(MAGIC + bytes(size - len(MAGIC)))
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        _table = np.memmap(ANOMALY_STATE_FILE, dtype=SLOT, mode="r+", offset=len(MAGIC), shape=(MAX_DEVICES,))
+    return _table
+
+
+def _new_metric():
+    st = np.zeros((), dtype=STATE)
+    for field in ("mean", "last", "same", "anomaly_value"):
+        st[field] = np.nan
+    st["anomaly_kind"] = -1
+    return st
+
+
+_EMPTY = _new_metric()
+
+
+def _slot(table, device, claim=False):
+    """Slot index of a device (claimed and initialized if `claim`), or None."""
+    i = _slots.get(device)
+    if i is not None and table["device"][i] == device.encode():
+        return i
+    names = table["device"]
+    found = np.flatnonzero(names == device.encode())
+    if len(found):
+        _slots[device] = int(found[0])
+        return _slots[device]
+    free = np.flatnonzero(names == b"")
+    if not claim:
+        return None
+    if not len(free):
+        raise RuntimeError(f"anomaly state full ({MAX_DEVICES} devices)")
+    i = int(free[0])
+    table["metrics"][i] = _EMPTY
+    table["device"][i] = device.encode()
+    _slots[device] = i
+    return i
+
+
+@contextmanager
+def _state():
+    """The state table, locked against the other workers."""
+    table = _mapping()
+    with open(ANOMALY_STATE_FILE, "rb") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield table
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _seen(st):
+    return not math.isnan(st["last"])
+
+
+def _reseed(st, x, floor):
+    st["mean"], st["var"], st["n"] = x, floor * floor, 0
+
+
+def check(rule, st, t, x, cfg=DEFAULT_ANOMALY):
+    """Kinds of anomaly for value `x` at epoch `t`, updating the metric state
+    `st`; `cfg` holds alpha, warmup, reseed and stale."""
+    kinds = []
+    floor = float(rule.get("floor") or 0)
+    seen = _seen(st)
+    if seen and t - st["last_t"] > cfg["stale"]:
+        _reseed(st, x, floor)
+    if rule.get("zero") and x == 0 and st["mean"] > floor:  # False while mean is NaN
+        kinds.append("zero")
+    z = rule.get("z")
+    if z and st["n"] >= cfg["warmup"]:
+        if abs(x - st["mean"]) > z * max(math.sqrt(st["var"]), floor):
+            kinds.append("spike")
+    if seen and t < st["last_t"]:
+        # backfilled: judged against the current model, which it doesn't change
+        return kinds
+
+    rate = rule.get("rate")
+    dt = t - st["last_t"]
+    # readings in the same second have no interval to scale the allowance by
+    if rate and seen and dt > 0 and abs(x - st["last"]) > floor + rate * dt / 60:
+        kinds.append("rate")
+    if x == st["same"]:
+        st["same_n"] += 1
+    else:
+        st["same"], st["same_since"], st["same_n"] = x, t, 1
+    stuck = rule.get("stuck")
+    if (stuck and st["same_n"] >= 3 and t - st["same_since"] >= stuck
+            and x not in (rule.get("stuck_ignore") or ())):
+        kinds.append("stuck")
+
+    if kinds and kinds != ["stuck"] and "zero" not in kinds:
+        st["run"] += 1
+        if st["run"] < cfg["reseed"]:
+            return kinds
+        # a sustained shift, not a glitch: restart the model from here
+        _reseed(st, x, floor)
+        kinds = [k for k in kinds if k not in ("spike", "rate")]
+    elif kinds:
+        return kinds
+    st["run"] = 0
+    if math.isnan(st["mean"]):
+        st["mean"] = x
+    else:
+        d = x - st["mean"]
+        st["mean"] += cfg["alpha"] * d
+        st["var"] = (1 - cfg["alpha"]) * (st["var"] + cfg["alpha"] * d * d)
+    st["n"] += 1
+    st["last"], st["last_t"] = x, t
+    return kinds
+
+
+def screen(rows, mode=None):
+    """Check readings (time-sorted dicts) in arrival order. Returns (kept,
+    flagged): the rows to write and [(row, ["metric:kind", ...])] for the
+    anomalous ones. In quarantine mode those are left out of `kept` and
+    appended to the quarantine file."""
+    mode = mode or MODE
+    if mode == "off" or not rows:
+        return rows, []
+    cfg = _settings()
+    kept, flagged = [], []
+    with _state() as table:
+        for row in rows:
+            device = row.get("device_id") or DEFAULT_DEVICE
+            t = to_epoch(row["timestamp"])
+            per_device = table["metrics"][_slot(table, device, claim=True)]
+            reasons = []
+            for m, rule in cfg["metrics"].items():
+                if m not in row:
+                    continue
+                st = per_device[METRICS.index(m)]
+                for kind in check(rule, st, t, float(row[m]), cfg):
+                    st["counts"][KINDS.index(kind)] += 1
+                    st["anomaly_t"], st["anomaly_kind"], st["anomaly_value"] = t, KINDS.index(kind), row[m]
+                    reasons.append(f"{m}:{kind}")
+            if reasons:
+                flagged.append((row, reasons))
+            if not reasons or mode != "quarantine":
+                kept.append(row)
+    action = "quarantined" if mode == "quarantine" else "flagged"
+    for row, reasons in flagged:
+        for reason in reasons:
+            m, kind = reason.split(":")
+            metrics.inc("garden_anomalies_total", metric=m, kind=kind, action=action)
+    if flagged:
+        row, reasons = flagged[0]
+        logger.warning(f"[ANOMALY] {len(flagged)} of {len(rows)} readings {action}, e.g. "
+                       f"{row.get('device_id') or DEFAULT_DEVICE} at {row['timestamp']}: {', '.join(reasons)}")
+        if mode == "quarantine":
+            quarantine(flagged)
+    return kept, flagged
+
+
+def quarantine(flagged):
+    """Append (row, reasons) pairs to the quarantine CSV."""
+    os.makedirs(os.path.dirname(QUARANTINE_FILE), exist_ok=True)
+    fields = ["timestamp", "device_id", *METRICS, "reasons"]
+    with open(QUARANTINE_FILE, "a", newline="") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            w = csv.DictWriter(f, fieldnames=fields, extrasaction="ignore")
+            if f.tell() == 0:
+                w.writeheader()
+            for row, reasons in flagged:
+                w.writerow({**row, "device_id": row.get("device_id") or DEFAULT_DEVICE, "reasons": " ".join(reasons)})
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def summary(device=None):
+    """Per device and metric: anomaly counts, the model and the last anomaly."""
+    if not os.path.exists(ANOMALY_STATE_FILE):
+        return {}
+    with _state() as table:
+        slots = np.array(table[table["device"] != b""])  # a consistent copy
+    out = {}
+    for slot in slots:
+        d = slot["device"].decode()
+        if device is not None and d != device:
+            continue
+        out[d] = {}
+        for m, st in zip(METRICS, slot["metrics"]):
+            if not _seen(st) and not st["counts"].any():
+                continue  # never reported this metric
+            kind = int(st["anomaly_kind"])
+            out[d][m] = {
+                "counts": dict(zip(KINDS, st["counts"].tolist())),
+                "mean": None if math.isnan(st["mean"]) else round(float(st["mean"]), 3),
+                "std": round(math.sqrt(st["var"]), 3),
+                "readings": int(st["n"]),
+                "last_anomaly": None if kind < 0 else {"timestamp": format_ts(int(st["anomaly_t"])),
+                                                       "kind": KINDS[kind], "value": float(st["anomaly_value"])},
+            }
+    return out
+
+
+def reset(device=None):
+    with _state() as table:
+        for i in np.flatnonzero(table["device"] != b""):
+            if device is None or table["device"][i] == device.encode():
+                table["metrics"][i] = _EMPTY
+        table.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest anomaly detector state")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    for name, text in (("status", "print anomaly counts per device and metric"),
+                       ("reset", "forget the learned state (e.g. after replacing a sensor)")):
+        p = sub.add_parser(name, help=text)
+        p.add_argument("--device")
+    args = parser.parse_args()
+    if args.cmd == "reset":
+        reset(args.device)
+        print("anomaly state cleared")
+        sys.exit(0)
+    for d, per_device in sorted(summary(args.device).items()):
+        for m, s in sorted(per_device.items()):
+            counts = " ".join(f"{k}={v}" for k, v in s["counts"].items())
+            print(f"{d:<16} {m:<10} mean={s['mean']} std={s['std']} {counts}")
@@ -0,0 +1,341 @@
+# compaction.py
+# Moves old readings out of the hot tier into compressed monthly archives and
+# enforces the retention policy, so disk and page cache use stay bounded.
+#
+#   ARCHIVE_AFTER_DAYS  segments (and legacy CSV rows) older than this many
+#                       days, counted from UTC midnight, are merged into
+#                       archive/YYYY-MM.gea (default 0: off, keep everything
+#                       hot; check what a value would move with `run --dry-run`)
+#   RETENTION_DAYS      rows older than this are dropped, and archives of
+#                       months, rollup buckets and daily stats that ended
+#                       before it are deleted (default 0: keep forever)
+#   ARCHIVE_CODEC       zstd (needs the zstandard module) or zlib
+#   COMPACT_INTERVAL    seconds between runs in the ingest writer (default 3600; 0 disables)
+#
+# The ingest writer runs this on a timer. Without it (INGEST_WRITER=direct),
+# run it from cron:
+#   python compaction.py run [--dry-run]
+#   python compaction.py status
+#
+# With STORAGE_BACKEND=sqlite there are no files to archive; a pass only
+# deletes readings older than RETENTION_DAYS from the database (and the daily
+# stats, which stay in files).
+#
+# Legacy CSV logs are streamed in CHUNK_BYTES pieces. Rows with an old
+# timestamp but values that don't parse stay in the hot file and are counted
+# as csv_rows_unparsed, so nothing is dropped that the archive couldn't hold.
+#
+# Order of operations keeps every row readable throughout: the new archive
+# is written and renamed into place first, then the hot copy is removed while
+# its lock is held. A reader or a crash in between sees a row twice (deduped
+# by storage.read_range and by the next compaction), never zero times.
+import argparse
+import fcntl
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+import csv_index
+import daily_stats
+import latest_store
+import metrics
+import rollups
+import storage
+from log_cleaner import chunk_ranges, read_header
+from settings import LOG_DIR, STORAGE_BACKEND
+
+logger = logging.getLogger("dashboard")
+
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", 0))
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", 0))
+ARCHIVE_CODEC = os.getenv("ARCHIVE_CODEC") or storage.default_codec()
+COMPACT_INTERVAL = float(os.getenv("COMPACT_INTERVAL", 3600))
+LOCK_PATH = os.path.join(LOG_DIR, "compaction.lock")
+CHUNK_BYTES = 16 * 1024 * 1024
+
+
+def cutoffs(now=None):
+    """(hot_cutoff, retention_cutoff): rows with t < hot_cutoff leave the hot
+    tier; of those, rows with t < retention_cutoff are dropped. None = off."""
+    now = int(now if now is not None else time.time())
+    midnight = now // 86400 * 86400
+    archive = midnight - ARCHIVE_AFTER_DAYS * 86400 if ARCHIVE_AFTER_DAYS > 0 else None
+    retention = midnight - RETENTION_DAYS * 86400 if RETENTION_DAYS > 0 else None
+    enabled = [c for c in (archive, retention) if c is not None]
+    return (max(enabled) if enabled else None), retention
+
+
+@contextmanager
+def _flocked(path, blocking=True):
+    """Hold an exclusive flock on `path`; yields False if it's taken and not `blocking`."""
+    with open(path, "ab") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield f
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _by_month(cols):
+    """Split columns into {month_start: columns}."""
+    out = {}
+    t = cols["t"]
+    while len(t):
+        lo, hi = storage.month_bounds(t.min())
+        mask = (t >= lo) & (t < hi)
+        out[lo] = {k: v[mask] for k, v in cols.items()}
+        cols = {k: v[~mask] for k, v in cols.items()}
+        t = cols["t"]
+    return out
+
+
+def _archive(cols, retention, device, stats, dry_run):
+    """Merge rows into their month archives; rows older than `retention` are dropped."""
+    if retention is not None:
+        keep = cols["t"] >= retention
+        stats["dropped_rows"] += int((~keep).sum())
+        cols = {k: v[keep] for k, v in cols.items()}
+    for month, part in _by_month(cols).items():
+        stats["archived_rows"] += len(part["t"])
+        if dry_run:
+            continue
+        path = storage.archive_path(month, device)
+        existing = storage.read_archive(path) if os.path.exists(path) else storage.empty_columns()
+        merged = storage.dedupe_columns(storage.concat_columns([existing, part]))
+        storage.write_archive(path, merged, ARCHIVE_CODEC)
+
+
+def _compact_segments(device, hot, retention, stats, dry_run):
+    old = [s for s in storage.list_segments(None, hot, device) if s[1] <= hot]
+    # one month at a time, so only that month's segments are locked
+    months = {}
+    for seg in old:
+        months.setdefault(storage.month_bounds(seg[0])[0], []).append(seg)
+    for segs in months.values():
+        with ExitStack() as stack:
+            for _, _, path in segs:
+                stack.enter_context(_flocked(os.path.join(path, storage.LOCK_FILE)))
+            cols = storage.concat_columns([storage.read_segment(path) for _, _, path in segs])
+            _archive(cols, retention, device, stats, dry_run)
+            if not dry_run:
+                for _, _, path in segs:
+                    storage.remove_segment(path)
+            stats["segments_removed"] += len(segs)
+
+
+def _compact_csv(path, hot, retention, device, stats, dry_run, chunk_bytes=CHUNK_BYTES):
+    # under the writers' flock, a chunk at a time: rows older than the cutoff
+    # go to the archive (a month is merged in once no later chunk has rows for
+    # it), the rest, and any row we can't parse, are streamed to a new file
+    # that replaces the old one; the Appender notices the new inode
+    with _flocked(path):
+        try:
+            header, fieldnames = read_header(path)
+        except ValueError as e:
+            logger.warning(f"[compaction] skipping {path}: {e}")
+            return
+        tmp = path + ".compact"
+        out = None if dry_run else open(tmp, "wb")
+        moved = kept = unparsed = 0
+        pending = {}  # month -> [columns] not archived yet
+        try:
+            if out is not None:
+                out.write(header)
+            with open(path, "rb") as src:
+                for lo, hi in chunk_ranges(path, chunk_bytes, offset=len(header)):
+                    src.seek(lo)
+                    keep, old = [], []
+                    for line in src.read(hi - lo).decode("utf-8", "replace").splitlines(keepends=True):
+                        try:
+                            t = storage.to_epoch(line.split(",", 1)[0])
+                        except (ValueError, TypeError):
+                            keep.append(line)
+                            continue
+                        (old if t < hot else keep).append(line)
+                    touched = {}
+                    if old:
+                        junk = []
+                        touched = _by_month(storage.csv_lines_to_columns(old, fieldnames, junk=junk))
+                        for month, part in touched.items():
+                            pending.setdefault(month, []).append(part)
+                        keep += junk
+                        unparsed += len(junk)
+                        moved += len(old) - len(junk)
+                    # months this chunk didn't touch are done (rows are mostly in time order)
+                    for month in [m for m in pending if m not in touched]:
+                        _archive(storage.concat_columns(pending.pop(month)), retention, device, stats, dry_run)
+                    kept += sum(1 for line in keep if line.strip())
+                    if out is not None:
+                        out.write("".join(keep).encode("utf-8"))
+            for month in list(pending):
+                _archive(storage.concat_columns(pending.pop(month)), retention, device, stats, dry_run)
+            if unparsed:
+                logger.warning(f"[compaction] {path}: {unparsed} old rows don't parse; left in place")
+            stats["csv_rows_unparsed"] += unparsed
+            stats["csv_rows_moved"] += moved
+            if not moved or dry_run:
+                return
+            out.flush()
+            os.fsync(out.fileno())
+            out.close()
+            out = None
+            if not kept and path != storage.csv_log_file(device):
+                os.unlink(path)
+            else:
+                os.replace(tmp, path)
+            try:
+                os.unlink(csv_index.index_path(path))
+            except FileNotFoundError:
+                pass
+        finally:
+            if out is not None:
+                out.close()
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+
+def _prune_archives(device, retention, stats, dry_run):
+    for lo, hi, path in storage.list_archives(None, retention, device):
+        if hi <= retention:
+            stats["archives_removed"] += 1
+            if not dry_run:
+                os.unlink(path)
+
+
+def _compact_sqlite(retention, dry_run):
+    import sqlite_store
+
+    db = sqlite_store.connect()
+    try:
+        if dry_run:
+            counts = {d: db.execute("SELECT count(*) FROM readings WHERE device = ? AND t < ?", (d, retention)).fetchone()[0]
+                      for d in sqlite_store.devices(db)}
+        else:
+            counts = sqlite_store.prune(db, retention)
+    finally:
+        db.close()
+    summary = {}
+    for device in dict.fromkeys([*counts, *storage.list_devices()]):  # incl. devices that were emptied
+        stats = {"dropped_rows": counts.get(device, 0),
+                 "stats_days_removed": daily_stats.prune(retention, device) if not dry_run else 0}
+        if any(stats.values()):
+            summary[device] = stats
+            if not dry_run:
+                metrics.inc("garden_compaction_rows_total", stats["dropped_rows"], action="dropped")
+                latest_store.bump(device)  # history changed: new ETag
+            logger.info(f"[compaction] {device}: {stats}{' (dry run)' if dry_run else ''}")
+    return summary
+
+
+def compact(now=None, dry_run=False):
+    """One compaction pass over every device. Returns {device: stats}, or
+    None if another pass is already running."""
+    hot, retention = cutoffs(now)
+    if hot is None:
+        return {}
+    os.makedirs(LOG_DIR, exist_ok=True)
+    with _flocked(LOCK_PATH, blocking=False) as locked:
+        if not locked:
+            return None
+        if STORAGE_BACKEND == "sqlite":
+            return _compact_sqlite(retention, dry_run) if retention is not None else {}
+        summary = {}
+        for device in storage.list_devices():
+            stats = dict.fromkeys(("archived_rows", "dropped_rows", "segments_removed", "csv_rows_moved",
+                                   "csv_rows_unparsed", "archives_removed", "rollup_buckets_removed",
+                                   "stats_days_removed"), 0)
+            _compact_segments(device, hot, retention, stats, dry_run)
+            for path in storage.legacy_csv_files(None, hot, device):
+                _compact_csv(path, hot, retention, device, stats, dry_run)
+            if retention is not None:
+                _prune_archives(device, retention, stats, dry_run)
+                if not dry_run:
+                    stats["rollup_buckets_removed"] = rollups.prune(retention, device)
+                    stats["stats_days_removed"] = daily_stats.prune(retention, device)
+            if any(stats.values()):
+                summary[device] = stats
+                if not dry_run:
+                    metrics.inc("garden_compaction_rows_total", stats["archived_rows"], action="archived")
+                    metrics.inc("garden_compaction_rows_total", stats["dropped_rows"], action="dropped")
+                    if any(stats[k] for k in ("dropped_rows", "archives_removed", "rollup_buckets_removed",
+                                              "stats_days_removed")):
+                        latest_store.bump(device)  # history changed: new ETag
+                logger.info(f"[compaction] {device}: {stats}{' (dry run)' if dry_run else ''}")
+        return summary
+
+
+def start_scheduler(interval=COMPACT_INTERVAL, delay=60):
+    """Run `compact` every `interval` seconds in a daemon thread (first run after `delay`)."""
+    if interval <= 0 or cutoffs()[0] is None:
+        return None
+
+    def run():
+        time.sleep(delay)
+        while True:
+            try:
+                compact()
+            except Exception:
+                logger.exception("[compaction] pass failed")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name="compaction", daemon=True)
+    thread.start()
+    return thread
+
+
+def _size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, n)) for root, _, files in os.walk(path) for n in files)
+
+
+def _tier_sizes(device):
+    size = lambda paths: sum(_size(p) for p in paths)
+    segments = storage.list_segments(device=device)
+    archives = storage.list_archives(device=device)
+    csvs = storage.legacy_csv_files(device=device)
+    return {
+        "segments": (len(segments), size(p for _, _, p in segments)),
+        "csv": (len(csvs), size(csvs)),
+        "archives": (len(archives), size(p for _, _, p in archives)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive old readings and apply the retention policy")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("run", help="one compaction pass")
+    run.add_argument("--dry-run", action="store_true", help="report what would move without changing anything")
+    sub.add_parser("status", help="files and bytes per tier")
+    args = parser.parse_args()
+
+    if args.command == "status":
+        hot, retention = cutoffs()
+        fmt = lambda t: storage.format_ts(t) if t is not None else "off"
+        print(f"archive before {fmt(hot)}, drop before {fmt(retention)}, codec {ARCHIVE_CODEC}")
+        for device in storage.list_devices():
+            tiers = _tier_sizes(device)
+            print(device + ": " + ", ".join(f"{k} {n} files / {b / 1e6:.1f} MB" for k, (n, b) in tiers.items()))
+        return 0
+
+    summary = compact(dry_run=args.dry_run)
+    if summary is None:
+        print("another compaction is running")
+        return 1
+    if not summary:
+        print("nothing to do")
+    for device, stats in summary.items():
+        print(f"{device}: " + ", ".join(f"{k}={v}" for k, v in stats.items()))
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    sys.exit(main())
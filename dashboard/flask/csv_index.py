@@ -0,0 +1,132 @@
+# csv_index.py
+# Sparse timestamp index for raw_sensorlog CSV files.
+#
+# The sidecar "<log>.idx" holds one fixed-size record per closed block of the
+# CSV: (start offset, end offset, min epoch, max epoch). Blocks close once they
+# pass BLOCK_BYTES, so the index grows by a few bytes per ~64 KiB of log. A range
+# read only parses the blocks whose [min, max] overlaps the window, plus the
+# short unindexed tail. Min/max per block keeps this correct even when rows
+# were appended out of order.
+import fcntl
+import logging
+import os
+import struct
+
+logger = logging.getLogger(__name__)
+
+BLOCK_BYTES = 64 * 1024
+RECORD = struct.Struct("<qqqq")  # start, end, min_t, max_t
+
+
+def index_path(path):
+    return path + ".idx"
+
+
+def load(path):
+    """Return the list of (start, end, min_t, max_t) blocks for a CSV."""
+    try:
+        with open(index_path(path), "rb") as f:
+            raw = f.read()
+    except FileNotFoundError:
+        return []
+    usable = len(raw) - len(raw) % RECORD.size
+    return [RECORD.unpack_from(raw, i) for i in range(0, usable, RECORD.size)]
+
+
+def _header_end(f):
+    f.seek(0)
+    return len(f.readline())
+
+
+def refresh(path, to_epoch):
+    """Close any full blocks past the end of the index and return all blocks.
+
+    Cheap when nothing changed: one stat plus reading the index file. If the
+    CSV shrank (rotated or trimmed), the index is rebuilt from scratch.
+    """
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return []
+
+    blocks = load(path)
+    indexed = blocks[-1][1] if blocks else 0
+    if indexed <= size and size - indexed < BLOCK_BYTES:
+        return blocks
+
+    # another worker may be extending the index at the same time
+    with open(index_path(path), "ab") as idx:
+        fcntl.flock(idx, fcntl.LOCK_EX)
+        try:
+            blocks = load(path)
+            if blocks and blocks[-1][1] > size:
+                logger.info(f"[index] {path} shrank, rebuilding index")
+                idx.truncate(0)
+                blocks = []
+            new = _scan(path, blocks, size, to_epoch)
+            if new:
+                idx.write(b"".join(RECORD.pack(*b) for b in new))
+                blocks.extend(new)
+        finally:
+            fcntl.flock(idx, fcntl.LOCK_UN)
+    return blocks
+
+
+def _scan(path, blocks, size, to_epoch):
+    new = []
+    with open(path, "rb") as f:
+        pos = blocks[-1][1] if blocks else _header_end(f)
+        if size - pos < BLOCK_BYTES:
+            return new
+
+        f.seek(pos)
+        start, lo, hi = pos, None, None
+        for line in f:
+            pos += len(line)
+            if not line.endswith(b"\n"):
+                break  # partial write in progress; leave it in the tail
+            try:
+                t = to_epoch(line.split(b",", 1)[0].decode("utf-8-sig"))
+            except (ValueError, UnicodeDecodeError):
+                t = None  # repeated header / junk row
+            if t is not None:
+                lo = t if lo is None else min(lo, t)
+                hi = t if hi is None else max(hi, t)
+            if pos - start >= BLOCK_BYTES:
+                # a block with nothing parseable gets min > max and never matches
+                new.append((start, pos, lo, hi) if lo is not None else (start, pos, 1, 0))
+                start, lo, hi = pos, None, None
+    return new
+
+
+def byte_ranges(path, to_epoch, start=None, end=None):
+    """Byte ranges of `path` that may hold rows with start <= t < end.
+
+    Adjacent matching blocks are merged; the unindexed tail is always included.
+    """
+    blocks = refresh(path, to_epoch)
+    size = os.path.getsize(path)
+    if blocks:
+        tail = blocks[-1][1]
+    else:
+        with open(path, "rb") as f:
+            tail = _header_end(f)
+
+    ranges = []
+    for b_start, b_end, lo, hi in blocks:
+        if lo > hi:
+            continue
+        if start is not None and hi < start:
+            continue
+        if end is not None and lo >= end:
+            continue
+        if ranges and ranges[-1][1] == b_start:
+            ranges[-1][1] = b_end
+        else:
+            ranges.append([b_start, b_end])
+    if tail < size:
+        if ranges and ranges[-1][1] == tail:
+            ranges[-1][1] = size
+        else:
+            ranges.append([tail, size])
+    return [tuple(r) for r in ranges]
@@ -0,0 +1,463 @@
+# daily_stats.py
+# Per-day accumulators behind /api/stats: vapor-pressure deficit, daily light
+# integral, growing-degree days and rolling means / standard deviations.
+#
+# One file of fixed-size records per device, sorted by local calendar day:
+#   logs/stats/daily.bin -> (day, n, first_t, last_t, light_s, dli, lux_last,
+#                            <metric>_sum/_sumsq/_min/_max ..., vpd_* ...)
+# Ingest folds new readings into the matching day in place (normally the last
+# record), like rollups.py, so a season's GDD or a week of rolling stats reads
+# one record per day instead of every reading. Sums of squares make the
+# standard deviation of any run of days a sum over their records.
+#
+# DLI integrates PPFD (lux / STATS_LUX_PER_PPFD, ~54 for sunlight) over time
+# with the trapezoid rule; gaps longer than STATS_LIGHT_MAX_GAP seconds (a
+# sleeping or offline sensor) are not counted, and `light_s` says how many
+# seconds were covered. A reading that arrives older than the last one folded
+# in still counts toward the other sums but adds no light; `python
+# daily_stats.py rebuild` recomputes everything from storage.
+#
+# Like rollups.py, the records only cover the days from a `covered_from` date
+# stored next to them: the first fold writes 0001-01-01 on an empty store, or
+# the day after its oldest reading's day when older ones were already stored,
+# and rebuild resets it to 0001-01-01. Days before it are aggregated from raw
+# rows at read time until the next rebuild. Retention (compaction.py) prunes
+# the days that ended before its cutoff.
+import fcntl
+import logging
+import math
+import os
+import sys
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+import storage
+from settings import STATS_DIR
+from storage import DEFAULT_DEVICE, METRICS
+
+logger = logging.getLogger(__name__)
+
+LUX_PER_PPFD = float(os.getenv("STATS_LUX_PER_PPFD", 54))  # lux per µmol/m²/s; ~70-80 for white LED
+LIGHT_MAX_GAP = int(os.getenv("STATS_LIGHT_MAX_GAP", 900))
+GDD_BASE_F = 50.0
+GDD_CAP_F = 86.0
+
+_fields = [("day", "<i8"), ("n", "<i8"), ("first_t", "<i8"), ("last_t", "<i8"),
+           ("light_s", "<f8"), ("dli", "<f8"), ("lux_last", "<f4")]
+for _m in (*METRICS, "vpd"):
+    _fields += [(f"{_m}_sum", "<f8"), (f"{_m}_sumsq", "<f8"), (f"{_m}_min", "<f4"), (f"{_m}_max", "<f4")]
+RECORD = np.dtype(_fields)
+
+_EPOCH_DAY = date(1970, 1, 1)
+_ALL_DAYS = (date.min - _EPOCH_DAY).days  # covered_from when the records hold everything
+
+
+def stats_path(device=DEFAULT_DEVICE):
+    root = STATS_DIR if device == DEFAULT_DEVICE else os.path.join(storage.device_root(device), "stats")
+    return os.path.join(root, "daily.bin")
+
+
+def coverage_path(device=DEFAULT_DEVICE):
+    return os.path.join(os.path.dirname(stats_path(device)), "covered_from")
+
+
+def covered_from(device=DEFAULT_DEVICE):
+    """First day number whose record holds every stored reading of that day,
+    or None without a marker (every day is then read from raw rows)."""
+    try:
+        with open(coverage_path(device)) as f:
+            return day_number(date.fromisoformat(f.read().strip()))
+    except (OSError, ValueError):
+        return None
+
+
+def _mark_covered(device, day=None):
+    path = coverage_path(device)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        f.write(day_date(_ALL_DAYS if day is None else day).isoformat() + "\n")
+    os.replace(path + ".tmp", path)
+
+
+@contextmanager
+def _locked(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+# -- kernels -----------------------------------------------------------------
+
+def vpd_kpa(temp_f, humidity):
+    """Air vapor-pressure deficit in kPa (Tetens saturation pressure)."""
+    c = (np.asarray(temp_f, dtype=np.float64) - 32) * 5 / 9
+    svp = 0.6108 * np.exp(17.27 * c / (c + 237.3))
+    return svp * (1 - np.clip(np.asarray(humidity, dtype=np.float64), 0, 100) / 100)
+
+
+def ppfd(lux):
+    """Approximate photosynthetic photon flux density (µmol/m²/s) from lux."""
+    return np.asarray(lux, dtype=np.float64) / LUX_PER_PPFD
+
+
+def light_steps(t, lux, prev_t=None, prev_lux=None):
+    """Per reading, the light (mol/m²) and seconds since the reading before
+    it (trapezoid rule; 0 across gaps over LIGHT_MAX_GAP or out of order)."""
+    t = np.asarray(t, dtype=np.int64)
+    p = ppfd(lux)
+    if prev_t is None:
+        dt = np.r_[0, np.diff(t)]
+        p0 = np.r_[p[:1], p[:-1]]
+    else:
+        dt = np.diff(t, prepend=prev_t)
+        p0 = np.r_[ppfd(prev_lux), p[:-1]]
+    dt = np.where((dt > 0) & (dt <= LIGHT_MAX_GAP), dt, 0)
+    return (p0 + p) / 2 * dt / 1e6, dt.astype(np.float64)
+
+
+def gdd(tmin_f, tmax_f, base=GDD_BASE_F, cap=GDD_CAP_F):
+    """Growing-degree days per day from daily min/max °F (the max clipped to
+    `cap`, the min raised to `base`; cap=None for no upper threshold)."""
+    tmax = np.asarray(tmax_f, dtype=np.float64)
+    tmin = np.asarray(tmin_f, dtype=np.float64)
+    if cap is not None:
+        tmax = np.minimum(tmax, cap)
+        tmin = np.minimum(tmin, cap)
+    return np.maximum((np.maximum(tmax, base) + np.maximum(tmin, base)) / 2 - base, 0)
+
+
+def local_days(t):
+    """Local calendar day number (days since 1970-01-01) of each epoch."""
+    t = np.asarray(t, dtype=np.int64)
+    if not len(t):
+        return t
+    # UTC offsets only change on the hour: look each distinct hour up once
+    hours, inverse = np.unique(t // 3600, return_inverse=True)
+    offsets = np.array([datetime.fromtimestamp(int(h) * 3600).astimezone().utcoffset().total_seconds()
+                        for h in hours], dtype=np.int64)
+    return (t + offsets[inverse]) // 86400
+
+
+def day_number(d):
+    return (d - _EPOCH_DAY).days
+
+
+def day_date(n):
+    return _EPOCH_DAY + timedelta(days=int(n))
+
+
+# -- accumulators ------------------------------------------------------------
+
+def aggregate(cols, prev_t=None, prev_lux=None):
+    """Collapse time-sorted columns into one record per local day. `prev_t`
+    and `prev_lux` are the reading before the first one, if known."""
+    t = cols["t"]
+    if len(t) == 0:
+        return np.zeros(0, dtype=RECORD)
+    days = local_days(t)
+    starts = np.flatnonzero(np.r_[True, days[1:] != days[:-1]])
+    ends = np.r_[starts[1:], len(t)] - 1
+
+    out = np.zeros(len(starts), dtype=RECORD)
+    out["day"] = days[starts]
+    out["n"] = ends - starts + 1
+    out["first_t"] = t[starts]
+    out["last_t"] = t[ends]
+    mol, seconds = light_steps(t, cols["lux"], prev_t, prev_lux)
+    out["dli"] = np.add.reduceat(mol, starts)
+    out["light_s"] = np.add.reduceat(seconds, starts)
+    out["lux_last"] = cols["lux"][ends]
+    values = {m: np.asarray(cols[m], dtype=np.float64) for m in METRICS}
+    values["vpd"] = vpd_kpa(values["temp_f"], values["humidity"])
+    for m, v in values.items():
+        out[f"{m}_sum"] = np.add.reduceat(v, starts)
+        out[f"{m}_sumsq"] = np.add.reduceat(v * v, starts)
+        out[f"{m}_min"] = np.minimum.reduceat(v, starts)
+        out[f"{m}_max"] = np.maximum.reduceat(v, starts)
+    return out
+
+
+def merge(a, b):
+    """Combine two aligned record arrays covering the same days."""
+    out = a.copy()
+    out["n"] = a["n"] + b["n"]
+    out["first_t"] = np.minimum(a["first_t"], b["first_t"])
+    newer = b["last_t"] >= a["last_t"]
+    out["last_t"] = np.where(newer, b["last_t"], a["last_t"])
+    out["lux_last"] = np.where(newer, b["lux_last"], a["lux_last"])
+    for f in ("dli", "light_s"):
+        out[f] = a[f] + b[f]
+    for m in (*METRICS, "vpd"):
+        out[f"{m}_sum"] = a[f"{m}_sum"] + b[f"{m}_sum"]
+        out[f"{m}_sumsq"] = a[f"{m}_sumsq"] + b[f"{m}_sumsq"]
+        out[f"{m}_min"] = np.minimum(a[f"{m}_min"], b[f"{m}_min"])
+        out[f"{m}_max"] = np.maximum(a[f"{m}_max"], b[f"{m}_max"])
+    return out
+
+
+def _count(path):
+    return os.path.getsize(path) // RECORD.itemsize if os.path.exists(path) else 0
+
+
+def _apply(cols, device=DEFAULT_DEVICE):
+    path = stats_path(device)
+    with _locked(path):
+        n = _count(path)
+        existing = np.memmap(path, dtype=RECORD, mode="r+", shape=(n,)) if n else None
+        prev_t = prev_lux = None
+        if n and existing["last_t"][-1] < cols["t"][0]:
+            prev_t, prev_lux = int(existing["last_t"][-1]), float(existing["lux_last"][-1])
+        agg = aggregate(cols, prev_t, prev_lux)
+        if n:
+            last = existing["day"][-1]
+            old, agg = agg[agg["day"] <= last], agg[agg["day"] > last]
+            if len(old):
+                idx = np.searchsorted(existing["day"], old["day"])
+                found = existing["day"][idx] == old["day"]
+                if found.any():
+                    existing[idx[found]] = merge(existing[idx[found]], old[found])
+                    existing.flush()
+                if not found.all():
+                    # backfilled day that doesn't exist yet: rare, rewrite the file
+                    combined = np.concatenate([np.asarray(existing), old[~found], agg])
+                    del existing
+                    combined.sort(order="day", kind="stable")
+                    combined.tofile(path + ".tmp")
+                    os.replace(path + ".tmp", path)
+                    return
+            del existing
+        if len(agg):
+            with open(path, "ab") as f:
+                f.write(agg.tobytes())
+
+
+def update(rows):
+    """Fold one reading (dict) or a list of readings into the day records."""
+    if isinstance(rows, dict):
+        rows = [rows]
+    for device, group in storage.group_by_device(rows).items():
+        cols = {"t": np.array([storage.to_epoch(r["timestamp"]) for r in group], dtype=np.int64)}
+        for m in METRICS:
+            cols[m] = np.array([float(r.get(m, 0) or 0) for r in group], dtype=np.float64)
+        order = np.argsort(cols["t"], kind="stable")
+        cols = {k: v[order] for k, v in cols.items()}
+        if not os.path.exists(stats_path(device)) and covered_from(device) is None:
+            # first fold for this device: days with older stored readings aren't covered
+            if not len(storage.read_range(None, int(cols["t"][0]), device)["t"]):
+                _mark_covered(device)
+            else:
+                start = int(local_days(cols["t"][:1])[0]) + 1
+                _mark_covered(device, start)
+                logger.warning(f"[daily_stats] {device}: days before {day_date(start)} aren't in the stats; "
+                               "reading them from raw rows until `python daily_stats.py rebuild`")
+        _apply(cols, device)
+
+
+def read_days(first=None, last=None, device=DEFAULT_DEVICE):
+    """Day records with first <= day <= last (day numbers, None = open);
+    days before covered_from are aggregated from raw rows."""
+    start = covered_from(device)
+    if start is None:
+        return _raw_days(first, last, device)
+    if start == _ALL_DAYS or (first is not None and first >= start):
+        return _read_records(first, last, device)
+    raw = _raw_days(first, start - 1 if last is None else min(last, start - 1), device)
+    if last is not None and last < start:
+        return raw
+    return np.concatenate([raw, _read_records(start, last, device)])
+
+
+def _local_midnight(n):
+    return int(datetime.combine(day_date(n), datetime.min.time()).astimezone().timestamp())
+
+
+def _raw_days(first, last, device):
+    lo = _local_midnight(first) if first is not None else None
+    hi = _local_midnight(last + 1) if last is not None else None
+    # from LIGHT_MAX_GAP earlier, so the first day gets the light since the reading before it
+    cols = storage.read_range(lo - LIGHT_MAX_GAP if lo is not None else None, hi, device)
+    recs = aggregate({k: np.asarray(v) for k, v in cols.items()})
+    return recs[recs["day"] >= first] if first is not None else recs
+
+
+def _read_records(first, last, device):
+    path = stats_path(device)
+    n = _count(path)
+    if not n:
+        return np.zeros(0, dtype=RECORD)
+    mm = np.memmap(path, dtype=RECORD, mode="r", shape=(n,))
+    day = mm["day"]
+    lo = int(np.searchsorted(day, first)) if first is not None else 0
+    hi = int(np.searchsorted(day, last, "right")) if last is not None else n
+    return np.array(mm[lo:hi])
+
+
+# -- summaries ---------------------------------------------------------------
+
+def _mean_std(total, sumsq, n):
+    n = np.maximum(n, 1)
+    mean = total / n
+    return mean, np.sqrt(np.maximum(sumsq / n - mean * mean, 0))
+
+
+def rolling(recs, window):
+    """Mean and standard deviation of every metric over the readings of the
+    trailing `window` calendar days ending at each record (days without
+    readings count as empty)."""
+    days = recs["day"]
+    # records whose day is within the window: [lo, i]
+    lo = np.searchsorted(days, days - window + 1)
+    hi = np.arange(1, len(recs) + 1)
+    csum = lambda v: np.r_[0, np.cumsum(v)]
+    n = csum(recs["n"])
+    out = {"n": n[hi] - n[lo]}
+    for m in (*METRICS, "vpd"):
+        s, sq = csum(recs[f"{m}_sum"]), csum(recs[f"{m}_sumsq"])
+        out[m] = _mean_std(s[hi] - s[lo], sq[hi] - sq[lo], out["n"])
+    return out
+
+
+def summarize(recs, base=GDD_BASE_F, cap=GDD_CAP_F, window=7, since=None):
+    """One dict per day record; the first `window - 1` records (and any before
+    day number `since`) only feed the rolling stats."""
+    mean_std = {m: _mean_std(recs[f"{m}_sum"], recs[f"{m}_sumsq"], recs["n"]) for m in (*METRICS, "vpd")}
+    roll = rolling(recs, window)
+    daily_gdd = gdd(recs["temp_f_min"], recs["temp_f_max"], base, cap)
+    out = []
+    for i in range(len(recs)):
+        if since is not None and recs["day"][i] < since:
+            continue
+        row = {
+            "date": day_date(recs["day"][i]).isoformat(),
+            "n": int(recs["n"][i]),
+            "dli": round(float(recs["dli"][i]), 3),
+            "light_hours": round(float(recs["light_s"][i]) / 3600, 2),
+            "gdd": round(float(daily_gdd[i]), 2),
+        }
+        for m in ("vpd", *METRICS):
+            row[m] = {
+                "mean": round(float(mean_std[m][0][i]), 3),
+                "std": round(float(mean_std[m][1][i]), 3),
+                "min": round(float(recs[f"{m}_min"][i]), 3),
+                "max": round(float(recs[f"{m}_max"][i]), 3),
+                "rolling_mean": round(float(roll[m][0][i]), 3),
+                "rolling_std": round(float(roll[m][1][i]), 3),
+            }
+        out.append(row)
+    return out
+
+
+def season_gdd(first, last, base=GDD_BASE_F, cap=GDD_CAP_F, device=DEFAULT_DEVICE):
+    """(total GDD, days with readings) for day numbers first..last."""
+    recs = read_days(first, last, device)
+    return float(gdd(recs["temp_f_min"], recs["temp_f_max"], base, cap).sum()), len(recs)
+
+
+# -- /api/stats --------------------------------------------------------------
+
+STATS_MAX_DAYS = 366
+
+
+def parse_query(args, today=None):
+    """/api/stats query args (any mapping with .get) -> the validated query
+    for `query`. Raises ValueError."""
+    today = today or date.today()
+    device = args.get("device", DEFAULT_DEVICE)
+    if not storage.valid_device(device):
+        raise ValueError("device must be 1-32 letters, digits, '-' or '_'")
+    ymd = lambda name, default: datetime.strptime(args.get(name), "%Y-%m-%d").date() if args.get(name) else default
+    try:
+        last = ymd("to", today)
+        season = ymd("season", date(today.year, 1, 1))
+        days = int(args.get("days", 7))
+        first = ymd("from", last - timedelta(days=days - 1))
+    except ValueError:
+        raise ValueError("from, to and season must be YYYY-MM-DD; days an integer")
+    if not 1 <= (last - first).days + 1 <= STATS_MAX_DAYS:
+        raise ValueError(f"the range must cover 1 to {STATS_MAX_DAYS} days")
+    try:
+        window = int(args.get("window", 7))
+    except ValueError:
+        raise ValueError("window must be 1-90 days")
+    if not 1 <= window <= 90:
+        raise ValueError("window must be 1-90 days")
+    try:
+        base = float(args.get("base", GDD_BASE_F))
+        if not math.isfinite(base):
+            raise ValueError
+    except ValueError:
+        raise ValueError("base must be a number")
+    cap = str(args.get("cap", GDD_CAP_F)).strip().lower()
+    try:
+        cap = None if cap == "none" else float(cap)
+        if cap is not None and not math.isfinite(cap):
+            raise ValueError
+    except ValueError:
+        raise ValueError("cap must be a number or 'none'")
+    return {"device": device, "first": first, "last": last, "season": season, "today": today,
+            "window": window, "base": base, "cap": cap}
+
+
+def query(q):
+    """The /api/stats data for a parse_query query: one record per day read."""
+    device, window, base, cap = q["device"], q["window"], q["base"], q["cap"]
+
+    def days(first_n, last_n):
+        # the days before `first_n` only feed the rolling window
+        recs = read_days(first_n - window + 1, last_n, device)
+        return summarize(recs, base=base, cap=cap, window=window, since=first_n)
+
+    today_n = day_number(q["today"])
+    total, counted = season_gdd(day_number(q["season"]), today_n, base=base, cap=cap, device=device)
+    return {
+        "device": device,
+        "today": next(iter(days(today_n, today_n)), None),
+        "season": {"since": q["season"].isoformat(), "gdd": round(total, 1), "days": counted, "base": base, "cap": cap},
+        "window": window,
+        "days": days(day_number(q["first"]), day_number(q["last"])),
+    }
+
+
+def prune(before, device=DEFAULT_DEVICE):
+    """Drop the day records of local days that ended at or before `before`
+    (retention). Returns the number of days removed."""
+    path = stats_path(device)
+    if not os.path.exists(path):
+        return 0
+    with _locked(path):
+        recs = _read_records(None, None, device)
+        keep = recs["day"] >= local_days([before])[0]
+        if keep.all():
+            return 0
+        recs[keep].tofile(path + ".tmp")
+        os.replace(path + ".tmp", path)
+    return int((~keep).sum())
+
+
+def rebuild():
+    """Recompute the day records of every device from storage. Run it while ingest is stopped."""
+    total = 0
+    for device in storage.list_devices():
+        cols = storage.read_range(device=device)
+        order = np.argsort(cols["t"], kind="stable")
+        cols = {k: np.asarray(v)[order] for k, v in cols.items()}
+        path = stats_path(device)
+        with _locked(path):
+            aggregate(cols).tofile(path + ".tmp")
+            os.replace(path + ".tmp", path)
+        _mark_covered(device)
+        total += len(cols["t"])
+    return total
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["rebuild"]:
+        print("usage: python daily_stats.py rebuild")
+        sys.exit(1)
+    print(f"rebuilt daily stats from {rebuild()} readings")
@@ -1,15 +1,9 @@
-from flask_mqtt import Mqtt
 from flask import Flask, jsonify
-from datetime import datetime
 import os
 from dotenv import load_dotenv
 # custom imports
 from routes import routes
-from shared import load_config, save_config
-from ntfy_handler import send_ntfy_message
-from mqtt_handler import publish_mqtt
-from sensor_utils import validate_sensor_data, format_sensor_data
-from settings import CONFIG_FILE, LOG_DIR
+from settings import LOG_DIR
 from logging_config import setup_loggers
 
 # Load .env variables
@@ -34,7 +28,7 @@ app.config.update(
     MQTT_KEEPALIVE=60,
     MQTT_TLS_ENABLED=False
 )
-#mqtt = Mqtt(app)
+#mqtt = Mqtt(app)  # flask_mqtt is no longer imported; MQTT goes through mqtt_handler
 
 ## set global state
 latest_data = None
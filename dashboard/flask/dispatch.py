@@ -0,0 +1,145 @@
+# dispatch.py
+# Background delivery of side effects (MQTT, ntfy) off the request path.
+#
+# Each Dispatcher owns a bounded queue and one worker thread. Under gunicorn's
+# gevent worker, threading is monkey-patched, so the worker is a greenlet.
+# When the queue is full the overflow policy decides what to keep:
+#   "coalesce"     keep only the newest item per key (MQTT state: newest wins)
+#   "drop_oldest"  discard the oldest queued item
+#   "drop_newest"  discard the item being submitted
+# Failed deliveries are retried with exponential backoff, then dropped.
+# The async FastAPI server subclasses Dispatcher with an asyncio task as the
+# worker (dashboard/fastapi/aio_dispatch.py); the queue and policies are shared.
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import alerts
+import metrics
+from mqtt_handler import publish_mqtt
+from storage import DEFAULT_DEVICE
+
+logger = logging.getLogger("dashboard")
+
+POLICIES = ("coalesce", "drop_oldest", "drop_newest")
+
+
+class Dispatcher:
+    def __init__(self, name, handler, maxsize=100, policy="drop_oldest",
+                 retries=3, backoff=1.0, max_backoff=30.0):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown policy: {policy}")
+        self.name = name
+        self.handler = handler
+        self.maxsize = maxsize
+        self.policy = policy
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self._items = OrderedDict()
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._pid = None
+        self.dropped = 0
+        self.failed = 0
+        self.delivered = 0
+
+    def submit(self, item, key=None):
+        """Queue `item` for delivery. Returns False if it was dropped."""
+        with self._cond:
+            self._ensure_worker()
+            if key is None or self.policy != "coalesce":
+                self._seq += 1
+                key = self._seq
+            elif key in self._items:
+                # replace in place; keeps its position in the queue
+                self._items[key] = item
+                self._wake()
+                return True
+
+            if len(self._items) >= self.maxsize:
+                self.dropped += 1
+                metrics.inc("garden_dispatch_total", queue=self.name, outcome="dropped")
+                if self.policy == "drop_newest":
+                    logger.warning(f"[dispatch:{self.name}] queue full, dropping new item")
+                    return False
+                self._items.popitem(last=False)
+                logger.warning(f"[dispatch:{self.name}] queue full, dropped oldest item")
+
+            self._items[key] = item
+            self._wake()
+            return True
+
+    def _wake(self):
+        self._cond.notify()
+
+    def pending(self):
+        with self._cond:
+            return len(self._items)
+
+    def _ensure_worker(self):
+        # threads don't survive fork, so (re)start lazily in each worker process
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name=f"dispatch-{self.name}", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._items:
+                    self._cond.wait()
+                _, item = self._items.popitem(last=False)
+            self._deliver(item)
+
+    def _deliver(self, item):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                self.handler(item)
+                return self._delivered()
+            except Exception as e:
+                if not self._retry(attempt, e, delay):
+                    return
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+
+    def _delivered(self):
+        self.delivered += 1
+        metrics.inc("garden_dispatch_total", queue=self.name, outcome="delivered")
+
+    def _retry(self, attempt, error, delay):
+        """Count a failed attempt; False once the item is given up."""
+        if attempt == self.retries:
+            self.failed += 1
+            metrics.inc("garden_dispatch_total", queue=self.name, outcome="failed")
+            logger.error(f"[dispatch:{self.name}] giving up after {attempt + 1} attempts: {error}")
+            return False
+        logger.warning(f"[dispatch:{self.name}] attempt {attempt + 1} failed: {error}; retrying in {delay:.1f}s")
+        metrics.inc("garden_dispatch_total", queue=self.name, outcome="retried")
+        return True
+
+
+QUEUE_SIZE = int(os.getenv("DISPATCH_QUEUE_SIZE", 100))
+RETRIES = int(os.getenv("DISPATCH_RETRIES", 3))
+
+# MQTT state is retained on the broker, so only the newest reading matters
+mqtt_dispatcher = Dispatcher("mqtt", publish_mqtt, maxsize=QUEUE_SIZE, policy="coalesce", retries=RETRIES)
+# ntfy only hears about threshold transitions, coalesced into digests (see alerts.py)
+ntfy_dispatcher = Dispatcher("ntfy", alerts.process, maxsize=QUEUE_SIZE, policy="drop_oldest", retries=RETRIES)
+
+
+def dispatch_readings(readings, mqtt=mqtt_dispatcher, ntfy=ntfy_dispatcher):
+    """Hand accepted readings (sorted by time) to every side-effect queue, once
+    per batch; never blocks."""
+    newest = {}
+    for r in readings:
+        newest[r.get("device_id") or DEFAULT_DEVICE] = r
+    for device, reading in newest.items():
+        mqtt.submit(reading, key=f"reading:{device}")
+    ntfy.submit(readings)
@@ -0,0 +1,103 @@
+# downsample.py
+# Server-side downsampling for /api/history, vectorized over storage columns.
+#
+# Both methods pick a subset of the original rows, so the response keeps its
+# usual shape, and every metric shares the same buckets. A query for N points
+# returns at most N rows: LTTB keeps one row per bucket, the one whose
+# triangles are largest summed over all metrics (each scaled to its range),
+# and minmax splits N into N / (2 * len(METRICS)) buckets so the per-metric
+# min and max rows fit. ?resolution= buckets by time instead and returns up
+# to 2 * len(METRICS) rows per bucket.
+import numpy as np
+
+from storage import METRICS
+
+METHODS = ("lttb", "minmax")
+
+
+def _bucket_starts(ids):
+    """Start offsets of each run of equal (sorted) bucket ids."""
+    return np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+
+
+def _first_extreme(values, starts, pick=np.maximum):
+    """Index of the first max (or min) of `values` within each bucket."""
+    ext = pick.reduceat(values, starts)
+    sizes = np.diff(np.r_[starts, len(values)])
+    hits = np.flatnonzero(values == np.repeat(ext, sizes))
+    owner = np.searchsorted(starts, hits, side="right") - 1
+    _, first = np.unique(owner, return_index=True)
+    return hits[first]
+
+
+def lttb_indices(x, y, n):
+    """Largest-triangle-three-buckets, in the vectorized form that uses the
+    previous bucket's centroid instead of the previously selected point.
+    `y` is one series or a 2-D array of them (one per row); each bucket then
+    keeps the point with the largest area summed over the series."""
+    size = len(x)
+    if n >= size or n < 3:
+        return np.arange(size)
+    y = np.atleast_2d(y)
+
+    # first and last points are always kept; the interior goes into n-2 buckets
+    edges = np.linspace(1, size - 1, n - 1).astype(np.int64)
+    starts = edges[:-1] - 1
+    xi, yi = x[1:-1], y[:, 1:-1]
+    counts = np.diff(edges)
+    cx = np.add.reduceat(xi, starts) / counts
+    cy = np.add.reduceat(yi, starts, axis=1) / counts
+
+    # triangle anchors: previous bucket centroid and next bucket centroid
+    ax, ay = np.r_[x[0], cx[:-1]], np.c_[y[:, :1], cy[:, :-1]]
+    bx, by = np.r_[cx[1:], x[-1]], np.c_[cy[:, 1:], y[:, -1:]]
+    ax, ay = np.repeat(ax, counts), np.repeat(ay, counts, axis=1)
+    bx, by = np.repeat(bx, counts), np.repeat(by, counts, axis=1)
+
+    area = np.abs((ax - bx) * (yi - ay) - (ax - xi) * (by - ay)).sum(axis=0)
+    picks = _first_extreme(area, starts) + 1
+    return np.r_[0, picks, size - 1]
+
+
+def _scaled(cols):
+    """Every metric as a row of a 2-D array, scaled to 0..1 over its range."""
+    y = np.array([cols[m] for m in METRICS], dtype=np.float64)
+    lo = y.min(axis=1, keepdims=True)
+    span = y.max(axis=1, keepdims=True) - lo
+    return (y - lo) / np.where(span > 0, span, 1)
+
+
+def minmax_indices(y, bucket_ids):
+    """Min and max of every bucket; `bucket_ids` must be non-decreasing."""
+    if len(y) == 0:
+        return np.arange(0)
+    starts = _bucket_starts(bucket_ids)
+    lo = _first_extreme(y, starts, np.minimum)
+    hi = _first_extreme(y, starts, np.maximum)
+    return np.union1d(lo, hi)
+
+
+def downsample(cols, points=None, resolution=None, method="lttb"):
+    """Reduce time-sorted columns to at most `points` rows, or to the min/max
+    envelope of `resolution`-second buckets."""
+    t = cols["t"]
+    if len(t) < 3:
+        return cols
+
+    if resolution:
+        bucket_ids = (t - t[0]) // int(resolution)
+        keep = [minmax_indices(cols[m].astype(np.float64), bucket_ids) for m in METRICS]
+    elif points and len(t) > points:
+        buckets = points // (2 * len(METRICS))
+        if method == "minmax" and buckets:
+            # equal-count buckets, each with room for every metric's min and max
+            bucket_ids = np.arange(len(t)) * buckets // len(t)
+            keep = [minmax_indices(cols[m].astype(np.float64), bucket_ids) for m in METRICS]
+        else:
+            # (a minmax budget too small for one bucket falls back to lttb)
+            keep = [lttb_indices(t.astype(np.float64), _scaled(cols), points)]
+    else:
+        return cols
+
+    idx = np.unique(np.concatenate(keep))
+    return {k: v[idx] for k, v in cols.items()}
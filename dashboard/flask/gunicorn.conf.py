@@ -1,4 +1,6 @@
 # gunicorn.conf.py
+import gc
+import os
 
 # Logging
 loglevel = 'debug'
@@ -9,10 +11,55 @@ errorlog = 'logs/gunicorn-error.log'
 # Workers and performance
 workers = 2
 threads = 4
-worker_class = 'gevent'  # or 'uvicorn.workers.UvicornWorker' if using FastAPI
+worker_class = 'gevent'  # the FastAPI server has its own config with uvicorn workers (../fastapi)
+
+# Import the app once in the master and fork workers from it (set
+# GUNICORN_PRELOAD=false to import per worker, e.g. for code reloads).
+# Everything that must not be shared across fork (MQTT/ntfy connections,
+# dispatcher threads, the latest-reading mmap) is created lazily per pid.
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").strip().lower() in ("1", "true", "yes", "on")
+
+if preload_app and worker_class == 'gevent':
+    # modules create locks and conditions at import time; patch before the
+    # master imports the app so they are greenlet-aware in the workers
+    from gevent import monkey
+    monkey.patch_all()
 
 # Binding
 bind = '0.0.0.0:8000'
 
 # Daemon (optional)
 # daemon = True
+
+
+# Ingest writer sidecar: one process owns the log files and group-commits
+# rows from every worker (see ingest_writer.py; INGEST_WRITER=direct disables it)
+def on_starting(server):
+    import subprocess
+    import sys
+    import metrics
+    metrics.reset()  # counters restart with the server; workers and the writer repopulate them
+    if os.getenv("INGEST_WRITER", "sidecar") != "sidecar":
+        return
+    here = os.path.dirname(os.path.abspath(__file__))
+    server.ingest_writer = subprocess.Popen([sys.executable, os.path.join(here, "ingest_writer.py")], cwd=here)
+
+
+def on_exit(server):
+    proc = getattr(server, "ingest_writer", None)
+    if proc is not None:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+
+def child_exit(server, worker):
+    # fold the worker's counters into the retired total, also if it was
+    # killed before its atexit hook could (see metrics.py)
+    import metrics
+    metrics.retire(worker.pid)
+
+
+def pre_fork(server, worker):
+    # move the preloaded heap out of the collector's reach so its pages stay
+    # shared copy-on-write instead of being touched by every worker's GC
+    gc.freeze()
@@ -0,0 +1,318 @@
+# ingest_writer.py
+# Single writer for sensor logs, shared by every gunicorn worker.
+#
+# Run as a sidecar (gunicorn.conf.py starts it in `on_starting`):
+#   python ingest_writer.py
+# It listens on a Unix socket (INGEST_SOCKET, default logs/ingest.sock) and
+# owns the log files: one storage.Appender keeps segment/CSV handles open,
+# and rows from concurrent requests are group-committed: whatever arrived
+# while the previous group was being written (and fsynced) goes out as the
+# next group. INGEST_GROUP_WAIT_MS (default 0) additionally holds a group
+# open up to that long, or until INGEST_GROUP_MAX_ROWS rows are pending.
+# Each request is acked only after its group is written.
+#
+# Protocol: one JSON object per line, {"rows": [...]} -> {"ok": true} or
+# {"ok": false, "error": "..."}. A line cut short (no newline) is ignored.
+# With sqlite, rows that weren't stored (another reading of that device and
+# second was) are listed by index: {"ok": true, "skipped": [2, 5]}.
+# INGEST_TIMEOUT bounds connecting and sending; once a request is sent the
+# client waits for its answer however long the commit takes, because timing
+# out then can't tell a failed write from a slow one and a retry would store
+# the rows twice. A writer that dies closes the socket, which ends the wait.
+#
+# INGEST_FSYNC decides durability:
+#   "commit"    fsync after every group (default; survives power loss)
+#   "interval"  fsync at most every INGEST_FSYNC_INTERVAL seconds
+#   "none"      leave it to the OS page cache
+#
+# Workers call `append(rows)`, which returns the rows stored. With
+# INGEST_WRITER=direct, or while the sidecar isn't reachable, it writes
+# in-process through storage.append.
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+import compaction
+import metrics
+import storage
+from settings import INGEST_SOCKET, INGEST_WRITER
+
+logger = logging.getLogger("dashboard")
+
+GROUP_MAX_ROWS = int(os.getenv("INGEST_GROUP_MAX_ROWS", 500))
+GROUP_WAIT = float(os.getenv("INGEST_GROUP_WAIT_MS", 0)) / 1000
+FSYNC = os.getenv("INGEST_FSYNC", "commit")
+FSYNC_INTERVAL = float(os.getenv("INGEST_FSYNC_INTERVAL", 1.0))
+CLIENT_TIMEOUT = float(os.getenv("INGEST_TIMEOUT", 5.0))  # connect and send, not the commit
+FSYNC_POLICIES = ("commit", "interval", "none")
+
+
+# -- server -------------------------------------------------------------------
+
+class _Pending:
+    __slots__ = ("rows", "done", "error", "stored")
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.done = threading.Event()
+        self.error = None
+        self.stored = rows
+
+
+class GroupCommitter:
+    def __init__(self, max_rows=GROUP_MAX_ROWS, wait=GROUP_WAIT, fsync=FSYNC, fsync_interval=FSYNC_INTERVAL):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"unknown fsync policy: {fsync}")
+        self.max_rows = max_rows
+        self.wait = wait
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.appender = storage.Appender()
+        self.commits = 0
+        self.rows = 0
+
+        self._pending = []
+        self._count = 0
+        self._cond = threading.Condition()
+        self._last_sync = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="group-commit", daemon=True)
+        self._thread.start()
+
+    def submit(self, rows):
+        """Queue rows for the next group, block until it is committed and
+        return the rows that were stored."""
+        item = _Pending(rows)
+        with self._cond:
+            self._pending.append(item)
+            self._count += len(rows)
+            self._cond.notify()
+        item.done.wait()
+        if item.error is not None:
+            raise item.error
+        return item.stored
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                deadline = time.monotonic() + self.wait
+                while self._count < self.max_rows:
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        break
+                    self._cond.wait(left)
+                group, self._pending, self._count = self._pending, [], 0
+            self._commit(group)
+
+    def _commit(self, group):
+        rows = [row for item in group for row in item.rows]
+        error = None
+        start = time.perf_counter()
+        try:
+            stored = self.appender.append(rows)
+            if len(stored) < len(rows):
+                kept = set(map(id, stored))
+                for item in group:
+                    item.stored = [row for row in item.rows if id(row) in kept]
+            now = time.monotonic()
+            if self.fsync == "commit" or (self.fsync == "interval" and now - self._last_sync >= self.fsync_interval):
+                self.appender.sync()
+                self._last_sync = now
+            self.commits += 1
+            self.rows += len(rows)
+            metrics.observe("garden_ingest_commit_duration_seconds", time.perf_counter() - start)
+            metrics.observe("garden_ingest_commit_rows", len(rows))
+        except Exception as e:
+            logger.error(f"[ingest] group commit of {len(rows)} rows failed: {e}")
+            error = e
+        for item in group:
+            item.error = error
+            item.done.set()
+
+    def close(self):
+        with self._cond:
+            group, self._pending, self._count = self._pending, [], 0
+        if group:
+            self._commit(group)
+        if self.fsync != "none":
+            self.appender.sync()
+        self.appender.close()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.endswith(b"\n"):
+                break  # the client gave up mid-send
+            if not line.strip():
+                continue
+            try:
+                rows = json.loads(line)["rows"]
+                stored = set(map(id, self.server.committer.submit(rows)))
+                reply = {"ok": True}
+                if len(stored) < len(rows):
+                    reply["skipped"] = [i for i, row in enumerate(rows) if id(row) not in stored]
+            except Exception as e:
+                reply = {"ok": False, "error": str(e)}
+            self.wfile.write(json.dumps(reply).encode() + b"\n")
+
+
+class IngestServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path=INGEST_SOCKET, committer=None):
+        self.committer = committer or GroupCommitter()
+        if os.path.exists(path):
+            if _reachable(path):
+                raise RuntimeError(f"ingest writer already running on {path}")
+            os.unlink(path)  # stale socket from a previous run
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        super().__init__(path, _Handler)
+
+    def server_close(self):
+        super().server_close()
+        self.committer.close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+def _reachable(path):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        s.close()
+
+
+def serve(path=INGEST_SOCKET):
+    server = IngestServer(path)
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    compaction.start_scheduler()  # the writer owns the files, so it also archives them
+    logger.info(f"[ingest] writer listening on {path} (group {server.committer.max_rows} rows / "
+                f"{server.committer.wait * 1000:.0f} ms, fsync={server.committer.fsync})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+# -- client -------------------------------------------------------------------
+
+_idle = []  # connected sockets not in use, shared by the worker's threads/greenlets
+_idle_lock = threading.Lock()
+_pid = None
+_warned = False
+
+
+def _checkout():
+    global _pid
+    with _idle_lock:
+        if _pid != os.getpid():
+            # sockets inherited across fork belong to the parent
+            _pid = os.getpid()
+            _idle.clear()
+        if _idle:
+            return _idle.pop()
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(CLIENT_TIMEOUT)
+    try:
+        s.connect(INGEST_SOCKET)
+    except OSError:
+        s.close()
+        raise
+    return s, s.makefile("rb")
+
+
+def _checkin(conn):
+    with _idle_lock:
+        if _pid == os.getpid():
+            _idle.append(conn)
+            return
+    _discard(conn)
+
+
+def _discard(conn):
+    for c in reversed(conn):
+        try:
+            c.close()
+        except OSError:
+            pass
+
+
+def _direct(rows, reason):
+    global _warned
+    if not _warned:
+        logger.warning(f"[ingest] writer not reachable on {INGEST_SOCKET} ({reason}); writing directly")
+        _warned = True
+    return storage.append(rows)
+
+
+def append(rows):
+    """Persist one reading (dict) or a list of readings through the ingest
+    writer, or directly when it is disabled or unreachable. Returns the rows
+    stored."""
+    global _warned
+    if isinstance(rows, dict):
+        rows = [rows]
+    if INGEST_WRITER != "sidecar":
+        return storage.append(rows)
+
+    payload = json.dumps({"rows": rows}, default=float).encode() + b"\n"
+    for attempt in range(2):
+        try:
+            conn = _checkout()
+        except OSError as e:
+            return _direct(rows, e)
+        try:
+            conn[0].sendall(payload)
+            break
+        except OSError as e:
+            # a pooled socket from before a writer restart; nothing was read yet
+            _discard(conn)
+            if attempt:
+                return _direct(rows, e)
+
+    try:
+        conn[0].settimeout(None)  # sent: the rows may be committing, wait for the answer
+        line = conn[1].readline()
+        conn[0].settimeout(CLIENT_TIMEOUT)
+    except OSError:
+        _discard(conn)
+        raise
+    if not line:
+        _discard(conn)
+        raise ConnectionError("ingest writer closed the connection")
+    _checkin(conn)
+    _warned = False
+    reply = json.loads(line)
+    if not reply.get("ok"):
+        raise RuntimeError(f"ingest writer: {reply.get('error')}")
+    return skip_rows(rows, reply.get("skipped"))
+
+
+def skip_rows(rows, skipped):
+    """`rows` without the indices a writer reply listed as skipped."""
+    if not skipped:
+        return rows
+    skipped = set(skipped)
+    return [row for i, row in enumerate(rows) if i not in skipped]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    metrics.count_errors("")
+    sys.exit(serve())
@@ -0,0 +1,137 @@
+# journal.py
+# Per-device log of stored rows in the order they were written, behind the
+# /api/history ?since= cursor.
+#
+# Layout (little-endian):
+#   header   magic(8s) base(int64): sequence number of the first record
+#   records  (t int64, <metric> float32 ...) in write order
+#
+# A cursor is the sequence number just past the last row a client has seen,
+# so a backfilled row (a device flushing its offline buffer, an import) is
+# delivered to pollers even though its timestamp is older than what they
+# already have. storage.Appender appends every batch after the backend write.
+#
+# The journal keeps at least JOURNAL_ROWS recent rows: once it holds twice
+# that, the appender rewrites it without the older half (under the lock, then
+# a rename). Cursors from before the kept rows are expired; clients reload
+# their window instead.
+#
+# With STORAGE_BACKEND=sqlite there are no journal files: sqlite_store keeps
+# the same sequence in its journal table, written by the transaction that
+# inserts the rows, and `end` / `read_since` read it from there.
+import fcntl
+import os
+import struct
+
+import numpy as np
+
+from settings import STORAGE_BACKEND
+from storage import DEFAULT_DEVICE, METRICS, device_root, to_epoch
+
+MAGIC = b"GEJRNL01"
+HEADER = struct.Struct("<8sq")
+RECORD = np.dtype([("t", "<i8")] + [(m, "<f4") for m in METRICS])
+JOURNAL_ROWS = int(os.getenv("JOURNAL_ROWS", 100_000))
+
+
+class CursorExpired(ValueError):
+    pass
+
+
+def journal_path(device=DEFAULT_DEVICE):
+    return os.path.join(device_root(device), "journal.bin")
+
+
+def _header(f):
+    magic, base = HEADER.unpack(f.read(HEADER.size).ljust(HEADER.size, b"\0"))
+    return base if magic == MAGIC else None
+
+
+def append(rows, device=DEFAULT_DEVICE):
+    """Append one device's stored rows, in write order, to its journal (the
+    file backends; sqlite_store.append journals its own)."""
+    n = len(rows)
+    if not n:
+        return
+    recs = np.zeros(n, dtype=RECORD)
+    recs["t"] = [to_epoch(r["timestamp"]) for r in rows]
+    for m in METRICS:
+        recs[m] = [float(r.get(m, 0) or 0) for r in rows]
+    path = journal_path(device)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(path, "ab") as f:
+                size = f.tell()
+                if size < HEADER.size:
+                    f.truncate(0)
+                    f.write(HEADER.pack(MAGIC, 0))
+                    size = HEADER.size
+                # cut a torn record left by a crash, so records stay aligned
+                size -= (size - HEADER.size) % RECORD.itemsize
+                f.truncate(size)
+                f.write(recs.tobytes())
+                count = (size - HEADER.size) // RECORD.itemsize + n
+            if count >= 2 * JOURNAL_ROWS:
+                _trim(path, count - JOURNAL_ROWS)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _trim(path, drop):
+    with open(path, "rb") as f:
+        base = _header(f) or 0
+        f.seek(HEADER.size + drop * RECORD.itemsize)
+        rest = f.read()
+    with open(path + ".tmp", "wb") as out:
+        out.write(HEADER.pack(MAGIC, base + drop))
+        out.write(rest[:len(rest) - len(rest) % RECORD.itemsize])
+    os.replace(path + ".tmp", path)
+
+
+def _open(device):
+    """(file, base, count) of a device's journal, or None if it has none."""
+    try:
+        f = open(journal_path(device), "rb")
+    except FileNotFoundError:
+        return None
+    base = _header(f)
+    if base is None:
+        f.close()
+        return None
+    count = (os.fstat(f.fileno()).st_size - HEADER.size) // RECORD.itemsize
+    return f, base, count
+
+
+def end(device=DEFAULT_DEVICE):
+    """Sequence number just past the newest journaled row (0 if none)."""
+    if STORAGE_BACKEND == "sqlite":
+        import sqlite_store  # imports this module
+        return sqlite_store.journal_end(device)
+    opened = _open(device)
+    if opened is None:
+        return 0
+    f, base, count = opened
+    f.close()
+    return base + count
+
+
+def read_since(seq, device=DEFAULT_DEVICE):
+    """(columns in write order, next sequence number) for the rows written at
+    or after `seq`. Raises CursorExpired if they are no longer journaled."""
+    if STORAGE_BACKEND == "sqlite":
+        import sqlite_store
+        return sqlite_store.journal_since(seq, device)
+    opened = _open(device)
+    if opened is None:
+        if seq:
+            raise CursorExpired("since cursor has expired; reload the window")
+        return {k: np.zeros(0, dtype=RECORD[k]) for k in RECORD.names}, 0
+    f, base, count = opened
+    with f:
+        if not base <= seq <= base + count:
+            raise CursorExpired("since cursor has expired; reload the window")
+        f.seek(HEADER.size + (seq - base) * RECORD.itemsize)
+        recs = np.frombuffer(f.read((base + count - seq) * RECORD.itemsize), dtype=RECORD)
+    return {k: recs[k].copy() for k in RECORD.names}, base + count
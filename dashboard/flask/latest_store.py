@@ -0,0 +1,186 @@
+# latest_store.py
+# Latest reading per device, shared by every gunicorn worker through a
+# memory-mapped file.
+#
+# Layout (little-endian, fixed size):
+#   header  magic(8s) slot count(uint32) pad
+#   slots   MAX_DEVICES x [device_id(32s) seq(uint64) t(int64) version(uint64) values(float64 x len(METRICS))]
+#
+# Slot 0 is the default device; other devices claim a free slot on their
+# first reading. `version` counts every row written for the device (also
+# backfilled ones that don't change the latest reading) and is bumped when
+# retention deletes some, so readers can tell whether a device's history
+# changed (see the /api/history ETag). Writers serialize on a flock and bump `seq` around the
+# payload (a seqlock); readers never lock, they just retry if `seq` changed
+# underneath them.
+import fcntl
+import mmap
+import os
+import struct
+
+from settings import LATEST_FILE
+from storage import DEFAULT_DEVICE, METRICS, format_ts, to_epoch
+
+MAGIC = b"GESLAT03"
+MAX_DEVICES = 64
+HEADER = struct.Struct("<8sI4x")
+NAME = struct.Struct("<32s")
+SEQ = struct.Struct("<Q")
+PAYLOAD = struct.Struct("<qQ" + "d" * len(METRICS))
+SLOT_SIZE = NAME.size + SEQ.size + PAYLOAD.size
+SIZE = HEADER.size + MAX_DEVICES * SLOT_SIZE
+
+_fd = None
+_map = None
+_slots = {}  # device_id -> slot index, cached per process
+
+
+def _mapping():
+    global _fd, _map
+    if _map is None:
+        os.makedirs(os.path.dirname(LATEST_FILE), exist_ok=True)
+        fd = os.open(LATEST_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size != SIZE or os.pread(fd, len(MAGIC), 0) != MAGIC:
+                # new file or an older layout: start fresh
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, SIZE)
+                os.pwrite(fd, HEADER.pack(MAGIC, MAX_DEVICES), 0)
+                os.pwrite(fd, NAME.pack(DEFAULT_DEVICE.encode()), HEADER.size)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        _fd, _map = fd, mmap.mmap(fd, SIZE)
+    return _map
+
+
+def _offset(slot):
+    return HEADER.size + slot * SLOT_SIZE
+
+
+def _slot_name(m, slot):
+    return NAME.unpack_from(m, _offset(slot))[0].rstrip(b"\0").decode()
+
+
+def _find_slot(m, device):
+    slot = _slots.get(device)
+    if slot is not None and _slot_name(m, slot) == device:
+        return slot
+    for i in range(MAX_DEVICES):
+        name = _slot_name(m, i)
+        if name == device:
+            _slots[device] = i
+            return i
+        if not name:
+            return None
+    return None
+
+
+def _claim_slot(m, device):
+    slot = _find_slot(m, device)
+    if slot is None:
+        slot = next((i for i in range(MAX_DEVICES) if not _slot_name(m, i)), None)
+        if slot is None:
+            raise RuntimeError(f"latest_store full ({MAX_DEVICES} devices)")
+        NAME.pack_into(m, _offset(slot), device.encode())
+        _slots[device] = slot
+    return slot
+
+
+def record(rows):
+    """Account for rows that were just persisted: bump each device's version
+    and keep its newest reading."""
+    m = _mapping()
+    newest, counts = {}, {}
+    for row in rows:
+        device = row.get("device_id") or DEFAULT_DEVICE
+        t = to_epoch(row["timestamp"])
+        counts[device] = counts.get(device, 0) + 1
+        if device not in newest or t >= newest[device][0]:
+            newest[device] = (t, row)
+    fcntl.flock(_fd, fcntl.LOCK_EX)
+    try:
+        for device, (t, row) in newest.items():
+            slot = _claim_slot(m, device)
+            seq_at = _offset(slot) + NAME.size
+            seq = SEQ.unpack_from(m, seq_at)[0]
+            old_t, version, *values = PAYLOAD.unpack_from(m, seq_at + SEQ.size)
+            if seq == 0 or t >= old_t:
+                old_t, values = t, [float(row.get(k, 0) or 0) for k in METRICS]
+            payload = PAYLOAD.pack(old_t, version + counts[device], *values)
+            SEQ.pack_into(m, seq_at, seq + 1)
+            m[seq_at + SEQ.size:seq_at + SEQ.size + PAYLOAD.size] = payload
+            SEQ.pack_into(m, seq_at, seq + 2)
+    finally:
+        fcntl.flock(_fd, fcntl.LOCK_UN)
+
+
+def bump(device=DEFAULT_DEVICE, n=1):
+    """Count a change that isn't a write (rows removed by retention) against
+    a device's version. No-op for a device that never reported."""
+    m = _mapping()
+    fcntl.flock(_fd, fcntl.LOCK_EX)
+    try:
+        slot = _find_slot(m, device)
+        if slot is None:
+            return
+        seq_at = _offset(slot) + NAME.size
+        seq = SEQ.unpack_from(m, seq_at)[0]
+        if seq == 0:
+            return
+        t, version, *values = PAYLOAD.unpack_from(m, seq_at + SEQ.size)
+        payload = PAYLOAD.pack(t, version + n, *values)
+        SEQ.pack_into(m, seq_at, seq + 1)
+        m[seq_at + SEQ.size:seq_at + SEQ.size + PAYLOAD.size] = payload
+        SEQ.pack_into(m, seq_at, seq + 2)
+    finally:
+        fcntl.flock(_fd, fcntl.LOCK_UN)
+
+
+def _read_slot(m, slot, retries):
+    """(t, version, values) for a slot, or None if it was never written."""
+    seq_at = _offset(slot) + NAME.size
+    for _ in range(retries):
+        before = SEQ.unpack_from(m, seq_at)[0]
+        if before & 1:
+            continue
+        t, version, *values = PAYLOAD.unpack_from(m, seq_at + SEQ.size)
+        if SEQ.unpack_from(m, seq_at)[0] == before:
+            return None if before == 0 else (t, version, values)
+    return None
+
+
+def _reading(device, raw):
+    t, _, values = raw
+    return {"timestamp": format_ts(t), "device_id": device, **dict(zip(METRICS, values))}
+
+
+def read(device=DEFAULT_DEVICE, retries=100):
+    """Return a device's latest reading as a dict, or None if it never reported."""
+    m = _mapping()
+    slot = _find_slot(m, device)
+    raw = None if slot is None else _read_slot(m, slot, retries)
+    return None if raw is None else _reading(device, raw)
+
+
+def version(device=DEFAULT_DEVICE, retries=100):
+    """Rows written for a device since the store was created, plus retention
+    deletes (see bump); 0 if none."""
+    m = _mapping()
+    slot = _find_slot(m, device)
+    raw = None if slot is None else _read_slot(m, slot, retries)
+    return 0 if raw is None else raw[1]
+
+
+def read_all(retries=100):
+    """{device_id: latest reading} for every device that has reported."""
+    m = _mapping()
+    out = {}
+    for i in range(MAX_DEVICES):
+        name = _slot_name(m, i)
+        if not name:
+            break
+        raw = _read_slot(m, i, retries)
+        if raw is not None:
+            out[name] = _reading(name, raw)
+    return out
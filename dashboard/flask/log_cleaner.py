@@ -0,0 +1,336 @@
+# log_cleaner.py
+# Chunked, vectorized cleaning of raw_sensorlog CSV files.
+#
+# A log is processed in fixed-size byte chunks cut at line boundaries, so
+# memory stays flat whatever the file size. Each chunk is parsed with NumPy:
+# newline and comma positions give the field boundaries, every field is
+# gathered into a fixed-width byte array and converted in one cast, and the
+# kept lines are copied out byte-for-byte (no re-formatting). Only odd rows
+# (legacy timestamp formats, malformed numbers) fall back to per-row parsing.
+#
+# Every dropped row is counted under the first rule it breaks, in RULES order.
+# RANGES are the plausible sensor ranges, checked against every firmware
+# variant; the ingest validation applies them too when INGEST_RANGE_CHECK is
+# set (see sensor_utils.validate_readings).
+#
+# CLI: utils/data-cleaner.py
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+
+from storage import METRICS, to_epoch
+
+RULES = ("blank", "header", "columns", "timestamp", "window", "numeric", "range")
+
+# inclusive plausible bounds per metric, wide enough for every firmware variant:
+# SHT31 / HDC1000 read -40..125 C, VEML7700 / OPT3001 up to ~120k lux (the
+# OPT3001 builds send lux=-1 for a failed read), and the moisture probe is
+# constrained to 0..150% so overwatering stays visible
+RANGES = {
+    "temp_f": (-40.0, 257.0),
+    "humidity": (0.0, 100.0),
+    "lux": (0.0, 200_000.0),
+    "moisture": (0.0, 150.0),
+}
+
+CHUNK_BYTES = 16 * 1024 * 1024
+TS_WIDTH = 24   # longer timestamps are parsed row by row
+NUM_WIDTH = 16  # longer numbers are malformed by definition
+
+_NUMERIC = np.zeros(256, dtype=bool)
+_NUMERIC[np.frombuffer(b"\x000123456789.-+eE", np.uint8)] = True  # \x00 is padding
+_DIGIT = np.zeros(256, dtype=bool)
+_DIGIT[np.frombuffer(b"0123456789", np.uint8)] = True
+# "YYYY-MM-DDTHH:MM:SS[Z]": separator positions, the rest are digits
+_TS_SEPS = {4: ord("-"), 7: ord("-"), 13: ord(":"), 16: ord(":")}
+_TS_DIGITS = [i for i in range(19) if i not in _TS_SEPS and i != 10]
+
+
+# -- shared range checks ----------------------------------------------------------
+
+def range_mask(cols, ranges=RANGES):
+    """Boolean mask of rows whose metrics are all within `ranges` (NaN fails)."""
+    ok = np.ones(len(next(iter(cols.values()))), dtype=bool)
+    for m, (lo, hi) in ranges.items():
+        if m in cols:
+            v = cols[m]
+            ok &= (v >= lo) & (v <= hi)
+    return ok
+
+
+def out_of_range(reading, ranges=RANGES):
+    """Reason string for the first metric of one reading outside `ranges`, else None."""
+    for m, (lo, hi) in ranges.items():
+        if m in reading and not lo <= float(reading[m]) <= hi:
+            return f"{m} is outside the plausible range [{lo:g}, {hi:g}]"
+    return None
+
+
+# -- chunk parsing ----------------------------------------------------------------
+
+def _gather(windows, start, end, width):
+    """Bytes [start, end) of every row as one fixed-width array (zero padded),
+    plus a mask of rows whose field didn't fit. `windows` is a sliding window
+    view of the chunk, so this is one fancy index rather than an index matrix."""
+    length = end - start
+    g = windows[start, :width]
+    g[np.arange(width) >= length[:, None]] = 0
+    return g, length, length > width
+
+
+def _parse_numbers(g, length, too_long):
+    """float64 per row; NaN where the field isn't a number."""
+    s = g.view(f"S{g.shape[1]}").ravel()
+    if not too_long.any() and length.all():
+        try:
+            return s.astype(np.float64)  # a clean chunk: one cast
+        except ValueError:
+            pass
+    bad = too_long | (length == 0) | ~_NUMERIC[g].all(axis=1)
+    g[bad] = 0
+    g[bad, :3] = np.frombuffer(b"nan", np.uint8)
+    try:
+        return s.astype(np.float64)
+    except ValueError:
+        # only numeric characters but not a number ("1-2", ".."): per row
+        out = np.empty(len(s))
+        for i, v in enumerate(s.tolist()):
+            try:
+                out[i] = float(v)
+            except ValueError:
+                out[i] = np.nan
+        return out
+
+
+def _parse_timestamps(g, length):
+    """Epoch seconds per row, and a mask of rows whose timestamp parsed.
+
+    "YYYY-MM-DDTHH:MM:SSZ" (what we write) and naive "YYYY-MM-DD[T ]HH:MM:SS"
+    (local time, like to_epoch) are converted in one cast; anything else,
+    e.g. the old FastAPI format, goes through to_epoch row by row.
+    """
+    t = np.zeros(len(g), dtype=np.int64)
+    fast = _DIGIT[g[:, _TS_DIGITS]].all(axis=1) & ((g[:, 10] == ord("T")) | (g[:, 10] == ord(" ")))
+    for i, sep in _TS_SEPS.items():
+        fast &= g[:, i] == sep
+    zulu = fast & (length == 20) & (g[:, 19] == ord("Z"))
+    naive = fast & (length == 19)
+    fast = zulu | naive
+    ok = fast.copy()
+    if fast.any():
+        s = np.ascontiguousarray(g[fast, :19])
+        s[:, 10] = ord("T")
+        try:
+            t[fast] = s.view("S19").ravel().astype("datetime64[s]").astype(np.int64)
+        except ValueError:  # e.g. month 13; sort it out row by row
+            ok[:] = fast[:] = False
+    if naive.any() and fast.any():
+        # local -> UTC, one offset per distinct local hour (exactly what
+        # datetime.timestamp() does for each row)
+        hours, inverse = np.unique(t[naive] // 3600, return_inverse=True)
+        offsets = np.array([int(datetime.fromtimestamp(h * 3600, timezone.utc).replace(tzinfo=None).timestamp()) - h * 3600
+                            for h in hours.tolist()], dtype=np.int64)
+        t[naive] += offsets[inverse]
+    for i in np.flatnonzero(~fast):
+        try:
+            t[i] = to_epoch(bytes(g[i, :length[i]]).decode("utf-8"))
+            ok[i] = True
+        except (ValueError, TypeError, UnicodeDecodeError, OverflowError):
+            ok[i] = False
+    return t, ok
+
+
+def _layout(a, nfields):
+    """Line and field boundaries of `a` (bytes ending in a newline).
+
+    Returns (nl, starts, ends, shaped, rows, lo, hi): newline positions, the
+    start and end (without the line break) of every line, a mask of lines with
+    `nfields` fields, their indices, and lo/hi[i, j], the byte bounds of field
+    j of line rows[i].
+    """
+    nl = np.flatnonzero(a == 10)
+    starts = np.concatenate(([0], nl[:-1] + 1))
+    ends = nl - (a[np.maximum(nl - 1, 0)] == 13) * (nl > starts)  # strip \r
+    n = len(nl)
+    commas = np.flatnonzero(a == 44)
+    per_line = np.bincount(np.searchsorted(nl, commas), minlength=n)[:n]
+    first = np.concatenate(([0], np.cumsum(per_line)[:-1]))
+    shaped = (per_line == nfields - 1) & (ends > starts)
+    rows = np.flatnonzero(shaped)
+    lo = np.empty((len(rows), nfields), dtype=np.int64)
+    hi = np.empty((len(rows), nfields), dtype=np.int64)
+    if nfields > 1:
+        c = commas[first[rows][:, None] + np.arange(nfields - 1)]
+        lo[:, 0], lo[:, 1:] = starts[rows], c + 1
+        hi[:, :-1], hi[:, -1] = c, ends[rows]
+    else:
+        lo[:, 0], hi[:, 0] = starts[rows], ends[rows]
+    return nl, starts, ends, shaped, rows, lo, hi
+
+
+def _windows(a):
+    return np.lib.stride_tricks.sliding_window_view(
+        np.concatenate((a, np.zeros(max(TS_WIDTH, NUM_WIDTH), np.uint8))), max(TS_WIDTH, NUM_WIDTH))
+
+
+def _timestamps(buf, windows, lo, hi):
+    """Epoch seconds and parsed mask of the timestamp fields at [lo, hi)."""
+    g, length, too_long = _gather(windows, lo, hi, TS_WIDTH)
+    t, ok = _parse_timestamps(g, length)
+    for i in np.flatnonzero(too_long):
+        try:
+            t[i] = to_epoch(buf[lo[i]:hi[i]].decode("utf-8"))
+            ok[i] = True
+        except (ValueError, TypeError, UnicodeDecodeError, OverflowError):
+            pass
+    return g, length, t, ok
+
+
+def clean_chunk(buf, fieldnames, ranges=RANGES, since=None, until=None):
+    """Clean whole CSV lines (no file header) held in `buf`.
+
+    Returns (kept, counts): the kept lines as bytes, unchanged, and a Counter
+    of dropped rows per rule plus "rows" and "kept".
+    """
+    counts = Counter()
+    if not buf:
+        return b"", counts
+    if not buf.endswith(b"\n"):
+        buf += b"\n"
+    a = np.frombuffer(buf, dtype=np.uint8)
+    windows = _windows(a)
+    nl, starts, ends, shaped, rows, bounds_lo, bounds_hi = _layout(a, len(fieldnames))
+    n = len(nl)
+    counts["rows"] = n
+
+    keep = np.ones(n, dtype=bool)
+
+    def drop(rule, mask):
+        mask = mask & keep
+        counts[rule] += int(mask.sum())
+        keep[mask] = False
+
+    drop("blank", ends == starts)
+
+    ts_col = fieldnames.index("timestamp")
+    g, length, t, ts_ok = _timestamps(buf, windows, bounds_lo[:, ts_col], bounds_hi[:, ts_col])
+    header = np.zeros(n, dtype=bool)
+    header[rows] = (length == 9) & (g[:, :9] == np.frombuffer(b"timestamp", np.uint8)).all(axis=1)
+    drop("header", header)
+    drop("columns", ~shaped)
+
+    bad = np.zeros(n, dtype=bool)
+    bad[rows] = ~ts_ok
+    drop("timestamp", bad)
+    if since is not None or until is not None:
+        outside = np.zeros(n, dtype=bool)
+        outside[rows] = ((t < since) if since is not None else False) | ((t >= until) if until is not None else False)
+        drop("window", outside)
+
+    values = {}
+    for m in METRICS:
+        if m not in fieldnames:
+            continue  # e.g. logs from before the moisture probe
+        j = fieldnames.index(m)
+        values[m] = _parse_numbers(*_gather(windows, bounds_lo[:, j], bounds_hi[:, j], NUM_WIDTH))
+    nan = np.zeros(n, dtype=bool)
+    nan[rows] = np.logical_or.reduce([np.isnan(v) for v in values.values()]) if values else False
+    drop("numeric", nan)
+    outside = np.zeros(n, dtype=bool)
+    outside[rows] = ~range_mask(values, ranges) if values else False
+    drop("range", outside)
+
+    counts["kept"] = int(keep.sum())
+    if keep.all():
+        return buf, counts
+    # copy the kept lines (with their newlines) straight out of the buffer
+    line_of_byte = np.repeat(keep, nl - starts + 1)
+    return a[line_of_byte].tobytes(), counts
+
+
+def parse_lines(buf, fieldnames):
+    """The lines of `buf` (whole CSV lines, no file header) that have
+    len(fieldnames) fields and a timestamp that parses, as a dict of arrays:
+    byte bounds of the line ("start", "end", without the line break) and of
+    its timestamp field ("ts_lo", "ts_hi"), and the epoch seconds "t". Also
+    returns the number of other lines (blank, headers, malformed)."""
+    if not buf.endswith(b"\n"):
+        buf += b"\n"
+    a = np.frombuffer(buf, dtype=np.uint8)
+    nl, starts, ends, shaped, rows, lo, hi = _layout(a, len(fieldnames))
+    ts_col = fieldnames.index("timestamp")
+    _, _, t, ok = _timestamps(buf, _windows(a), lo[:, ts_col], hi[:, ts_col])
+    lines = {"start": starts[rows], "end": ends[rows], "ts_lo": lo[:, ts_col], "ts_hi": hi[:, ts_col], "t": t}
+    return {k: v[ok] for k, v in lines.items()}, len(nl) - int(ok.sum())
+
+
+# -- files ------------------------------------------------------------------------
+
+def read_header(path, required=("timestamp", "temp_f", "humidity", "lux")):
+    """(header line as bytes, field names) of a CSV log."""
+    with open(path, "rb") as f:
+        header = f.readline()
+    names = header.decode("utf-8-sig").strip().split(",")
+    missing = [c for c in required if c not in names]
+    if missing:
+        raise ValueError(f"{path}: header has no {', '.join(missing)} column")
+    return header, names
+
+
+def chunk_ranges(path, chunk_bytes=CHUNK_BYTES, offset=0):
+    """(start, end) byte ranges of about `chunk_bytes` from `offset`, each
+    ending just after a newline (the last one at end of file)."""
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        start = offset
+        while start < size:
+            end = min(start + chunk_bytes, size)
+            if end < size:
+                f.seek(end)
+                rest = f.readline()
+                end += len(rest)
+            yield start, end
+            start = end
+
+
+def _clean_range(args):
+    path, start, end, fieldnames, ranges, since, until = args
+    with open(path, "rb") as f:
+        f.seek(start)
+        buf = f.read(end - start)
+    return clean_chunk(buf, fieldnames, ranges, since, until)
+
+
+def clean_file(src, dst, chunk_bytes=CHUNK_BYTES, ranges=RANGES, since=None, until=None, jobs=1):
+    """Write the clean rows of `src` (with its header) to `dst`; returns the
+    Counter of rows, kept rows and drops per rule. With jobs > 1, chunks are
+    cleaned in parallel processes and written in order."""
+    header, fieldnames = read_header(src)
+    tasks = ((src, lo, hi, fieldnames, ranges, since, until)
+             for lo, hi in chunk_ranges(src, chunk_bytes, offset=len(header)))
+    totals = Counter()
+    with open(dst, "wb") as out:
+        out.write(header if header.endswith(b"\n") else header + b"\n")
+        if jobs > 1:
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                # bounded read-ahead keeps memory flat
+                pending = []
+                for task in tasks:
+                    pending.append(pool.submit(_clean_range, task))
+                    if len(pending) >= jobs * 2:
+                        kept, counts = pending.pop(0).result()
+                        out.write(kept)
+                        totals.update(counts)
+                for fut in pending:
+                    kept, counts = fut.result()
+                    out.write(kept)
+                    totals.update(counts)
+        else:
+            for task in tasks:
+                kept, counts = _clean_range(task)
+                out.write(kept)
+                totals.update(counts)
+    return totals
@@ -0,0 +1,261 @@
+# log_merge.py
+# Streaming, time-aligned merge of CSV logs (e.g. raw_sensorlog.csv with a
+# VEML7700 debug log) into one training table.
+#
+# The first log drives the output: every row of it is matched with at most
+# one row of each other log, like pandas.merge_asof, and written as the
+# primary line followed by the matched row's fields (everything but its
+# timestamp). `direction` picks the match per row:
+#   backward  the last row at or before the primary row's time
+#   forward   the first row at or after it
+#   nearest   whichever is closer (backward on a tie)
+# and rows further than `tolerance` seconds away don't match. With
+# how="inner" primary rows that miss a match in any log are dropped; with
+# how="left" they're kept with empty fields.
+#
+# Every log is read in chunks cut at line boundaries (log_cleaner.chunk_ranges)
+# and parsed with NumPy (log_cleaner.parse_lines). Of the secondary logs only
+# the rows within `tolerance` of the primary rows still to be written are
+# held, so memory is bounded by the chunk size, not the file size. Logs are
+# expected in roughly time order, as the loggers append them: rows are sorted
+# as they're read, and a row is only written once no later chunk can still
+# precede it (by the time of the last row read). A row that turns up after
+# rows newer than it were written or discarded is dropped and counted as
+# "late". Lines are copied byte for byte, so the same inputs always give the
+# same output.
+#
+# CLI: utils/merge-logs.py
+import os
+import re
+from collections import Counter
+
+import numpy as np
+
+from log_cleaner import chunk_ranges, parse_lines, read_header
+
+DIRECTIONS = ("backward", "forward", "nearest")
+CHUNK_BYTES = 4 * 1024 * 1024
+EMIT_ROWS = 65_536  # output rows assembled at once (bounds the gather index)
+
+_EMPTY = np.empty(0, dtype=np.int64)
+
+
+class _Log:
+    """Parsed rows of one log that haven't been consumed yet, in time order."""
+
+    def __init__(self, path, chunk_bytes, since=None, until=None):
+        self.path = path
+        self.header, self.fieldnames = read_header(path, required=("timestamp",))
+        self.ts_col = self.fieldnames.index("timestamp")
+        self._chunks = chunk_ranges(path, chunk_bytes, offset=len(self.header))
+        self._file = open(path, "rb")
+        self.since, self.until = since, until
+        self.buf = np.empty(0, dtype=np.uint8)
+        self.rows = {k: _EMPTY for k in ("start", "end", "ts_lo", "ts_hi", "t")}
+        self.frontier = None  # time of the last row read, in file order
+        self.floor = None     # rows older than this arrive too late to use
+        self.done = False
+        self.counts = Counter()
+
+    def __len__(self):
+        return len(self.rows["t"])
+
+    def horizon(self, tolerance=0):
+        """Rows of other logs before this time can't gain a match (or, for
+        the driving log, a predecessor) from what's left to read."""
+        if self.done:
+            return np.inf
+        return -np.inf if self.frontier is None else self.frontier - tolerance
+
+    def close(self):
+        self._file.close()
+
+    def fill(self):
+        """Parse the next chunk into the buffer; False at end of file."""
+        span = next(self._chunks, None)
+        if span is None:
+            self.done = True
+            self.close()
+            return False
+        self._file.seek(span[0])
+        data = self._file.read(span[1] - span[0])
+        rows, skipped = parse_lines(data, self.fieldnames)
+        self.counts["rows"] += len(rows["t"]) + skipped
+        self.counts["skipped"] += skipped
+        t = rows["t"]
+        keep = np.ones(len(t), dtype=bool)
+        if self.floor is not None and self.frontier is not None:
+            # out of order and behind what's been written or discarded; rows
+            # that are merely behind (a gap in another log) are trimmed as usual
+            late = (t < self.floor) & (t < self.frontier)
+            self.counts["late"] += int(late.sum())
+            keep &= ~late
+        if self.since is not None:
+            keep &= t >= self.since
+        if self.until is not None:
+            keep &= t < self.until
+        if len(t):
+            self.frontier = int(t[-1])
+        base = len(self.buf)
+        self.buf = np.concatenate((self.buf, np.frombuffer(data, dtype=np.uint8)))
+        for k in rows:
+            rows[k] = rows[k][keep] + (base if k != "t" else 0)
+        merged = {k: np.concatenate((self.rows[k], rows[k])) for k in rows}
+        order = np.argsort(merged["t"], kind="stable")
+        self.rows = {k: v[order] for k, v in merged.items()}
+        return True
+
+    def drop(self, n):
+        """Forget the first n rows."""
+        if n:
+            self.floor = max(self.floor or 0, int(self.rows["t"][n - 1]))
+        self.rows = {k: v[n:] for k, v in self.rows.items()}
+        live = int((self.rows["end"] - self.rows["start"]).sum())
+        if len(self.buf) > 2 * live + (1 << 20):
+            self._compact()
+
+    def drop_before(self, t):
+        self.drop(int(np.searchsorted(self.rows["t"], t, "left")))
+        self.floor = max(self.floor or 0, int(t))
+
+    def _compact(self):
+        # a few rows can pin a whole chunk (a clock glitch far in the future):
+        # copy the remaining lines into a new buffer
+        r = self.rows
+        size = r["end"] - r["start"]
+        new_start = np.cumsum(size) - size
+        self.buf = self.buf[np.repeat(r["start"] - new_start, size) + np.arange(int(size.sum()))]
+        shift = new_start - r["start"]
+        self.rows = {**r, "start": new_start, "end": r["end"] + shift,
+                     "ts_lo": r["ts_lo"] + shift, "ts_hi": r["ts_hi"] + shift}
+
+
+def match(t, other, direction="nearest", tolerance=1.0):
+    """Index into `other` (sorted epoch seconds) of the row matched to each
+    of `t`, or -1 where nothing is within `tolerance`."""
+    n = len(other)
+    back = np.searchsorted(other, t, "right") - 1
+    fwd = np.searchsorted(other, t, "left")
+    back_ok = back >= 0
+    fwd_ok = fwd < n
+    back_gap = np.where(back_ok, t - other[np.maximum(back, 0)], np.inf) if n else np.full(len(t), np.inf)
+    fwd_gap = np.where(fwd_ok, other[np.minimum(fwd, n - 1)] - t, np.inf) if n else np.full(len(t), np.inf)
+    if direction == "backward":
+        idx, gap = back, back_gap
+    elif direction == "forward":
+        idx, gap = fwd, fwd_gap
+    else:
+        closer = back_gap <= fwd_gap
+        idx, gap = np.where(closer, back, fwd), np.minimum(back_gap, fwd_gap)
+    return np.where(gap <= tolerance, idx, -1)
+
+
+def _label(path):
+    return re.sub(r"\W+", "_", os.path.splitext(os.path.basename(path))[0]).strip("_")
+
+
+def output_fields(logs):
+    """Field names of the merged table: the primary log's, then every other
+    log's (without its timestamp), suffixed with the log's file name when
+    the name is already taken."""
+    names = list(logs[0].fieldnames)
+    for log in logs[1:]:
+        for name in log.fieldnames:
+            if name == "timestamp":
+                continue
+            names.append(f"{name}_{_label(log.path)}" if name in names else name)
+    return names
+
+
+def _assemble(buf, rows, others, picks):
+    """Output lines for the primary `rows` (byte ranges into `buf`) and the
+    rows of `others` picked for them (-1: none).
+
+    Every line is a run of byte ranges ("pieces") into one pool; the pieces
+    of all lines are gathered with a single fancy index."""
+    n = len(rows["t"])
+    consts = b"\n," + b"".join(b"," * (len(log.fieldnames) - 1) for log in others)
+    pool = np.concatenate([buf] + [log.buf for log in others] + [np.frombuffer(consts, dtype=np.uint8)])
+    bases = np.cumsum([len(buf)] + [len(log.buf) for log in others])
+    newline, comma, empty = bases[-1], bases[-1] + 1, bases[-1] + 2
+
+    starts, lens = [rows["start"]], [rows["end"] - rows["start"]]
+    for base, log, idx in zip(bases, others, picks):
+        hit = idx >= 0
+        width = len(log.fieldnames) - 1
+        if hit.any():
+            r = {k: v[np.where(hit, idx, 0)] for k, v in log.rows.items()}
+            # "," + the fields before the timestamp, then "," + the ones after it
+            starts += [np.full(n, comma), base + r["start"], base + r["ts_hi"]]
+            lens += [np.where(hit & (log.ts_col > 0), 1, 0),
+                     np.where(hit, np.maximum(r["ts_lo"] - 1 - r["start"], 0), 0),
+                     np.where(hit, r["end"] - r["ts_hi"], 0)]
+        # no match: a run of empty fields
+        starts.append(np.full(n, empty))
+        lens.append(np.where(hit, 0, width))
+        empty += width
+    starts.append(np.full(n, newline))
+    lens.append(np.ones(n, dtype=np.int64))
+
+    st = np.stack(starts, axis=1).ravel()
+    ln = np.stack(lens, axis=1).ravel()
+    offsets = np.cumsum(ln) - ln
+    return pool[np.repeat(st - offsets, ln) + np.arange(int(ln.sum()))].tobytes()
+
+
+def merge_files(paths, dst, direction="nearest", tolerance=1.0, how="inner",
+                since=None, until=None, chunk_bytes=CHUNK_BYTES):
+    """Merge `paths` (the first one drives) into `dst`; returns a Counter
+    with "written", "unmatched" (primary rows missing a match in some log)
+    and per log "<label>.rows", ".skipped" and ".late"."""
+    if direction not in DIRECTIONS:
+        raise ValueError(f"direction must be one of {', '.join(DIRECTIONS)}")
+    if how not in ("inner", "left"):
+        raise ValueError("how must be inner or left")
+    if len(paths) < 2:
+        raise ValueError("need at least two logs to merge")
+    logs = [_Log(path, chunk_bytes) for path in paths]
+    primary, others = logs[0], logs[1:]
+    primary.since, primary.until = since, until
+    totals = Counter()
+
+    with open(dst, "wb") as out:
+        out.write((",".join(output_fields(logs)) + "\n").encode("utf-8"))
+        while True:
+            if not len(primary):
+                if primary.done or (until is not None and primary.frontier is not None and primary.frontier >= until):
+                    break
+                primary.fill()
+                continue
+            t0 = primary.rows["t"][0]
+            # a primary row is final once no later chunk can hold an earlier
+            # primary row or, of any other log, a closer match
+            if primary.horizon() <= t0:
+                primary.fill()
+                continue
+            for log in others:
+                log.drop_before(t0 - tolerance)
+            horizons = [primary.horizon()] + [log.horizon(tolerance) for log in others]
+            blocked = [log for log, h in zip(others, horizons[1:]) if h <= t0]
+            if blocked:
+                for log in blocked:
+                    log.fill()
+                continue
+            t = primary.rows["t"]
+            n = min(int(np.searchsorted(t, min(horizons), "left")), EMIT_ROWS)
+            picks = [match(t[:n], log.rows["t"], direction, tolerance) for log in others]
+            matched = np.logical_and.reduce([idx >= 0 for idx in picks])
+            totals["unmatched"] += n - int(matched.sum())
+            keep = matched if how == "inner" else np.ones(n, dtype=bool)
+            if keep.any():
+                rows = {k: v[:n][keep] for k, v in primary.rows.items()}
+                out.write(_assemble(primary.buf, rows, others, [idx[keep] for idx in picks]))
+            totals["written"] += int(keep.sum())
+            primary.drop(n)
+
+    for log in logs:
+        log.close()
+        for k, v in log.counts.items():
+            totals[f"{_label(log.path)}.{k}"] += v
+    return totals
+
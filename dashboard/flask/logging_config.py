@@ -2,10 +2,14 @@ import os
 import logging
 from logging.handlers import TimedRotatingFileHandler
 from settings import LOG_DIR
+import metrics
 
 os.makedirs(LOG_DIR, exist_ok=True)
 
-def setup_loggers(app):
+def setup_loggers(app=None):
+    # the Flask app's logger is "dashboard" (its import name); the FastAPI
+    # server has no app logger and passes none
+    logger = app.logger if app is not None else logging.getLogger("dashboard")
     formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s')
 
     # Console handler
@@ -18,11 +22,11 @@ def setup_loggers(app):
     info_handler = _create_handler('info.log', logging.INFO, formatter)
     error_handler = _create_handler('error.log', logging.ERROR, formatter)
 
-    app.logger.setLevel(logging.DEBUG)
-    app.logger.addHandler(console_handler)
-    app.logger.addHandler(debug_handler)
-    app.logger.addHandler(info_handler)
-    app.logger.addHandler(error_handler)
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(console_handler)
+    logger.addHandler(debug_handler)
+    logger.addHandler(info_handler)
+    logger.addHandler(error_handler)
 
     # MQTT logger
     mqtt_logger = logging.getLogger("mqtt")
@@ -36,6 +40,9 @@ def setup_loggers(app):
     ntfy_logger.addHandler(_create_handler('ntfy.log', logging.INFO, formatter))
     ntfy_logger.propagate = False
 
+    # error counters for /metrics; "dashboard" and the rest propagate to the root logger
+    metrics.count_errors("", "mqtt", "ntfy")
+
 
 def _create_handler(filename, level, formatter):
     handler = TimedRotatingFileHandler(
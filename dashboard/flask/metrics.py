@@ -0,0 +1,367 @@
+# metrics.py
+# Counters and histograms for /metrics (Prometheus text format), summed
+# across gunicorn workers and the ingest writer.
+#
+# Each process records into plain dicts (one lock, no I/O on the hot path). A
+# background thread snapshots them every METRICS_FLUSH_INTERVAL seconds to
+# logs/metrics/<pid>.json, written to a temp file and renamed over. A scrape
+# flushes its own process, then adds up every snapshot in the directory.
+#
+# When a process exits, its snapshot is folded into retired.json (the sum of
+# every exited process) and removed: at exit, by gunicorn's child_exit hook for
+# workers that die without running it, and by a new process that finds a
+# leftover snapshot under its own (reused) pid. So counters never go
+# backwards and dead pids don't pile up. Folding and scraping serialize on
+# .lock. The directory is cleared when gunicorn starts (gunicorn.conf.py).
+#
+# Every metric is declared in METRICS below; recording an undeclared name
+# raises KeyError. Gauges (log file sizes) are computed at scrape time.
+import atexit
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from settings import LOG_DIR, METRICS_DIR, SQLITE_DB
+
+FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", 1.0))
+RETIRED = "retired.json"
+LOCK = ".lock"
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+ROW_BUCKETS = (0, 10, 100, 1000, 10_000, 100_000, 1_000_000)
+
+# name -> (type, help, histogram buckets)
+METRICS = {
+    "garden_http_requests_total": ("counter", "HTTP requests by route, method and status.", None),
+    "garden_http_request_duration_seconds": ("histogram", "HTTP request latency by route and method.", LATENCY_BUCKETS),
+    "garden_ingest_stage_duration_seconds": (
+        "histogram", "Time spent per ingest stage (validate, detect, write, latest, rollup, stats, stream, mqtt, ntfy).", LATENCY_BUCKETS),
+    "garden_ingest_rows_total": ("counter", "Readings accepted, rejected or quarantined by the ingest endpoints.", None),
+    "garden_anomalies_total": ("counter", "Anomalous readings per metric, kind (spike, rate, stuck, zero) and action.", None),
+    "garden_ingest_commit_duration_seconds": ("histogram", "Ingest writer group commit time (write + fsync).", LATENCY_BUCKETS),
+    "garden_ingest_commit_rows": ("histogram", "Rows per ingest writer group commit.", ROW_BUCKETS),
+    "garden_history_rows_scanned": ("histogram", "Rows read from storage per history query and level.", ROW_BUCKETS),
+    "garden_history_rows_returned": ("histogram", "Rows returned per history query and level, after downsampling.", ROW_BUCKETS),
+    "garden_dispatch_total": ("counter", "Side-effect deliveries by queue and outcome.", None),
+    "garden_errors_total": ("counter", "Error log records by subsystem.", None),
+    "garden_compaction_rows_total": ("counter", "Rows moved to the archive tier or dropped by retention.", None),
+}
+
+_lock = threading.Lock()
+_flush_lock = threading.RLock()  # one snapshot write at a time, none after exit
+_counters = {}    # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [bucket counts..., +Inf count, sum]
+_dirty = False
+_pid = None
+
+
+def _key(name, labels):
+    if name not in METRICS:
+        raise KeyError(f"undeclared metric: {name}")
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _ensure_flusher():
+    # threads don't survive fork: (re)start per process, dropping what the
+    # parent recorded (it's in the parent's snapshot)
+    global _pid, _dirty
+    if _pid == os.getpid():
+        return
+    _pid = os.getpid()
+    _counters.clear()
+    _histograms.clear()
+    _dirty = False
+    try:
+        retire(_pid)  # a snapshot under our pid is from a dead process
+    except OSError as e:
+        logging.getLogger("dashboard").warning(f"[metrics] retire failed: {e}")
+    threading.Thread(target=_flush_loop, name="metrics-flush", daemon=True).start()
+    atexit.register(_exit)
+
+
+def inc(name, value=1, **labels):
+    global _dirty
+    key = _key(name, labels)
+    with _lock:
+        _ensure_flusher()
+        _counters[key] = _counters.get(key, 0) + value
+        _dirty = True
+
+
+def observe(name, value, **labels):
+    global _dirty
+    key = _key(name, labels)
+    buckets = METRICS[name][2]
+    with _lock:
+        _ensure_flusher()
+        h = _histograms.get(key)
+        if h is None:
+            h = _histograms[key] = [0] * (len(buckets) + 2)
+        for i, le in enumerate(buckets):
+            if value <= le:
+                h[i] += 1
+                break
+        else:
+            h[len(buckets)] += 1
+        h[-1] += value
+        _dirty = True
+
+
+@contextmanager
+def timer(name, **labels):
+    """Observe the duration of the block in seconds (also when it raises)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+# -- snapshots ------------------------------------------------------------------
+
+def _snapshot():
+    with _lock:
+        return {
+            "counters": [[n, list(l), v] for (n, l), v in _counters.items()],
+            "histograms": [[n, list(l), list(h)] for (n, l), h in _histograms.items()],
+        }
+
+
+def flush():
+    """Write this process's snapshot now."""
+    global _dirty
+    with _flush_lock:
+        if _pid != os.getpid():
+            return  # nothing recorded in this process, or it is exiting
+        with _lock:
+            _dirty = False
+        data = json.dumps(_snapshot())
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        _write_json(os.path.join(METRICS_DIR, f"{os.getpid()}.json"), data)
+
+
+def _write_json(path, data):
+    fd, tmp = tempfile.mkstemp(prefix=".metrics-", dir=METRICS_DIR)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+@contextmanager
+def _dir_lock(kind):
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    with open(os.path.join(METRICS_DIR, LOCK), "a") as f:
+        fcntl.flock(f, kind)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _read_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None  # replaced or removed while listing
+
+
+def _add(counters, histograms, snap):
+    for n, labels, v in snap["counters"]:
+        key = (n, tuple(map(tuple, labels)))
+        counters[key] = counters.get(key, 0) + v
+    for n, labels, h in snap["histograms"]:
+        key = (n, tuple(map(tuple, labels)))
+        total = histograms.get(key)
+        histograms[key] = h if total is None else [a + b for a, b in zip(total, h)]
+
+
+def retire(pid):
+    """Fold the snapshot of an exited process into retired.json and remove it."""
+    path = os.path.join(METRICS_DIR, f"{pid}.json")
+    if not os.path.exists(path):
+        return
+    with _dir_lock(fcntl.LOCK_EX):
+        snap = _read_snapshot(path)
+        if snap is None:
+            return
+        counters, histograms = {}, {}
+        for p in (os.path.join(METRICS_DIR, RETIRED), path):
+            done = _read_snapshot(p)
+            if done is not None:
+                _add(counters, histograms, done)
+        _write_json(os.path.join(METRICS_DIR, RETIRED), json.dumps({
+            "counters": [[n, list(l), v] for (n, l), v in counters.items()],
+            "histograms": [[n, list(l), h] for (n, l), h in histograms.items()],
+        }))
+        os.unlink(path)
+
+
+def _exit():
+    global _pid
+    try:
+        with _flush_lock:
+            flush()
+            _pid = None  # no flush may recreate the snapshot after it is retired
+        retire(os.getpid())
+    except OSError:
+        pass
+
+
+def _flush_loop():
+    me = os.getpid()
+    while _pid == me:
+        time.sleep(FLUSH_INTERVAL)
+        if _dirty:
+            try:
+                flush()
+            except OSError as e:
+                logging.getLogger("dashboard").warning(f"[metrics] flush failed: {e}")
+
+
+def reset():
+    """Remove every snapshot (on server start, before workers exist)."""
+    try:
+        names = os.listdir(METRICS_DIR)
+    except FileNotFoundError:
+        return
+    for name in names:
+        try:
+            os.unlink(os.path.join(METRICS_DIR, name))
+        except OSError:
+            pass
+
+
+def _collect():
+    counters, histograms = {}, {}
+    if not os.path.isdir(METRICS_DIR):
+        return counters, histograms
+    with _dir_lock(fcntl.LOCK_SH):  # not halfway through a retire
+        for name in os.listdir(METRICS_DIR):
+            if name.endswith(".json"):
+                snap = _read_snapshot(os.path.join(METRICS_DIR, name))
+                if snap is not None:
+                    _add(counters, histograms, snap)
+    return counters, histograms
+
+
+# -- exposition -----------------------------------------------------------------
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+
+def _num(v):
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) and not float(v).is_integer() else str(int(v))
+
+
+def _file_sizes():
+    sizes = {}
+    try:
+        for entry in os.scandir(LOG_DIR):
+            if entry.is_file() and entry.name.endswith((".log", ".csv")):
+                sizes[entry.name] = entry.stat().st_size
+    except FileNotFoundError:
+        pass
+    return sizes
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.stat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def render():
+    """Every metric summed over all processes, in Prometheus text format 0.0.4."""
+    try:
+        flush()
+    except OSError:
+        pass
+    counters, histograms = _collect()
+    out = []
+    for name, (kind, help, buckets) in METRICS.items():
+        out.append(f"# HELP {name} {help}")
+        out.append(f"# TYPE {name} {kind}")
+        if kind == "counter":
+            for (n, labels), v in sorted(counters.items()):
+                if n == name:
+                    out.append(f"{name}{_labels(labels)} {_num(v)}")
+            continue
+        for (n, labels), h in sorted(histograms.items()):
+            if n != name:
+                continue
+            cumulative = 0
+            for le, count in zip(list(buckets) + [float("inf")], h):
+                cumulative += count
+                out.append(f"{name}_bucket{_labels(labels, [('le', _num(le))])} {cumulative}")
+            out.append(f"{name}_sum{_labels(labels)} {_num(h[-1])}")
+            out.append(f"{name}_count{_labels(labels)} {cumulative}")
+
+    out.append("# HELP garden_log_file_bytes Size of log and CSV files in LOG_DIR.")
+    out.append("# TYPE garden_log_file_bytes gauge")
+    for name, size in sorted(_file_sizes().items()):
+        out.append(f"garden_log_file_bytes{_labels([('file', name)])} {size}")
+    out.append("# HELP garden_storage_bytes Size of the segment, archive, rollup and stats stores (all devices) and the SQLite database.")
+    out.append("# TYPE garden_storage_bytes gauge")
+    try:
+        shards = [e.path for e in os.scandir(os.path.join(LOG_DIR, "devices")) if e.is_dir()]
+    except FileNotFoundError:
+        shards = []
+    for kind in ("segments", "archive", "rollups", "stats"):
+        size = sum(_dir_size(os.path.join(root, kind)) for root in [LOG_DIR] + shards)
+        out.append(f"garden_storage_bytes{_labels([('store', kind)])} {size}")
+    db = sum(os.path.getsize(p) for p in (SQLITE_DB, SQLITE_DB + "-wal") if os.path.exists(p))
+    out.append(f"garden_storage_bytes{_labels([('store', 'sqlite')])} {db}")
+    return "\n".join(out) + "\n"
+
+
+# -- error counter ----------------------------------------------------------------
+
+class ErrorCounter(logging.Handler):
+    """Counts ERROR records per subsystem: the "[tag]" the message starts with
+    (e.g. "[MQTT] ..." -> mqtt, "[dispatch:ntfy] ..." -> dispatch), else the
+    logger name."""
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+
+    def emit(self, record):
+        try:
+            msg = str(record.msg)
+            if msg.startswith("[") and "]" in msg[:32]:
+                subsystem = msg[1:msg.index("]")].split(":")[0].lower()
+            else:
+                subsystem = record.name
+            inc("garden_errors_total", subsystem=subsystem)
+        except Exception:
+            self.handleError(record)
+
+
+def count_errors(*loggers):
+    """Attach one ErrorCounter to each logger (by name; "" is the root logger)."""
+    handler = ErrorCounter()
+    for name in loggers:
+        logger = logging.getLogger(name)
+        if not any(isinstance(h, ErrorCounter) for h in logger.handlers):
+            logger.addHandler(handler)
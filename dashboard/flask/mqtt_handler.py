@@ -1,29 +1,186 @@
 # mqtt_handler.py
-import paho.mqtt.publish as publish
-import os
-import logging
+# One long-lived MQTT connection per worker process.
+#
+# The client is created lazily (after gunicorn forks), reconnects on its own
+# network thread, and buffers messages in a bounded offline queue while the
+# broker is unreachable. Per-metric topics and Home Assistant discovery
+# payloads are built once and re-announced on every (re)connect.
 import json
+import logging
+import os
+import threading
+from collections import deque
+
+import paho.mqtt.client as mqtt
+
+import metrics
+
+from storage import DEFAULT_DEVICE, METRICS, PRECISION
 
 logger = logging.getLogger("mqtt")
 
-def publish_mqtt(data):
-    try:
-        broker = os.getenv("MQTT_BROKER")
-        port = int(os.getenv("MQTT_PORT", 1883))
-        topic = os.getenv("MQTT_TOPIC", "garden/sensors")
+# metric -> (display name, unit, Home Assistant device_class)
+UNITS = {
+    "temp_f": ("Temperature", "°F", "temperature"),
+    "humidity": ("Humidity", "%", "humidity"),
+    "lux": ("Light", "lx", "illuminance"),
+    "moisture": ("Soil Moisture", "%", "moisture"),
+}
+
+
+def _env_flag(name, default="false"):
+    return os.getenv(name, default).strip().lower() in ("1", "true", "yes", "on")
+
+
+# Topics and payloads, shared with the async publisher of the FastAPI server.
+# Every message is a (topic, payload, retain) tuple.
+def state_topic(topic, device_id=DEFAULT_DEVICE):
+    return topic if device_id == DEFAULT_DEVICE else f"{topic}/device/{device_id}"
+
+
+def discovery_messages(topic, device_id=DEFAULT_DEVICE):
+    """Home Assistant discovery configs for one device's sensors."""
+    prefix = os.getenv("MQTT_DISCOVERY_PREFIX", "homeassistant").rstrip("/")
+    suffix = "" if device_id == DEFAULT_DEVICE else f"_{device_id}"
+    device = {
+        "identifiers": [f"garden_environment_sensor{suffix}"],
+        "name": "Garden Environment Sensor" + ("" if not suffix else f" ({device_id})"),
+    }
+    base = state_topic(topic, device_id)
+    messages = []
+    for m in METRICS:
+        name, unit, device_class = UNITS[m]
+        config = {
+            "name": name,
+            "unique_id": f"garden{suffix}_{m}",
+            "state_topic": f"{base}/{m}",
+            "unit_of_measurement": unit,
+            "device_class": device_class,
+            "state_class": "measurement",
+            "device": device,
+        }
+        messages.append((f"{prefix}/sensor/garden{suffix}_{m}/config", json.dumps(config), True))
+    return messages
+
+
+def reading_messages(topic, reading):
+    """The JSON state message of a reading, then one message per metric."""
+    base = state_topic(topic, reading.get("device_id") or DEFAULT_DEVICE)
+    yield base, json.dumps(reading), True
+    for m in METRICS:
+        if m in reading:
+            yield f"{base}/{m}", str(round(float(reading[m]), PRECISION[m])), True
+
+
+class MqttPublisher:
+    def __init__(self):
+        self.broker = os.getenv("MQTT_BROKER")
+        self.port = int(os.getenv("MQTT_PORT", 1883))
+        self.topic = os.getenv("MQTT_TOPIC", "garden/sensors").rstrip("/")
+        self.qos = int(os.getenv("MQTT_QOS", 0))
         user = os.getenv("MQTT_USER")
         password = os.getenv("MQTT_PASSWORD")
 
+        self.connected = False
+        self._lock = threading.Lock()
+        self._offline = deque(maxlen=int(os.getenv("MQTT_OFFLINE_QUEUE", 500)))
+        self._discovery_enabled = _env_flag("MQTT_DISCOVERY", "true")
+        self._discovery = {}  # device_id -> discovery messages, built once per device
+        if self._discovery_enabled:
+            self._discovery[DEFAULT_DEVICE] = self._build_discovery(DEFAULT_DEVICE)
+
+        client_id = f"garden-dashboard-{os.getpid()}"
+        if hasattr(mqtt, "CallbackAPIVersion"):  # paho-mqtt >= 2.0
+            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=client_id)
+        else:
+            self.client = mqtt.Client(client_id=client_id)
+        if user and password:
+            self.client.username_pw_set(user, password)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.reconnect_delay_set(min_delay=1, max_delay=60)
+
+    def start(self):
+        logger.info(f"[MQTT] Connecting to {self.broker}:{self.port}, topic={self.topic}, qos={self.qos}")
+        self.client.connect_async(self.broker, self.port, keepalive=60)
+        self.client.loop_start()
+
+    def stop(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+    def state_topic(self, device_id=DEFAULT_DEVICE):
+        return state_topic(self.topic, device_id)
+
+    def _build_discovery(self, device_id):
+        return discovery_messages(self.topic, device_id)
+
+    def _messages(self, reading):
+        device_id = reading.get("device_id") or DEFAULT_DEVICE
+        if self._discovery_enabled and device_id not in self._discovery:
+            # first reading from a new device: announce it once
+            self._discovery[device_id] = self._build_discovery(device_id)
+            yield from self._discovery[device_id]
+        yield from reading_messages(self.topic, reading)
+
+    def _send(self, topic, payload, retain):
+        info = self.client.publish(topic, payload=payload, qos=self.qos, retain=retain)
+        return info.rc == mqtt.MQTT_ERR_SUCCESS
 
-        if not broker:
-            logger.error("[MQTT] env variable missing!")
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            logger.error(f"[MQTT] Connect refused: {mqtt.connack_string(rc)}")
             return
+        with self._lock:
+            self.connected = True
+            for messages in self._discovery.values():
+                for msg in messages:
+                    self._send(*msg)
+            backlog = len(self._offline)
+            while self._offline:
+                if not self._send(*self._offline[0]):
+                    break
+                self._offline.popleft()
+        logger.info(f"[MQTT] Connected; flushed {backlog - len(self._offline)} queued messages")
 
-        auth = {'username': user, 'password': password} if user and password else None
-        payload = json.dumps(data)
-        logger.info(f"MQTT Broker: {broker}, Port: {port}, Topic: {topic}")
-        publish.single(topic, payload=payload, hostname=broker, port=port, auth=auth, retain=True)
-        logger.info(f"[MQTT] Published to {topic}: {payload}")
-    except Exception as e:
-        logger.error(f"[MQTT] Error publishing to MQTT: {e}")
-    
+    def _on_disconnect(self, client, userdata, rc):
+        self.connected = False
+        if rc != 0:
+            logger.warning(f"[MQTT] Disconnected unexpectedly (rc={rc}); will reconnect")
+
+    def publish(self, readings):
+        """Publish one reading or a batch; queues offline while disconnected."""
+        if isinstance(readings, dict):
+            readings = [readings]
+        with self._lock:
+            for reading in readings:
+                for msg in self._messages(reading):
+                    if not (self.connected and self._send(*msg)):
+                        if len(self._offline) == self._offline.maxlen:
+                            logger.warning("[MQTT] Offline queue full, dropping oldest message")
+                        self._offline.append(msg)
+
+
+_publisher = None
+_pid = None
+
+
+def get_publisher():
+    global _publisher, _pid
+    if _publisher is None or _pid != os.getpid():
+        _pid = os.getpid()
+        _publisher = MqttPublisher()
+        if _publisher.broker:
+            _publisher.start()
+    return _publisher
+
+
+def publish_mqtt(data):
+    if _env_flag("DISABLE_MQTT"):
+        return
+    publisher = get_publisher()
+    if not publisher.broker:
+        logger.error("[MQTT] env variable missing!")
+        return
+    with metrics.timer("garden_ingest_stage_duration_seconds", stage="mqtt"):
+        publisher.publish(data)
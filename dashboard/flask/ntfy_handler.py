@@ -1,9 +1,10 @@
 # ntfy_handler.py
 import os
-import requests
 import logging
 from dotenv import load_dotenv
 
+import metrics
+
 
 logger = logging.getLogger("ntfy")
 load_dotenv()
@@ -12,35 +13,56 @@ NTFY_TOKEN = os.getenv("NTFY_TOKEN")
 NTFY_HOST = os.getenv("NTFY_HOST", "").rstrip("/")
 NTFY_TOPIC = os.getenv("NTFY_TOPIC", "").rstrip("/")
 
-def send_ntfy_message(message, topic=NTFY_TOPIC, title="Garden Alert", priority="default"):
-    
+_session = None
+_session_pid = None
+
+
+def _get_session():
+  # keep-alive connection pool reused across notifications; `requests` is
+  # imported on first use and pooled sockets are never shared across fork
+  global _session, _session_pid
+  if _session is None or _session_pid != os.getpid():
+    import requests
+    from requests.adapters import HTTPAdapter
+    _session = requests.Session()
+    _session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+    _session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+    _session_pid = os.getpid()
+  return _session
+
+def ntfy_request(topic=NTFY_TOPIC, title="Garden Alert", priority="default"):
+  """(url, headers) of a notification, or None when ntfy isn't configured;
+  shared with the async client of the FastAPI server."""
   if not NTFY_HOST or not topic:
     logger.info("[ntfy] Skipping: NTFY_HOST or NTFY_TOPIC not configured.")
-    return
-    
-    
-  url = f"{NTFY_HOST}/{topic}"
+    return None
   headers = {
     "Authorization": f"Bearer {NTFY_TOKEN}",
     "Title": title,
     "Priority": priority
   }
+  return f"{NTFY_HOST}/{topic}", headers
 
-  try:
-    ## == [DEBUG] these can be commented out ==
-    logger.info(f"[ntfy] Host: {NTFY_HOST}")
-    logger.info(f"[ntfy] Sending message to {NTFY_HOST}/{topic}")
-    logger.info(f"[ntfy] Sending POST to {url}")
-    logger.info(f"[ntfy] Payload: {message}") 
-    
-    resp = requests.post(url, data=message.encode("utf-8"), headers=headers)
+
+def send_ntfy_message(message, topic=NTFY_TOPIC, title="Garden Alert", priority="default"):
     
+  request = ntfy_request(topic, title, priority)
+  if request is None:
+    return
+  url, headers = request
+
+  try:
+    logger.debug(f"[ntfy] Sending POST to {url}: {message}")
+
+    with metrics.timer("garden_ingest_stage_duration_seconds", stage="ntfy"):
+      resp = _get_session().post(url, data=message.encode("utf-8"), headers=headers, timeout=10)
+
     if resp.status_code != 200:
         logger.error(f"[ntfy] Failed with {resp.status_code}: {resp.text}")
     else:
-        logger.info(f"[ntfy] Message sent successfully: {resp.status_code}")
+        logger.info(f"[ntfy] Sent '{title}' to {topic}")
     resp.raise_for_status()
   
   except Exception as e:
     logger.error(f"[ntfy] Error: {e}")
-
+    raise  # let the dispatcher retry
@@ -0,0 +1,163 @@
+# pipeline.py
+# The ingest pipeline behind POST /api/sensor and /api/sensor/batch, shared
+# by the Flask routes and the async FastAPI server (dashboard/fastapi):
+#   parse/validate -> detect (anomaly.py) -> write (ingest_writer.py)
+#   -> latest, rollup, stats -> stream -> dispatch (MQTT, ntfy)
+# Every stage is timed in garden_ingest_stage_duration_seconds. The parsers
+# raise ValueError with the message the API returns; the derived-state
+# stages log and carry on, so a failing rollup never fails the request.
+import json
+import logging
+from datetime import datetime
+
+import anomaly
+import daily_stats
+import latest_store
+import metrics
+from dispatch import dispatch_readings
+from log_cleaner import out_of_range
+from rollups import update as update_rollups
+from sensor_utils import validate_readings
+from settings import INGEST_RANGE_CHECK
+from storage import DEFAULT_DEVICE, METRICS
+from stream_hub import hub as stream_hub
+
+logger = logging.getLogger("dashboard")
+
+BATCH_MAX = 5000
+NDJSON_TYPES = ("application/x-ndjson", "application/jsonl", "application/ndjson")
+
+
+def stage(name):
+    return metrics.timer("garden_ingest_stage_duration_seconds", stage=name)
+
+
+def parse_reading(data):
+    """One POST /api/sensor payload (device_id already checked) -> a reading
+    stamped now. Raises ValueError."""
+    def num(field):
+        v = data.get(field, None)
+        # treat None/"" as invalid
+        if v is None or (isinstance(v, str) and v.strip() == ""):
+            raise ValueError(f"{field} is missing or null")
+        try:
+            return float(v)
+        except (ValueError, TypeError):
+            raise ValueError(f"{field} must be numeric")
+
+    reading = {
+        "timestamp": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "device_id": data.get("device_id") or DEFAULT_DEVICE,
+        **{m: num(m) for m in METRICS},
+    }
+    implausible = INGEST_RANGE_CHECK and out_of_range(reading)
+    if implausible:
+        raise ValueError(implausible)
+    return reading
+
+
+def parse_batch(body, ndjson=False):
+    """A batch body (bytes) -> (items, rejected): a JSON array, {"readings": [...]}
+    or NDJSON lines, where unparseable lines are rejected by index. Raises
+    ValueError for a body that isn't a batch at all."""
+    items, rejected = [], []
+    if ndjson:
+        lines = [l for l in body.decode("utf-8", "replace").splitlines() if l.strip()]
+        for i, line in enumerate(lines):
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(None)
+                rejected.append({"index": i, "error": "invalid JSON"})
+        return items, rejected
+    try:
+        parsed = json.loads(body) if body else None
+    except ValueError:
+        parsed = None
+    if isinstance(parsed, dict):
+        parsed = parsed.get("readings")
+    if not isinstance(parsed, list):
+        raise ValueError("Expected a JSON array of readings")
+    return parsed, rejected
+
+
+def validate_batch(items, rejected):
+    """Validate parsed batch items -> (rows sorted by time, rejected by index);
+    `rejected` holds the parse errors from parse_batch."""
+    parse_errors = {r["index"] for r in rejected}
+    with stage("validate"):
+        rows, invalid = validate_readings(items)
+    rejected = sorted(rejected + [r for r in invalid if r["index"] not in parse_errors], key=lambda r: r["index"])
+    if rejected:
+        metrics.inc("garden_ingest_rows_total", len(rejected), outcome="rejected")
+    return rows, rejected
+
+
+def detect(rows):
+    """Run the anomaly detector (see anomaly.py) over validated rows: (rows to
+    write, [(row, reasons)]). A detector failure lets everything through."""
+    try:
+        with stage("detect"):
+            kept, flagged = anomaly.screen(rows)
+    except Exception as e:
+        logger.error(f"[ANOMALY] detection failed: {e}")
+        return rows, []
+    if flagged and anomaly.MODE == "quarantine":
+        metrics.inc("garden_ingest_rows_total", len(flagged), outcome="quarantined")
+    return kept, flagged
+
+
+def flagged_summary(flagged):
+    return [{"timestamp": r["timestamp"], "device_id": r.get("device_id") or DEFAULT_DEVICE, "anomalies": reasons}
+            for r, reasons in flagged]
+
+
+def batch_result(written, rejected, flagged, duplicates=0):
+    """The data of a /api/sensor/batch response."""
+    data = {"accepted": len(written), "rejected": rejected}
+    if duplicates:
+        data["duplicates"] = duplicates  # already stored for that device and second (sqlite)
+    if flagged:
+        data["quarantined" if anomaly.MODE == "quarantine" else "flagged"] = flagged_summary(flagged)
+    return data
+
+
+def update_derived(rows):
+    """Latest reading, rollups and daily stats for rows that were just
+    persisted (sorted by time)."""
+    try:
+        with stage("latest"):
+            latest_store.record(rows)
+    except Exception as e:
+        logger.error(f"[LATEST] update failed: {e}")
+
+    try:
+        with stage("rollup"):
+            update_rollups(rows)
+    except Exception as e:
+        logger.error(f"[ROLLUP] update failed: {e}")
+
+    try:
+        with stage("stats"):
+            daily_stats.update(rows)
+    except Exception as e:
+        logger.error(f"[STATS] update failed: {e}")
+
+
+def publish(rows):
+    try:
+        with stage("stream"):
+            stream_hub.publish(rows)
+    except Exception as e:
+        logger.error(f"[STREAM] publish failed: {e}")
+
+
+def after_write(rows):
+    """Derived state and side effects for rows that were just persisted (sorted by time)."""
+    update_derived(rows)
+    publish(rows)
+    # side-effects run in the background and should not crash the request
+    try:
+        dispatch_readings(rows)
+    except Exception as e:
+        logger.error(f"[DISPATCH] enqueue failed: {e}")
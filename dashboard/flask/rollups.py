@@ -0,0 +1,274 @@
+# rollups.py
+# Incrementally maintained 1m / 1h / 1d aggregates of every metric.
+#
+# Each level is a file of fixed-size records sorted by bucket start:
+#   logs/rollups/1h.bin -> (t, n, last_t, <metric>_sum/_min/_max/_last ...)
+# Ingest folds new readings into the matching buckets in place (normally the
+# last record), so long-range history reads a few hundred aggregates instead
+# of every raw row. Run `python rollups.py rebuild` to backfill from storage.
+#
+# A device's levels only count as complete (a `complete` marker next to them)
+# once they were rebuilt, or started on an empty store; until then
+# pick_level serves raw rows, so an upgrade with existing logs never hides
+# the readings from before it. Retention (compaction.py) prunes the buckets
+# that end before its cutoff.
+#
+# With STORAGE_BACKEND=sqlite the same records live in rollup_<level> tables
+# that the writer updates in its insert transaction (see sqlite_store.py), so
+# `update` has nothing left to do and reads come from the database.
+import fcntl
+import logging
+import os
+import sys
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import numpy as np
+
+import storage
+from settings import ROLLUP_DIR, STORAGE_BACKEND
+from storage import DEFAULT_DEVICE, METRICS
+
+logger = logging.getLogger(__name__)
+
+LEVELS = {"1m": 60, "1h": 3600, "1d": 86400}
+
+# auto level selection: raw rows up to this span, then the finest level
+# that keeps the bucket count under ROLLUP_MAX_POINTS
+RAW_MAX_SPAN = 86400
+ROLLUP_MAX_POINTS = 2000
+
+_fields = [("t", "<i8"), ("n", "<i8"), ("last_t", "<i8")]
+for _m in METRICS:
+    _fields += [(f"{_m}_sum", "<f8"), (f"{_m}_min", "<f4"), (f"{_m}_max", "<f4"), (f"{_m}_last", "<f4")]
+RECORD = np.dtype(_fields)
+
+
+def level_path(level, device=DEFAULT_DEVICE):
+    root = ROLLUP_DIR if device == DEFAULT_DEVICE else os.path.join(storage.device_root(device), "rollups")
+    return os.path.join(root, f"{level}.bin")
+
+
+def complete_path(device=DEFAULT_DEVICE):
+    return os.path.join(os.path.dirname(level_path("1d", device)), "complete")
+
+
+def is_complete(device=DEFAULT_DEVICE):
+    """Whether the levels hold every stored reading of `device`."""
+    return STORAGE_BACKEND == "sqlite" or os.path.exists(complete_path(device))
+
+
+def _mark_complete(device):
+    path = complete_path(device)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(storage.format_ts(int(datetime.now(timezone.utc).timestamp())) + "\n")
+
+
+@contextmanager
+def _locked(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def aggregate(cols, width):
+    """Collapse columns into one record per `width`-second bucket."""
+    t = cols["t"]
+    if len(t) == 0:
+        return np.zeros(0, dtype=RECORD)
+    b = t // width * width
+    order = np.lexsort((t, b))
+    b, t = b[order], t[order]
+    starts = np.flatnonzero(np.r_[True, b[1:] != b[:-1]])
+    ends = np.r_[starts[1:], len(b)] - 1
+
+    out = np.zeros(len(starts), dtype=RECORD)
+    out["t"] = b[starts]
+    out["n"] = ends - starts + 1
+    out["last_t"] = t[ends]
+    for m in METRICS:
+        v = cols[m][order].astype(np.float64)
+        out[f"{m}_sum"] = np.add.reduceat(v, starts)
+        out[f"{m}_min"] = np.minimum.reduceat(v, starts)
+        out[f"{m}_max"] = np.maximum.reduceat(v, starts)
+        out[f"{m}_last"] = v[ends]
+    return out
+
+
+def merge(a, b):
+    """Combine two aligned record arrays covering the same buckets."""
+    out = a.copy()
+    out["n"] = a["n"] + b["n"]
+    newer = b["last_t"] >= a["last_t"]
+    out["last_t"] = np.where(newer, b["last_t"], a["last_t"])
+    for m in METRICS:
+        out[f"{m}_sum"] = a[f"{m}_sum"] + b[f"{m}_sum"]
+        out[f"{m}_min"] = np.minimum(a[f"{m}_min"], b[f"{m}_min"])
+        out[f"{m}_max"] = np.maximum(a[f"{m}_max"], b[f"{m}_max"])
+        out[f"{m}_last"] = np.where(newer, b[f"{m}_last"], a[f"{m}_last"])
+    return out
+
+
+def _apply(level, agg, device=DEFAULT_DEVICE):
+    path = level_path(level, device)
+    with _locked(path):
+        n = os.path.getsize(path) // RECORD.itemsize if os.path.exists(path) else 0
+        if n:
+            existing = np.memmap(path, dtype=RECORD, mode="r+", shape=(n,))
+            last = existing["t"][-1]
+            old, agg = agg[agg["t"] <= last], agg[agg["t"] > last]
+            if len(old):
+                idx = np.searchsorted(existing["t"], old["t"])
+                found = existing["t"][idx] == old["t"]
+                if found.any():
+                    existing[idx[found]] = merge(existing[idx[found]], old[found])
+                    existing.flush()
+                if not found.all():
+                    # backfilled bucket that doesn't exist yet: rare, rewrite the level
+                    combined = np.concatenate([np.asarray(existing), old[~found], agg])
+                    del existing
+                    combined.sort(order="t", kind="stable")
+                    tmp = path + ".tmp"
+                    combined.tofile(tmp)
+                    os.replace(tmp, path)
+                    return
+            del existing
+        if len(agg):
+            with open(path, "ab") as f:
+                f.write(agg.tobytes())
+
+
+def update(rows):
+    """Fold one reading (dict) or a list of readings into every level."""
+    if STORAGE_BACKEND == "sqlite":
+        return  # folded in by the insert
+    if isinstance(rows, dict):
+        rows = [rows]
+    for device, group in storage.group_by_device(rows).items():
+        cols = {"t": np.array([storage.to_epoch(r["timestamp"]) for r in group], dtype=np.int64)}
+        for m in METRICS:
+            cols[m] = np.array([float(r.get(m, 0) or 0) for r in group], dtype=np.float64)
+        if not os.path.exists(level_path("1d", device)) and not is_complete(device):
+            # first fold for this device: complete only if nothing older is stored
+            if not len(storage.read_range(None, int(cols["t"].min()), device)["t"]):
+                _mark_complete(device)
+            else:
+                logger.warning(f"[rollups] {device}: existing readings aren't rolled up; "
+                               "serving raw rows until `python rollups.py rebuild`")
+        for level, width in LEVELS.items():
+            _apply(level, aggregate(cols, width), device)
+
+
+def read_records(level, start=None, end=None, device=DEFAULT_DEVICE):
+    if STORAGE_BACKEND == "sqlite":
+        import sqlite_store  # imports this module
+        return sqlite_store.read_records(level, start, end, device)
+    path = level_path(level, device)
+    n = os.path.getsize(path) // RECORD.itemsize if os.path.exists(path) else 0
+    if not n:
+        return np.zeros(0, dtype=RECORD)
+    mm = np.memmap(path, dtype=RECORD, mode="r", shape=(n,))
+    t = mm["t"]
+    lo = int(np.searchsorted(t, start // LEVELS[level] * LEVELS[level])) if start is not None else 0
+    hi = int(np.searchsorted(t, end)) if end is not None else n
+    return np.array(mm[lo:hi])
+
+
+def bucket_means(recs):
+    """Per-bucket means in the same column layout as storage.read_range."""
+    n = np.maximum(recs["n"], 1)
+    cols = {"t": recs["t"].astype(np.int64)}
+    for m in METRICS:
+        cols[m] = (recs[f"{m}_sum"] / n).astype(np.float32)
+    return cols
+
+
+def read_level(level, start=None, end=None, device=DEFAULT_DEVICE):
+    return bucket_means(read_records(level, start, end, device))
+
+
+def summarize(recs):
+    """Reading count and per-metric mean/min/max over a run of buckets, from
+    their sums and counts (not the bucket means)."""
+    n = int(recs["n"].sum())
+    out = {"n": n}
+    for m in METRICS:
+        out[m] = None if not n else {
+            "mean": round(float(recs[f"{m}_sum"].sum()) / n, 3),
+            "min": round(float(recs[f"{m}_min"].min()), 3),
+            "max": round(float(recs[f"{m}_max"].max()), 3),
+        }
+    return out
+
+
+def first_timestamp(device=DEFAULT_DEVICE):
+    recs = read_records("1d", device=device)
+    return int(recs["t"][0]) if len(recs) else None
+
+
+def pick_level(start, end=None, now=None, device=DEFAULT_DEVICE):
+    """Choose "raw" or a rollup level for the window [start, end); always
+    "raw" while the device's levels aren't complete."""
+    if not is_complete(device):
+        return "raw"
+    now = now if now is not None else int(datetime.now(timezone.utc).timestamp())
+    if start is None:
+        start = first_timestamp(device)
+        if start is None:
+            return "raw"
+    span = (end if end is not None else now) - start
+    if span <= RAW_MAX_SPAN:
+        return "raw"
+    for level, width in LEVELS.items():
+        if span / width <= ROLLUP_MAX_POINTS:
+            return level
+    return "1d"
+
+
+def prune(before, device=DEFAULT_DEVICE):
+    """Drop the buckets that end at or before `before` from every level of a
+    device (retention). Returns the number of buckets removed."""
+    if STORAGE_BACKEND == "sqlite":
+        return 0  # sqlite_store.prune deletes them with the readings
+    removed = 0
+    for level, width in LEVELS.items():
+        path = level_path(level, device)
+        with _locked(path):
+            recs = read_records(level, device=device)
+            keep = recs["t"] + width > before
+            if keep.all():
+                continue
+            recs[keep].tofile(path + ".tmp")
+            os.replace(path + ".tmp", path)
+            removed += int((~keep).sum())
+    return removed
+
+
+def rebuild():
+    """Recompute every level of every device from storage. Run it while ingest is stopped."""
+    if STORAGE_BACKEND == "sqlite":
+        import sqlite_store
+        return sqlite_store.rebuild_rollups(sqlite_store.connect())
+    total = 0
+    for device in storage.list_devices():
+        cols = storage.read_range(device=device)
+        for level, width in LEVELS.items():
+            path = level_path(level, device)
+            with _locked(path):
+                aggregate(cols, width).tofile(path + ".tmp")
+                os.replace(path + ".tmp", path)
+        _mark_complete(device)
+        total += len(cols["t"])
+    return total
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["rebuild"]:
+        print("usage: python rollups.py rebuild")
+        sys.exit(1)
+    print(f"rebuilt rollups from {rebuild()} readings")
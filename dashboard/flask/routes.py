@@ -1,33 +1,52 @@
-from flask import Flask, jsonify, request, render_template, Blueprint, current_app as app
-from ntfy_handler import send_ntfy_message
-from mqtt_handler import publish_mqtt
-from sensor_utils import format_sensor_data, load_log_data, write_csv_log, get_today_logfile, get_latest_logfile
-from settings import RAW_LOG_FILE, CONFIG_FILE
-from shared import latest_data, api_response, load_config, save_config
+from flask import Response, g, request, render_template, Blueprint, current_app as app
+from sensor_utils import history_etag, parse_history_args, query_history, write_csv_log
+from settings import STORAGE_BACKEND
+from shared import api_response, apply_config_update, compress_response, config_etag, config_version, load_config, validate_config_update
+import anomaly
+import daily_stats
+import latest_store
+import metrics
+import pipeline
+from stream_hub import KEEPALIVE as STREAM_KEEPALIVE, frame as sse_frame, hub as stream_hub
+from storage import DEFAULT_DEVICE, list_devices, valid_device
 import logging
-from datetime import datetime, timezone
-import os, json, tempfile
-import pandas as pd
+from datetime import datetime
+import json, time
 
 routes = Blueprint('routes', __name__)
 logger = logging.getLogger('dashboard')
+routes.after_request(compress_response)
+
+
+@routes.before_app_request
+def _start_timer():
+    g.request_start = time.perf_counter()
+
+
+@routes.after_app_request
+def _record_request(resp):
+    # runs after compress_response, so the timing includes encoding; for
+    # /api/stream it covers only setting up the stream
+    start = g.pop("request_start", None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        metrics.observe("garden_http_request_duration_seconds", time.perf_counter() - start,
+                        route=route, method=request.method)
+        metrics.inc("garden_http_requests_total", route=route, method=request.method, status=resp.status_code)
+    return resp
 
 
 # [GET] /dashboard ---------------------------------------------------------
 @routes.route("/dashboard")
 def dashboard():
-    log_file = get_latest_logfile()
-    if not os.path.exists(log_file):
-        return "Sensor log not found", 404
-    
-    df = pd.read_csv(log_file)
-    df["timestamp"] = pd.to_datetime(df["timestamp"])
+    # the page fetches its data from /api/history; nothing to read here
     return render_template("dashboard.html", year=datetime.now().year)
 
 
 # [GET] /api/sensor  --------------------------------------------------------
 @routes.route("/api/sensor", methods=["GET"])
 def get_sensor_data():
+    latest_data = latest_store.read(request.args.get("device", DEFAULT_DEVICE))
     if latest_data is None:
         return api_response("error", "No data received yet", http_status=200)
 
@@ -35,6 +54,7 @@ def get_sensor_data():
         dt = datetime.fromisoformat(latest_data["timestamp"].replace("Z", ""))
         formatted = {
             "timestamp": dt.isoformat(),
+            "device_id": latest_data["device_id"],
             "display_time": dt.strftime("%-m/%-d/%y %I:%M %p"),
             "temp_f": float(latest_data["temp_f"]),
             "humidity": float(latest_data["humidity"]),
@@ -52,57 +72,91 @@ def get_sensor_data():
 def post_sensor_data():
     try:
         if not request.is_json:
-            return api_response("error", "Content-Type must be application/json", 400)
+            return api_response("error", "Content-Type must be application/json", http_status=400)
 
         data = request.get_json(silent=True)
-        if not data:
-            return api_response("error", "Invalid or missing JSON payload", 400)
-
-        required = ("temp_f", "humidity", "lux", "moisture")
+        if not data or not isinstance(data, dict):
+            return api_response("error", "Invalid or missing JSON payload", http_status=400)
 
-        def num(field):
-            v = data.get(field, None)
-            # treat None/"" as invalid
-            if v is None or (isinstance(v, str) and v.strip() == ""):
-                raise ValueError(f"{field} is missing or null")
-            try:
-                return float(v)
-            except (ValueError, TypeError):
-                raise ValueError(f"{field} must be numeric")
+        started = time.perf_counter()
+        device_id = data.get("device_id") or DEFAULT_DEVICE
+        if not valid_device(device_id):
+            return api_response("error", "device_id must be 1-32 letters, digits, '-' or '_'", http_status=400)
 
         try:
-            latest_data = {
-                "timestamp": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
-                "temp_f":  num("temp_f"),
-                "humidity": num("humidity"),
-                "lux":      num("lux"),
-                "moisture": num("moisture"),
-            }
+            latest_data = pipeline.parse_reading(data)
         except ValueError as ve:
             logger.error(f"[API] /api/sensor validation error: {ve}; payload={data}")
-            return api_response("error", str(ve), 400)
+            metrics.inc("garden_ingest_rows_total", outcome="rejected")
+            return api_response("error", str(ve), http_status=400)
+        metrics.observe("garden_ingest_stage_duration_seconds", time.perf_counter() - started, stage="validate")
 
-        # side-effects should not crash the request
-        try:
-            publish_mqtt(latest_data)
-        except Exception as e:
-            logger.error(f"[MQTT] publish failed: {e}")
-
-        try:
-            send_ntfy_message(format_sensor_data(latest_data))
-        except Exception as e:
-            logger.error(f"[NTFY] send failed: {e}")
+        kept, flagged = pipeline.detect([latest_data])
+        anomalies = flagged[0][1] if flagged else None
+        if not kept:
+            return api_response("ok", data={"received": True, "quarantined": True, "anomalies": anomalies})
 
         try:
-            write_csv_log(latest_data)
+            with pipeline.stage("write"):
+                stored = write_csv_log(latest_data)
         except Exception as e:
             logger.error(f"[CSV] write failed: {e}")
-            return api_response("error", "Failed to write log", 500)
-
-        return api_response("ok", data={"received": True})
-    except Exception as e:
+            return api_response("error", "Failed to write log", http_status=500)
+
+        if not stored:
+            metrics.inc("garden_ingest_rows_total", outcome="duplicate")
+            return api_response("ok", data={"received": True, "duplicate": True})
+        pipeline.after_write(stored)
+        metrics.inc("garden_ingest_rows_total", outcome="accepted")
+        return api_response("ok", data={"received": True, "anomalies": anomalies} if anomalies else {"received": True})
+    except Exception:
         logger.exception("[API] /api/sensor unhandled")
-        return api_response("error", "internal error", 500)
+        return api_response("error", "internal error", http_status=500)
+
+
+
+# [POST] /api/sensor/batch  -------------------------------------------------
+@routes.route("/api/sensor/batch", methods=["POST"])
+def post_sensor_batch():
+    """Accept a JSON array (or {"readings": [...]}) or an NDJSON body of readings."""
+    try:
+        if request.mimetype not in pipeline.NDJSON_TYPES and not request.is_json:
+            return api_response("error", "Content-Type must be application/json or application/x-ndjson", http_status=400)
+        try:
+            items, rejected = pipeline.parse_batch(request.get_data(), ndjson=request.mimetype in pipeline.NDJSON_TYPES)
+        except ValueError as e:
+            return api_response("error", str(e), http_status=400)
+
+        if not items:
+            return api_response("error", "No readings in batch", http_status=400)
+        if len(items) > pipeline.BATCH_MAX:
+            return api_response("error", f"Batch too large (max {pipeline.BATCH_MAX} readings)", http_status=413)
+
+        rows, rejected = pipeline.validate_batch(items, rejected)
+        if not rows:
+            return api_response("error", "No valid readings in batch", http_status=400, data={"accepted": 0, "rejected": rejected})
+        if rejected:
+            logger.warning(f"[API] /api/sensor/batch rejected {len(rejected)} of {len(items)} readings")
+
+        rows, flagged = pipeline.detect(rows)
+        stored = rows
+        if rows:
+            try:
+                with pipeline.stage("write"):
+                    stored = write_csv_log(rows)
+            except Exception as e:
+                logger.error(f"[CSV] batch write failed: {e}")
+                return api_response("error", "Failed to write log", http_status=500)
+
+            if stored:
+                pipeline.after_write(stored)
+            metrics.inc("garden_ingest_rows_total", len(stored), outcome="accepted")
+            if len(stored) < len(rows):
+                metrics.inc("garden_ingest_rows_total", len(rows) - len(stored), outcome="duplicate")
+        return api_response("ok", data=pipeline.batch_result(stored, rejected, flagged, len(rows) - len(stored)))
+    except Exception:
+        logger.exception("[API] /api/sensor/batch unhandled")
+        return api_response("error", "internal error", http_status=500)
 
 
 # ---------------------------------------------------------------------------
@@ -113,7 +167,14 @@ def post_sensor_data():
 @routes.route("/api/config", methods=["GET", "POST"])
 def config_handler():
     if request.method == "GET":
-        return api_response(data=load_config())
+        # sleeping devices revalidate with If-None-Match (or ?version=N) and get
+        # an empty 304 while nothing changed
+        etag = config_etag()
+        if request.if_none_match.contains(etag) or request.args.get("version") == str(config_version()):
+            return Response(status=304, headers={"ETag": f'"{etag}"'})
+        resp, status = api_response(data=load_config())
+        resp.set_etag(etag)
+        return resp, status
 
     try:
         new_cfg = request.get_json(silent=True)
@@ -121,54 +182,11 @@ def config_handler():
             logger.error("[API] /api/config: No JSON body found")
             return api_response("error", "No JSON Found", http_status=400)
 
-        # Schema: sleep in seconds, plus other config keys
-        validators = {
-            "sleep":        lambda v: (int(v), 1, 6000),  # 1s to 6000s
-            "ssid":         lambda v: (str(v), None, None),
-            "password":     lambda v: (str(v), None, None),
-            "mqtt_broker":  lambda v: (str(v), None, None),
-            "mqtt_port":    lambda v: (int(v), 1, 65535),
-        }
-
-        validated = {}
-
-        # Backward-compat: accept polling_interval and convert → sleep (seconds)
-        if "polling_interval" in new_cfg and "sleep" not in new_cfg:
-            try:
-                val = int(new_cfg["polling_interval"])
-                if val > 6000:  # probably ms
-                    val //= 1000
-                val = max(1, min(6000, val))
-                validated["sleep"] = val
-            except Exception:
-                pass
-
-        # Validate all known keys
-        for key, fn in validators.items():
-            if key in new_cfg:
-                try:
-                    val, lo, hi = fn(new_cfg[key])
-                    if lo is not None and val < lo:
-                        return api_response("error", f"{key} must be >= {lo}", 400)
-                    if hi is not None and val > hi:
-                        return api_response("error", f"{key} must be <= {hi}", 400)
-                    validated[key] = val
-                except (ValueError, TypeError):
-                    return api_response("error", f"Invalid value for {key}", 400)
-
-        # Load current config, update with validated values
-        config = load_config()
-        config.update(validated)
-
-        # Bump version if anything changed
-        if validated:
-            old_ver = int(config.get("config_version", 0))
-            config["config_version"] = old_ver + 1
-            from datetime import datetime, timezone
-            config["updated_at"] = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
-
-        # Save (atomic if helper is in place)
-        save_config(config)
+        try:
+            validated = validate_config_update(new_cfg)
+        except ValueError as e:
+            return api_response("error", str(e), http_status=400)
+        config = apply_config_update(validated)
 
         return api_response("ok", data=config)
 
@@ -176,37 +194,128 @@ def config_handler():
         logger.error(f"[API] Exception in /api/config: {e}")
         return api_response("error", str(e), http_status=500)
 
+
+# [GET] /api/config/version  ------------------------------------------------
+@routes.route("/api/config/version")
+def config_version_handler():
+    resp, status = api_response(data={"config_version": config_version()})
+    resp.set_etag(config_etag())
+    return resp, status
+
 # ---------------------------------------------------------------------------
 
+# /api/devices  -------------------------------------------------------------
+@routes.route("/api/devices")
+def get_devices():
+    latest = latest_store.read_all()
+    devices = sorted(set(list_devices()) | set(latest))
+    return api_response(data=[{"device_id": d, "latest": latest.get(d)} for d in devices])
+
+
+# /api/stats  --------------------------------------------------------------
+# Daily VPD, DLI, GDD and mean/std/min/max per metric, with rolling mean/std
+# over ?window= days, from the per-day accumulators in daily_stats.py:
+# ?days=7 (ending today) or ?from=YYYY-MM-DD&to=YYYY-MM-DD, ?base=50&cap=86
+# (°F, cap=none to disable) for GDD and ?season=YYYY-MM-DD (default Jan 1)
+# for the season's GDD total.
+@routes.route("/api/stats")
+def get_stats():
+    try:
+        q = daily_stats.parse_query(request.args)
+    except ValueError as e:
+        return api_response("error", str(e), http_status=400)
+
+    etag = _history_etag([q["device"]], relative=True)
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers={"ETag": f'W/"{etag}"', "Cache-Control": "no-cache"})
+    return _with_etag(api_response(data=daily_stats.query(q)), etag)
+
+
+# /api/anomalies  ----------------------------------------------------------
+# Anomaly counts per device and metric from the ingest detector, with its
+# current EWMA mean/std and the last anomaly seen. ?device= for one device.
+@routes.route("/api/anomalies")
+def get_anomalies():
+    device = request.args.get("device")
+    if device is not None and not valid_device(device):
+        return api_response("error", "device must be 1-32 letters, digits, '-' or '_'", http_status=400)
+    return api_response(data={"mode": anomaly.MODE, "devices": anomaly.summary(device)})
+
+
+# /api/stream  --------------------------------------------------------------
+# Server-Sent Events: an "event: reading" frame per accepted reading (newest
+# per device for batches). ?device= limits it to one device. Each connection
+# holds one greenlet under the gevent worker.
+@routes.route("/api/stream")
+def stream():
+    device = request.args.get("device")
+    if device is not None and not valid_device(device):
+        return api_response("error", "invalid device", http_status=400)
+
+    sub = stream_hub.subscribe(device)
+    current = latest_store.read_all()
+    if device is not None:
+        current = {device: current[device]} if device in current else {}
+
+    def events():
+        try:
+            yield b"retry: 5000\n\n"
+            for reading in current.values():
+                yield sse_frame("reading", json.dumps(reading))
+            while True:
+                frames = sub.get(timeout=STREAM_KEEPALIVE)
+                # a comment line keeps proxies from timing out idle streams
+                yield b"".join(frames) if frames else b": keepalive\n\n"
+        finally:
+            sub.close()
+
+    return Response(events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# /metrics  -----------------------------------------------------------------
+# Prometheus text format, summed over every worker and the ingest writer
+@routes.route("/metrics")
+def metrics_handler():
+    return Response(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 # /api/status 
 @routes.route("/api/status")
 def status():
     return api_response(message="API is running!")
 
 # /api/history  -------------------------------------------------------------
-@routes.route("/api/history")
-def get_history():
-
+def _history_etag(devices, relative):
+    return history_etag(request.query_string.decode(), devices, relative)
 
 
-    filter_range = request.args.get("filter_range", "24h")
-    day_param = request.args.get("day")  # optional
-
-    log_path = RAW_LOG_FILE
+@routes.route("/api/history")
+def get_history():
     try:
-        size = os.path.getsize(log_path)
-    except Exception:
-        size = -1
-    app.logger.info(f"[API] /history using this logfile: {log_path} ({size} bytes), filter_range={filter_range}, day={day_param}")
+        q = parse_history_args(request.args)
+    except ValueError as e:
+        return api_response("error", str(e), http_status=400)
 
+    app.logger.info(f"[API] /history backend={STORAGE_BACKEND}, filter_range={q['filter_range']}, day={q['day']}, device={','.join(q['devices'])}")
 
+    # answered from the write version alone: no log read for unchanged data
+    etag = _history_etag(q["devices"], relative=q["relative"])
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers={"ETag": f'W/"{etag}"', "Cache-Control": "no-cache"})
 
-    data, error = load_log_data(filter_range=filter_range, day=day_param)
+    data, extra, error = query_history(q)
     if error:
         logger.error(f"[API] /api/history error: {error}")
         return api_response("error", error, http_status=404)
+    return _with_etag(api_response(data=data, **extra), etag)
+
 
-    return api_response(data=data)
+def _with_etag(result, etag):
+    resp, status = result
+    resp.set_etag(etag, weak=True)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp, status
 
 
 # ---------------------------------------------------------------------------
@@ -1,18 +1,98 @@
+import hashlib
 import logging
-import os, csv
+import time
 from datetime import datetime, timedelta, timezone
-from settings import LOG_DIR, RAW_LOG_FILE
+from settings import INGEST_RANGE_CHECK
+import rollups
+import numpy as np
+import storage
+import ingest_writer
+import journal
+import latest_store
+import log_cleaner
+import metrics
+from downsample import METHODS as DOWNSAMPLE_METHODS, downsample
 
 logger = logging.getLogger(__name__)
 
 
-def validate_sensor_data(data):
-    required_keys = ["temp_f", "humidity", "lux", "moisture"]
-    for key in required_keys:
-        if key not in data:
-            logger.warning(f"[sensor] Missing key: {key}")
-            return False
-    return True
+MAX_CLOCK_SKEW = 300  # seconds a device clock may run ahead of the server
+
+def _coerce(values):
+    """Vectorized float coercion; None, "" and non-numeric values become NaN."""
+    try:
+        return np.array(values, dtype=np.float64)
+    except (ValueError, TypeError):
+        out = np.full(len(values), np.nan)
+        for i, v in enumerate(values):
+            try:
+                out[i] = float(v)
+            except (ValueError, TypeError):
+                pass
+        return out
+
+def validate_readings(items, now=None):
+    """Validate a batch of reading dicts in one pass.
+
+    Each item needs numeric temp_f/humidity/lux/moisture (within the
+    plausible ranges of log_cleaner.RANGES if INGEST_RANGE_CHECK) and may carry a
+    "timestamp" (ISO string or epoch seconds; missing timestamps get `now`)
+    and a "device_id" (defaults to "default").
+    Returns (rows, rejected) where rows are normalized reading dicts and
+    rejected is a list of {"index", "error"}.
+    """
+    now = int(now if now is not None else datetime.now(timezone.utc).timestamp())
+    n = len(items)
+    ok = np.array([isinstance(it, dict) for it in items], dtype=bool)
+    reasons = {i: "reading must be a JSON object" for i in np.flatnonzero(~ok)}
+    items = [it if isinstance(it, dict) else {} for it in items]
+
+    cols = {}
+    for field in storage.METRICS:
+        raw = [it.get(field) for it in items]
+        vals = _coerce([None if isinstance(v, str) and not v.strip() else v for v in raw])
+        bad = ok & ~np.isfinite(vals)
+        for i in np.flatnonzero(bad):
+            reasons[i] = f"{field} is missing or not numeric"
+        ok &= ~bad
+        cols[field] = vals
+
+    ts = np.full(n, now, dtype=np.int64)
+    for i in np.flatnonzero(ok):
+        raw = items[i].get("timestamp")
+        if raw in (None, ""):
+            continue
+        try:
+            ts[i] = storage.to_epoch(raw)
+        except (ValueError, TypeError, AttributeError):
+            reasons[i] = "timestamp is not ISO-8601 or epoch seconds"
+            ok[i] = False
+    devices = [it.get("device_id") or storage.DEFAULT_DEVICE for it in items]
+    for i in np.flatnonzero(ok):
+        if not storage.valid_device(devices[i]):
+            reasons[i] = "device_id must be 1-32 letters, digits, '-' or '_'"
+            ok[i] = False
+
+    if INGEST_RANGE_CHECK:
+        implausible = ok & ~log_cleaner.range_mask(cols)
+        for i in np.flatnonzero(implausible):
+            reasons[i] = log_cleaner.out_of_range({f: cols[f][i] for f in storage.METRICS})
+        ok &= ~implausible
+
+    ahead = ok & (ts > now + MAX_CLOCK_SKEW)
+    for i in np.flatnonzero(ahead):
+        reasons[i] = "timestamp is in the future"
+    ok &= ~ahead
+
+    idx = np.flatnonzero(ok)
+    idx = idx[np.argsort(ts[idx], kind="stable")]
+    rows = [
+        {"timestamp": storage.format_ts(ts[i]), "device_id": devices[i],
+         **{f: float(cols[f][i]) for f in storage.METRICS}}
+        for i in idx
+    ]
+    rejected = [{"index": int(i), "error": reasons[i]} for i in sorted(reasons)]
+    return rows, rejected
 
 def format_sensor_data(data):
     return (
@@ -22,88 +102,232 @@ def format_sensor_data(data):
         f"🌱 Moisture: {data['moisture']}"
     )
 
-def get_today_logfile():
-    today = datetime.now().strftime("%Y-%m-%d")
-    return os.path.join(LOG_DIR, f"raw_sensorlog_{today}.csv")
+def write_csv_log(data):
+    return ingest_writer.append(data)
+
 
-def get_latest_logfile():
-    files = [
-        f for f in os.listdir(LOG_DIR)
-        if f.startswith("raw_sensorlog_") and f.endswith(".csv")
-    ]
-    if not files:
-        return None
-    for f in sorted(files, reverse=True):
-        path = os.path.join(LOG_DIR, f)
-        try:
-            if os.path.getsize(path) > 0:
-                return path
-        except OSError:
-            continue
-    # fall back to most recent even if empty
-    return os.path.join(LOG_DIR, sorted(files, reverse=True)[0])
+RANGE_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
 
-def write_csv_log(data):
-    os.makedirs(LOG_DIR, exist_ok=True)
-    path = RAW_LOG_FILE
-    is_new = not os.path.exists(path) or os.path.getsize(path) == 0
-
-    with open(path, "a", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=["timestamp","temp_f","humidity","lux","moisture"])
-        if is_new:
-            w.writeheader()
-        w.writerow({
-            "timestamp": data["timestamp"],  # ideally "YYYY-MM-DDTHH:MM:SSZ"
-            "temp_f": round(data["temp_f"], 2),
-            "humidity": round(data["humidity"], 2),
-            "lux": round(data["lux"], 1),
-            "moisture": round(data["moisture"], 1),
-        })
-
-
-
-def _read_csv_dicts(path):
-    rows = []
-    if not path or not os.path.exists(path) or os.path.getsize(path) == 0:
-        return rows
-    with open(path, newline="") as f:
-        reader = csv.DictReader(f)
-        for r in reader:
-            rows.append(r)
-    return rows
-
-
-def load_log_data(filter_range="24h", day=None):
-    path = RAW_LOG_FILE
-    if not os.path.exists(path) or os.path.getsize(path) == 0:
-        return [], None
-
-    data = []
+def parse_duration(value):
+    """"90s" / "5m" / "24h" / "7d" / "1w" -> seconds. Raises ValueError."""
+    v = (value or "").strip().lower()
+    unit = RANGE_UNITS.get(v[-1:])
+    if unit is None or not v[:-1].isdigit() or int(v[:-1]) <= 0:
+        raise ValueError(f"Invalid duration: {value}")
+    return int(v[:-1]) * unit
+
+def parse_range(filter_range="24h", day=None, now=None):
+    """Turn ?filter_range=24h / 7d / 1w / all and ?day=YYYY-MM-DD into (start, end) epochs.
+
+    `day` wins over `filter_range` and covers that local calendar day.
+    Raises ValueError on anything it doesn't understand.
+    """
+    if day:
+        d = datetime.strptime(day, "%Y-%m-%d")
+        return int(d.timestamp()), int((d + timedelta(days=1)).timestamp())
+
+    fr = (filter_range or "24h").strip().lower()
+    if fr == "all":
+        return None, None
+    try:
+        span = parse_duration(fr)
+    except ValueError:
+        raise ValueError(f"Invalid filter_range: {filter_range}")
+    now = int(now if now is not None else datetime.now(timezone.utc).timestamp())
+    return now - span, None
+
+
+def parse_cursor(since):
+    """?since= -> (seq, t, skip).
+
+    A cursor from a previous response is "w<seq>": the rows written after the
+    device's first `seq` writes, in write order (see journal.py), so a row
+    stored late with an older timestamp is still delivered; t and skip are
+    None. Otherwise seq is None and the value is read by time: "<epoch>:<n>"
+    (older cursors) means rows newer than `epoch` plus the rows stamped exactly
+    `epoch` after the first `n`, and a plain timestamp (ISO-8601 or epoch
+    seconds) means strictly newer than it, i.e. skip is None.
+    Raises ValueError.
+    """
+    value = (since or "").strip()
+    if value[:1] == "w" and value[1:].isdigit():
+        return int(value[1:]), None, None
+    if ":" in value and value.replace(":", "").isdigit():
+        t, skip = value.split(":", 1)
+        return None, int(t), int(skip)
+    try:
+        return None, int(float(value)), None
+    except ValueError:
+        pass
     try:
-        with open(path, newline="", encoding="utf-8-sig") as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                ts = row.get("timestamp", "")
-                # normalize timestamp -> ISO-UTC string
-                try:
-                    if ts.endswith("Z"):
-                        # already UTC
-                        pass
-                    else:
-                        # try parse local/naive -> keep as naive ISO to unblock UI
-                        datetime.fromisoformat(ts)  # validate format
-                    data.append({
-                        "timestamp": ts if ts.endswith("Z") else ts,
-                        "display_time": ts,  # front-end can format later
-                        "temp_f": float(row["temp_f"]),
-                        "humidity": float(row["humidity"]),
-                        "lux": float(row["lux"]),
-                        "moisture": float(row.get("moisture", 0)),
-                    })
-                except Exception:
-                    continue
-        # sort by timestamp string is fine if they’re ISO-ish
-        data.sort(key=lambda x: x["timestamp"])
-        return data, None
+        return None, storage.to_epoch(value), None
+    except (ValueError, TypeError):
+        raise ValueError(f"Invalid since: {since}")
+
+
+def format_cursor(seq):
+    return f"w{int(seq)}"
+
+
+def current_cursor(device=storage.DEFAULT_DEVICE):
+    """Cursor pointing just past the newest write of a device."""
+    return format_cursor(journal.end(device))
+
+
+HISTORY_FORMATS = {"rows": storage.columns_to_rows, "columns": storage.columns_to_arrays}
+
+
+def _downsample(cols, level, points, resolution, method):
+    # rows read vs rows sent, per query, for /metrics
+    metrics.observe("garden_history_rows_scanned", len(cols["t"]), level=level)
+    if points or resolution:
+        cols = downsample(cols, points=points, resolution=resolution, method=method)
+    metrics.observe("garden_history_rows_returned", len(cols["t"]), level=level)
+    return cols
+
+
+def summarize(cols):
+    """Reading count and per-metric mean/min/max of raw columns, in the
+    layout of rollups.summarize."""
+    n = len(cols["t"])
+    out = {"n": n}
+    for m in storage.METRICS:
+        v = np.asarray(cols[m], dtype=np.float64)
+        out[m] = None if not n else {
+            "mean": round(float(v.mean()), 3),
+            "min": round(float(v.min()), 3),
+            "max": round(float(v.max()), 3),
+        }
+    return out
+
+
+def load_log_data(filter_range="24h", day=None, points=None, resolution=None, method="lttb",
+                  rollup="auto", device=storage.DEFAULT_DEVICE, fmt="rows", summary=None):
+    """History rows for one device, or {device: rows} when `device` is a list
+    (the shards are read in parallel). fmt="columns" returns column arrays
+    instead of row dicts. Pass a dict as `summary` (single device) to have it
+    filled with the window's count/mean/min/max, taken before downsampling."""
+    def read(start, end, dev):
+        level = rollups.pick_level(start, end, device=dev) if rollup == "auto" else rollup
+        if level == "raw":
+            cols = storage.read_range(start, end, dev)
+            if summary is not None:
+                summary.update(summarize(cols))
+        else:
+            recs = rollups.read_records(level, start, end, dev)
+            if summary is not None:
+                summary.update(rollups.summarize(recs))
+            cols = rollups.bucket_means(recs)
+        return _downsample(cols, level, points, resolution, method)
+
+    try:
+        output = HISTORY_FORMATS[fmt]
+        start, end = parse_range(filter_range, day)
+        if isinstance(device, (list, tuple)):
+            per_device = storage.read_devices(list(device), start, end, reader=read)
+            return {d: output(c) for d, c in per_device.items()}, None
+        return output(read(start, end, device)), None
     except Exception as e:
         return [], str(e)
+
+
+def load_log_since(since, points=None, resolution=None, method="lttb", device=storage.DEFAULT_DEVICE, fmt="rows"):
+    """Raw rows stored after the ?since= cursor, for incremental polling.
+
+    Returns (rows, next_cursor, error). The rows are sorted by time and cut at
+    the cursor before any downsampling, so the next cursor always refers to
+    stored readings. An expired cursor is an error; reload the window.
+    """
+    try:
+        seq, t0, skip = parse_cursor(since)
+        if seq is not None:
+            cols, nxt = journal.read_since(seq, device)
+            order = np.argsort(cols["t"], kind="stable")
+            cols = {k: v[order] for k, v in cols.items()}
+        else:
+            nxt = journal.end(device)  # before the read: a row written meanwhile comes again, not never
+            cols = storage.read_range(t0, None, device)
+            at_t0 = int(np.searchsorted(cols["t"], t0, side="right"))
+            first = at_t0 if skip is None else min(skip, at_t0)
+            cols = {k: v[first:] for k, v in cols.items()}
+        cols = _downsample(cols, "raw", points, resolution, method)
+        return HISTORY_FORMATS[fmt](cols), format_cursor(nxt), None
+    except Exception as e:
+        return [], None, str(e)
+
+
+def parse_history_args(args):
+    """/api/history query args (any mapping with .get) -> the validated query
+    for history_etag and query_history. Raises ValueError."""
+    # ?device=a returns rows; ?device=a,b returns {device: rows} for comparison views
+    q = {
+        "filter_range": args.get("filter_range", "24h"),
+        "day": args.get("day"),
+        "devices": [d.strip() for d in args.get("device", storage.DEFAULT_DEVICE).split(",") if d.strip()],
+        # optional downsampling: ?points=N (lttb|minmax) or ?resolution=5m (min/max buckets)
+        "points": args.get("points"),
+        "resolution": args.get("resolution"),
+        "method": args.get("method", "lttb"),
+        "rollup": args.get("rollup", "auto"),  # auto | raw | 1m | 1h | 1d
+        # incremental polling: ?since=<cursor from the last response> returns only newer rows
+        "since": args.get("since"),
+        # ?format=columns: {"t": [epoch...], "temp_f": [...], ...} instead of row dicts
+        "fmt": args.get("format", "rows"),
+        # ?summary=1: count/mean/min/max of the whole window next to the (downsampled) data
+        "summary": str(args.get("summary", "")).strip().lower() in ("1", "true", "yes", "on"),
+    }
+    parse_range(q["filter_range"], q["day"])
+    if q["points"] is not None:
+        if not q["points"].isdigit():
+            raise ValueError("points must be an integer")
+        q["points"] = int(q["points"])
+        if q["points"] < 3:
+            raise ValueError("points must be >= 3")
+    if q["resolution"]:
+        q["resolution"] = parse_duration(q["resolution"])
+    if q["method"] not in DOWNSAMPLE_METHODS:
+        raise ValueError(f"method must be one of {', '.join(DOWNSAMPLE_METHODS)}")
+    if q["rollup"] not in ("auto", "raw", *rollups.LEVELS):
+        raise ValueError(f"rollup must be one of auto, raw, {', '.join(rollups.LEVELS)}")
+    if not q["devices"] or not all(storage.valid_device(d) for d in q["devices"]):
+        raise ValueError("device must be a comma-separated list of device ids")
+    if q["fmt"] not in HISTORY_FORMATS:
+        raise ValueError(f"format must be one of {', '.join(HISTORY_FORMATS)}")
+    if q["since"] is not None:
+        parse_cursor(q["since"])
+        if len(q["devices"]) > 1:
+            raise ValueError("since supports a single device")
+        if q["rollup"] not in ("auto", "raw"):
+            raise ValueError("since returns raw rows; use rollup=auto or raw")
+    if q["summary"] and (q["since"] is not None or len(q["devices"]) > 1):
+        raise ValueError("summary needs a single device and a window, not since")
+    # windows relative to now move without new writes
+    q["relative"] = q["since"] is None and not q["day"] and q["filter_range"].strip().lower() != "all"
+    return q
+
+
+def history_etag(query_string, devices, relative):
+    """Weak ETag for a history query: the query string plus each device's write
+    version, and the current minute for windows relative to now (so their
+    trailing edge still moves without new writes)."""
+    key = [query_string] + [f"{d}={latest_store.version(d)}" for d in devices]
+    if relative:
+        key.append(str(int(time.time()) // 60))
+    return hashlib.sha1("|".join(key).encode()).hexdigest()[:20]
+
+
+def query_history(q):
+    """Run a parse_history_args query: (data, extra, error), where extra holds
+    the response's "cursor" and, for ?summary=1, "summary"."""
+    devices = q["devices"]
+    if q["since"] is not None:
+        data, cursor, error = load_log_since(q["since"], points=q["points"], resolution=q["resolution"],
+                                             method=q["method"], device=devices[0], fmt=q["fmt"])
+        return data, {"cursor": cursor}, error
+    extra = {"cursor": current_cursor(devices[0]) if len(devices) == 1 else None}
+    summary = {} if q["summary"] else None
+    data, error = load_log_data(filter_range=q["filter_range"], day=q["day"],
+                                points=q["points"], resolution=q["resolution"], method=q["method"], rollup=q["rollup"],
+                                device=devices if len(devices) > 1 else devices[0], fmt=q["fmt"], summary=summary)
+    extra["summary"] = summary
+    return data, extra, error
@@ -1,7 +1,27 @@
 import os
 
-CONFIG_FILE = "config.json"
-LOG_DIR = os.path.join(os.path.dirname(__file__), "logs")
+CONFIG_FILE = os.getenv("CONFIG_FILE", "config.json")
+LOG_DIR = os.getenv("LOG_DIR", os.path.join(os.path.dirname(__file__), "logs"))
 RAW_LOG_FILE = os.path.join(LOG_DIR, "raw_sensorlog.csv")
 
+# Storage engine: "segments" (columnar, time-partitioned), "sqlite" (WAL database, see
+# sqlite_store.py) or "csv" (legacy raw_sensorlog.csv)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "segments")
+SEGMENT_DIR = os.path.join(LOG_DIR, "segments")
+SEGMENT_SPAN = os.getenv("SEGMENT_SPAN", "day")  # "day" or "hour"
+SQLITE_DB = os.getenv("SQLITE_DB", os.path.join(LOG_DIR, "sensors.db"))
+ROLLUP_DIR = os.path.join(LOG_DIR, "rollups")
+STATS_DIR = os.path.join(LOG_DIR, "stats")  # per-day accumulators for /api/stats (see daily_stats.py)
+LATEST_FILE = os.path.join(LOG_DIR, "latest.bin")  # mmap shared by all workers
+ALERT_STATE_FILE = os.path.join(LOG_DIR, "alert_state.json")
+ANOMALY_STATE_FILE = os.path.join(LOG_DIR, "anomaly_state.bin")  # per-metric detector state (see anomaly.py)
+QUARANTINE_FILE = os.path.join(LOG_DIR, "quarantine.csv")  # readings held back by ANOMALY_MODE=quarantine
 
+# Ingest writer: "sidecar" (one process owns the files, see ingest_writer.py) or "direct"
+INGEST_WRITER = os.getenv("INGEST_WRITER", "sidecar")
+# Reject readings outside log_cleaner.RANGES at /api/sensor and /api/sensor/batch (off by default)
+INGEST_RANGE_CHECK = os.getenv("INGEST_RANGE_CHECK", "false").strip().lower() in ("1", "true", "yes", "on")
+INGEST_SOCKET = os.getenv("INGEST_SOCKET", os.path.join(LOG_DIR, "ingest.sock"))
+STREAM_DIR = os.path.join(LOG_DIR, "stream")  # per-worker sockets for /api/stream fan-out
+ARCHIVE_DIR = os.path.join(LOG_DIR, "archive")  # compressed monthly archives (see compaction.py)
+METRICS_DIR = os.path.join(LOG_DIR, "metrics")  # per-process snapshots summed by /metrics
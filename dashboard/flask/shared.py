@@ -1,22 +1,93 @@
+import copy
+import fcntl
+import gzip
 import json
 import os
-from flask import jsonify
+import tempfile
+import threading
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from flask import current_app, request
 from settings import CONFIG_FILE
 
-latest_data = None
+import numpy as np
 
-def api_response(status="ok", message=None, data=None, http_status=200):
+# optional fast paths: orjson for encoding, brotli for Content-Encoding: br
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_BYTES = 1024
+
+
+def _default(obj):
+    if isinstance(obj, (np.ndarray, np.generic)):
+        return obj.tolist()
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj):
+    """Compact JSON bytes with sorted keys; NumPy arrays are encoded directly."""
+    if orjson is not None:
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_SORT_KEYS)
+    return json.dumps(obj, default=_default, sort_keys=True, separators=(",", ":")).encode()
+
+
+def api_response(status="ok", message=None, data=None, http_status=200, **extra):
     resp = {"status": status}
     if message: resp["message"] = message
     if data is not None: resp["data"] = data
-    return jsonify(resp), http_status
+    resp.update({k: v for k, v in extra.items() if v is not None})
+    return current_app.response_class(dumps(resp), mimetype="application/json"), http_status
 
-def load_config():
-    if not os.path.isfile(CONFIG_FILE):
-        return {}
-    with open(CONFIG_FILE, "r") as f:
-        config = json.load(f)
 
+def compress_response(resp):
+    """Brotli/gzip-encode JSON responses per Accept-Encoding (after_request hook)."""
+    if (resp.status_code != 200 or resp.is_streamed or resp.direct_passthrough
+            or "Content-Encoding" in resp.headers or resp.mimetype != "application/json"):
+        return resp
+    resp.vary.add("Accept-Encoding")
+    accepted = request.accept_encodings
+    body, encoding = encode_body(resp.get_data(), lambda name: accepted[name])
+    if encoding:
+        resp.set_data(body)
+        resp.headers["Content-Encoding"] = encoding
+    return resp
+
+
+def encode_body(body, accepts):
+    """(body, Content-Encoding or None): brotli or gzip when `accepts(name)`
+    and the body is worth compressing."""
+    if len(body) < COMPRESS_MIN_BYTES:
+        return body, None
+    if brotli is not None and accepts("br"):
+        return brotli.compress(body, quality=4), "br"
+    if accepts("gzip"):
+        return gzip.compress(body, compresslevel=5), "gzip"
+    return body, None
+
+# config.json is cached per process and re-read only when its stat changes
+# (saves replace the file, so the inode changes too). Saves take a flock on
+# config.json.lock so workers don't lose each other's updates.
+_config_cache = {"stat": None, "config": {}, "etag": None}
+_config_cache_lock = threading.Lock()
+
+
+def _config_stat():
+    try:
+        st = os.stat(CONFIG_FILE)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def _normalize_config(config):
     if "mqtt_homeassistant" in config:
         try:
             config["mqtt_homeassistant"]["port"] = int(config["mqtt_homeassistant"].get("port", 1883))
@@ -37,6 +108,128 @@ def load_config():
 
     return config
 
+
+def _cached_config():
+    stat = _config_stat()
+    with _config_cache_lock:
+        if stat != _config_cache["stat"] or _config_cache["etag"] is None:
+            raw = b""
+            if stat is not None:
+                with open(CONFIG_FILE, "rb") as f:
+                    raw = f.read()
+            config = _normalize_config(json.loads(raw)) if raw else {}
+            etag = f"{int(config.get('config_version', 0) or 0)}-{zlib.crc32(raw):08x}"
+            _config_cache.update(stat=stat, config=config, etag=etag)
+        return _config_cache["config"], _config_cache["etag"]
+
+
+def load_config():
+    return copy.deepcopy(_cached_config()[0])
+
+
+def config_etag():
+    """"<config_version>-<crc32 of config.json>": changes with any edit, even
+    a hand edit that forgot to bump config_version."""
+    return _cached_config()[1]
+
+
+def config_version():
+    return int(_cached_config()[0].get("config_version", 0) or 0)
+
+
+@contextmanager
+def _config_locked():
+    with open(CONFIG_FILE + ".lock", "a") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _write_config(data):
+    # write a temp file next to config.json and rename it over: readers see
+    # the old or the new file, never a partial one
+    directory = os.path.dirname(os.path.abspath(CONFIG_FILE))
+    fd, tmp = tempfile.mkstemp(prefix=".config-", suffix=".json", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, CONFIG_FILE)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
 def save_config(data):
-    with open(CONFIG_FILE, "w") as f:
-        json.dump(data, f, indent=2)
+    with _config_locked():
+        _write_config(data)
+
+
+def update_config(apply):
+    """Read-modify-write config.json under the cross-worker lock.
+
+    `apply(config)` edits the freshly loaded config in place; the result is
+    saved atomically and returned.
+    """
+    with _config_locked():
+        config = load_config()
+        apply(config)
+        _write_config(config)
+        return config
+
+
+# Schema: sleep in seconds, plus other config keys
+CONFIG_VALIDATORS = {
+    "sleep":        lambda v: (int(v), 1, 6000),  # 1s to 6000s
+    "ssid":         lambda v: (str(v), None, None),
+    "password":     lambda v: (str(v), None, None),
+    "mqtt_broker":  lambda v: (str(v), None, None),
+    "mqtt_port":    lambda v: (int(v), 1, 65535),
+}
+
+
+def validate_config_update(new_cfg):
+    """The known keys of a POST /api/config body, converted and range checked.
+    Raises ValueError with the message for the client."""
+    validated = {}
+
+    # Backward-compat: accept polling_interval and convert → sleep (seconds)
+    if "polling_interval" in new_cfg and "sleep" not in new_cfg:
+        try:
+            val = int(new_cfg["polling_interval"])
+            if val > 6000:  # probably ms
+                val //= 1000
+            val = max(1, min(6000, val))
+            validated["sleep"] = val
+        except Exception:
+            pass
+
+    # Validate all known keys
+    for key, fn in CONFIG_VALIDATORS.items():
+        if key in new_cfg:
+            try:
+                val, lo, hi = fn(new_cfg[key])
+            except (ValueError, TypeError):
+                raise ValueError(f"Invalid value for {key}")
+            if lo is not None and val < lo:
+                raise ValueError(f"{key} must be >= {lo}")
+            if hi is not None and val > hi:
+                raise ValueError(f"{key} must be <= {hi}")
+            validated[key] = val
+    return validated
+
+
+def apply_config_update(validated):
+    """Save validated values; bumps config_version only if one actually changed."""
+    def apply(config):
+        changed = {k: v for k, v in validated.items() if config.get(k) != v}
+        config.update(changed)
+        if changed:
+            config["config_version"] = int(config.get("config_version", 0)) + 1
+            config["updated_at"] = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    # locked read-modify-write, saved atomically
+    return update_config(apply)
@@ -0,0 +1,439 @@
+# sqlite_store.py
+# SQLite storage backend (STORAGE_BACKEND=sqlite): every device's readings in
+# one database, logs/sensors.db, in WAL mode so any number of readers run
+# alongside the writer across gunicorn workers.
+#
+#   readings   WITHOUT ROWID, keyed by (device, t): the table is its own
+#              clustered time index, so a range query is one b-tree seek plus
+#              a sequential scan. One reading per device and second: on a
+#              conflict (a retried POST, a re-run import) the stored reading
+#              wins and the new one is skipped
+#   rollup_1m / rollup_1h / rollup_1d
+#              the rollups.py aggregates (n, last_t, sum/min/max/last per
+#              metric) keyed by (device, bucket start), folded in by the same
+#              transaction that inserts the rows
+#   journal    (device, seq, t) of every stored reading in write order, the
+#              ?since= cursor of journal.py kept in the database instead of
+#              journal.bin files; written by the inserting transaction, so a
+#              skipped duplicate is never journaled, and trimmed to the
+#              newest JOURNAL_ROWS per device the same way
+#
+# storage.Appender writes a batch (a group commit in the ingest writer) as
+# one transaction. The connection runs synchronous=NORMAL, so commits don't
+# fsync; Appender.sync() fsyncs the WAL (which holds every committed
+# transaction) and then checkpoints it, keeping INGEST_FSYNC meaning what it
+# does for the file backends.
+#
+# Databases created with the older (device, t, <metrics>) key are rebuilt with
+# the new one on the first connect, keeping the first reading of each second.
+#
+# Import existing logs (segments, archives and raw_sensorlog*.csv; safe to
+# re-run, readings already stored are skipped):
+#   python sqlite_store.py migrate
+#   python sqlite_store.py status
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from itertools import chain
+
+import numpy as np
+
+import journal
+import rollups
+import storage
+from log_cleaner import chunk_ranges
+from settings import SQLITE_DB
+from storage import DEFAULT_DEVICE, METRICS, PRECISION
+
+logger = logging.getLogger("dashboard")
+
+BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000))
+INSERT_BATCH = 50_000  # rows per transaction when importing
+
+_COLS = ("t", *METRICS)
+_AGG = [f for f in rollups.RECORD.names if f != "t"]
+
+_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS readings (device TEXT NOT NULL, t INTEGER NOT NULL, "
+    + ", ".join(f"{m} REAL NOT NULL" for m in METRICS)
+    + ", PRIMARY KEY (device, t)) WITHOUT ROWID",
+] + [
+    f"CREATE TABLE IF NOT EXISTS rollup_{level} (device TEXT NOT NULL, t INTEGER NOT NULL, "
+    + ", ".join(f"{f} {'INTEGER' if f in ('n', 'last_t') else 'REAL'} NOT NULL" for f in _AGG)
+    + ", PRIMARY KEY (device, t)) WITHOUT ROWID"
+    for level in rollups.LEVELS
+] + [
+    "CREATE TABLE IF NOT EXISTS journal (device TEXT NOT NULL, seq INTEGER NOT NULL, t INTEGER NOT NULL, "
+    "PRIMARY KEY (device, seq)) WITHOUT ROWID",
+]
+
+_INSERT = (f"INSERT INTO readings (device, {', '.join(_COLS)}) VALUES (?, {', '.join('?' * len(_COLS))}) "
+           "ON CONFLICT (device, t) DO NOTHING")
+
+
+def _upsert(level):
+    newer = "excluded.last_t >= last_t"
+    sets = ["n = n + excluded.n"]
+    for m in METRICS:
+        sets += [f"{m}_sum = {m}_sum + excluded.{m}_sum",
+                 f"{m}_min = min({m}_min, excluded.{m}_min)",
+                 f"{m}_max = max({m}_max, excluded.{m}_max)",
+                 f"{m}_last = CASE WHEN {newer} THEN excluded.{m}_last ELSE {m}_last END"]
+    sets.append("last_t = max(last_t, excluded.last_t)")  # every SET sees the old row
+    return (f"INSERT INTO rollup_{level} (device, t, {', '.join(_AGG)}) "
+            f"VALUES (?, ?, {', '.join('?' * len(_AGG))}) "
+            f"ON CONFLICT (device, t) DO UPDATE SET {', '.join(sets)}")
+
+
+_UPSERTS = {level: _upsert(level) for level in rollups.LEVELS}
+
+
+# -- connections ------------------------------------------------------------------
+
+def connect(path=None):
+    """A new connection with the schema in place (autocommit; use `transaction`)."""
+    path = path or SQLITE_DB
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = sqlite3.connect(path, timeout=BUSY_TIMEOUT_MS / 1000, isolation_level=None, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    for stmt in _SCHEMA:
+        db.execute(stmt)
+    _upgrade(db)
+    return db
+
+
+def _upgrade(db):
+    # readings keyed by (device, t, <metrics>) before: rebuild with the new key
+    if sum(1 for col in db.execute("PRAGMA table_info(readings)") if col[5]) <= 2:
+        return
+    with transaction(db):
+        if sum(1 for col in db.execute("PRAGMA table_info(readings)") if col[5]) <= 2:
+            return  # another process got there first
+        logger.info("[sqlite] rebuilding readings with the (device, t) key")
+        db.execute(_SCHEMA[0].replace("readings", "readings_new", 1))
+        db.execute(f"INSERT INTO readings_new SELECT device, {', '.join(_COLS)} FROM readings "
+                   "ORDER BY device, t ON CONFLICT (device, t) DO NOTHING")
+        db.execute("DROP TABLE readings")
+        db.execute("ALTER TABLE readings_new RENAME TO readings")
+    rebuild_rollups(db)
+
+
+_local = threading.local()
+
+
+def reader():
+    """This thread's read connection (per process: connections don't survive fork)."""
+    db = getattr(_local, "db", None)
+    if db is None or _local.pid != os.getpid():
+        db = _local.db = connect()
+        _local.pid = os.getpid()
+    return db
+
+
+@contextmanager
+def transaction(db):
+    """BEGIN IMMEDIATE ... COMMIT, rolled back on error. IMMEDIATE takes the
+    write lock up front, so a busy database waits out busy_timeout instead
+    of failing halfway through."""
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield db
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    db.execute("COMMIT")
+
+
+def checkpoint(db):
+    """fsync the WAL, so every committed transaction is durable, then copy
+    what readers allow of it into the database (PASSIVE: never waits for
+    them; a checkpoint that completes fsyncs the database file)."""
+    path = db.execute("PRAGMA database_list").fetchone()[2]
+    try:
+        fd = os.open(path + "-wal", os.O_RDONLY)
+    except FileNotFoundError:
+        return  # nothing written since the last connection closed
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    db.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+
+# -- writes -----------------------------------------------------------------------
+
+def _rounded(cols):
+    # stored at the API's precision (like the CSV backend), so duplicates compare equal
+    return {"t": cols["t"], **{m: np.round(cols[m].astype(np.float64), PRECISION[m]) for m in METRICS}}
+
+
+def _values(device, cols):
+    return list(zip([device] * len(cols["t"]), *(cols[k].tolist() for k in _COLS)))
+
+
+def insert(db, device, cols, fold=True):
+    """Insert columns for one device (inside a transaction). New rows, not the
+    ones skipped on a (device, t) conflict, are folded into the rollup tables
+    unless `fold` is False. Returns the number of new rows."""
+    cols = _rounded(cols)
+    if fold:
+        return int(_insert_new(db, device, cols).sum())
+    before = db.total_changes
+    db.executemany(_INSERT, _values(device, cols))
+    return db.total_changes - before
+
+
+def _insert_new(db, device, cols):
+    """Insert and fold the rows whose (device, t) isn't stored yet (of a
+    repeated t, the first). Returns the mask of the rows that were."""
+    # the transaction holds the write lock, so what is stored now is what
+    # the insert would conflict with
+    t = cols["t"]
+    new = np.zeros(len(t), dtype=bool)
+    if not len(t):
+        return new
+    _, first = np.unique(t, return_index=True)
+    new[first] = True
+    stored = np.fromiter((r[0] for r in db.execute(
+        "SELECT t FROM readings WHERE device = ? AND t >= ? AND t <= ?", (device, int(t.min()), int(t.max())))),
+        np.int64)
+    new &= ~np.isin(t, stored)
+    if new.any():
+        cols = {k: v[new] for k, v in cols.items()}
+        db.executemany(_INSERT, _values(device, cols))
+        fold_rollups(db, device, cols)
+    return new
+
+
+def fold_rollups(db, device, cols):
+    for level, width in rollups.LEVELS.items():
+        agg = rollups.aggregate(cols, width)
+        db.executemany(_UPSERTS[level], [(device, *rec) for rec in agg.tolist()])
+
+
+def rows_to_columns(rows):
+    cols = {"t": np.array([storage.to_epoch(r["timestamp"]) for r in rows], dtype=np.int64)}
+    for m in METRICS:
+        cols[m] = np.array([float(r.get(m, 0) or 0) for r in rows], dtype=np.float64)
+    return cols
+
+
+def append(db, rows):
+    """Persist reading dicts, grouped by device, as one transaction, and
+    journal them. Returns the rows that were stored: one whose (device, t)
+    is taken is skipped."""
+    stored = set()
+    with transaction(db):
+        for device, group in storage.group_by_device(rows).items():
+            new = _insert_new(db, device, _rounded(rows_to_columns(group)))
+            group = [row for row, keep in zip(group, new) if keep]
+            _journal(db, device, [storage.to_epoch(r["timestamp"]) for r in group])
+            stored.update(map(id, group))
+    return [row for row in rows if id(row) in stored]
+
+
+def _journal(db, device, t):
+    if not t:
+        return
+    base, end = db.execute("SELECT coalesce(min(seq), 0), coalesce(max(seq) + 1, 0) FROM journal "
+                           "WHERE device = ?", (device,)).fetchone()
+    db.executemany("INSERT INTO journal (device, seq, t) VALUES (?, ?, ?)",
+                   [(device, end + i, ts) for i, ts in enumerate(t)])
+    end += len(t)
+    if end - base >= 2 * journal.JOURNAL_ROWS:
+        db.execute("DELETE FROM journal WHERE device = ? AND seq < ?", (device, end - journal.JOURNAL_ROWS))
+
+
+def rebuild_rollups(db, device=None):
+    """Recompute the rollup tables from the readings (one device or all), a
+    month at a time. Returns the number of readings aggregated."""
+    total = 0
+    for dev in [device] if device is not None else devices(db):
+        with transaction(db):
+            for level in rollups.LEVELS:
+                db.execute(f"DELETE FROM rollup_{level} WHERE device = ?", (dev,))
+            lo, hi = db.execute("SELECT min(t), max(t) FROM readings WHERE device = ?", (dev,)).fetchone()
+            month = lo
+            while month is not None and month <= hi:
+                start, end = storage.month_bounds(month)
+                cols = read_range(start, end, dev, db)
+                fold_rollups(db, dev, cols)  # months are whole days, so no bucket spans two
+                total += len(cols["t"])
+                month = end
+    return total
+
+
+def prune(db, before):
+    """Delete readings with t < before, and the rollup buckets that end by
+    then. Returns {device: rows}."""
+    counts = {}
+    with transaction(db):
+        for device in devices(db):
+            n = db.execute("DELETE FROM readings WHERE device = ? AND t < ?", (device, before)).rowcount
+            for level, width in rollups.LEVELS.items():
+                db.execute(f"DELETE FROM rollup_{level} WHERE device = ? AND t + ? <= ?", (device, width, before))
+            if n:
+                counts[device] = n
+    return counts
+
+
+# -- reads ------------------------------------------------------------------------
+
+def _range(start, end):
+    return (start if start is not None else -2**63, end if end is not None else 2**63 - 1)
+
+
+def read_range(start=None, end=None, device=DEFAULT_DEVICE, db=None):
+    """Columns like storage.read_range: rows with start <= t < end, sorted by time."""
+    db = db or reader()
+    rows = db.execute(f"SELECT {', '.join(_COLS)} FROM readings WHERE device = ? AND t >= ? AND t < ? "
+                      "ORDER BY t", (device, *_range(start, end))).fetchall()
+    if not rows:
+        return storage.empty_columns()
+    a = np.fromiter(chain.from_iterable(rows), np.float64, len(rows) * len(_COLS)).reshape(len(rows), len(_COLS))
+    cols = {"t": a[:, 0].astype(np.int64)}
+    for i, m in enumerate(METRICS, 1):
+        cols[m] = a[:, i].astype(np.float32)
+    return cols
+
+
+def read_records(level, start=None, end=None, device=DEFAULT_DEVICE, db=None):
+    """Rollup records like rollups.read_records, from the rollup_<level> table."""
+    db = db or reader()
+    width = rollups.LEVELS[level]
+    lo, hi = _range(start // width * width if start is not None else None, end)
+    rows = db.execute(f"SELECT t, {', '.join(_AGG)} FROM rollup_{level} WHERE device = ? AND t >= ? AND t < ? "
+                      "ORDER BY t", (device, lo, hi)).fetchall()
+    return np.array(rows, dtype=rollups.RECORD) if rows else np.zeros(0, dtype=rollups.RECORD)
+
+
+def journal_end(device=DEFAULT_DEVICE, db=None):
+    """Like journal.end: the sequence number just past the newest journaled row."""
+    db = db or reader()
+    return db.execute("SELECT coalesce(max(seq) + 1, 0) FROM journal WHERE device = ?", (device,)).fetchone()[0]
+
+
+def journal_since(seq, device=DEFAULT_DEVICE, db=None):
+    """Like journal.read_since: (columns in write order, next sequence number)
+    for the rows journaled at or after `seq`. Raises journal.CursorExpired."""
+    db = db or reader()
+    db.execute("BEGIN")  # one snapshot for the bounds and the rows
+    try:
+        base, end = db.execute("SELECT coalesce(min(seq), 0), coalesce(max(seq) + 1, 0) FROM journal "
+                               "WHERE device = ?", (device,)).fetchone()
+        if not base <= seq <= end:
+            raise journal.CursorExpired("since cursor has expired; reload the window")
+        # rows deleted by retention since are left out
+        rows = db.execute(f"SELECT {', '.join('r.' + c for c in _COLS)} FROM journal j "
+                          "JOIN readings r ON r.device = j.device AND r.t = j.t "
+                          "WHERE j.device = ? AND j.seq >= ? ORDER BY j.seq", (device, seq)).fetchall()
+    finally:
+        db.execute("COMMIT")
+    cols = {"t": np.array([r[0] for r in rows], dtype=np.int64)}
+    for i, m in enumerate(METRICS, 1):
+        cols[m] = np.array([r[i] for r in rows], dtype=np.float32)
+    return cols, end
+
+
+def devices(db=None):
+    """Device ids with readings (a loose index scan: one seek per device)."""
+    db = db or reader()
+    return [r[0] for r in db.execute(
+        "WITH RECURSIVE d(x) AS (SELECT min(device) FROM readings UNION ALL "
+        "SELECT (SELECT min(device) FROM readings WHERE device > x) FROM d WHERE x IS NOT NULL) "
+        "SELECT x FROM d WHERE x IS NOT NULL")]
+
+
+def list_devices(db=None):
+    """Like storage.list_devices: the default device first, then the others sorted."""
+    return [DEFAULT_DEVICE, *sorted(d for d in devices(db) if d != DEFAULT_DEVICE)]
+
+
+# -- migration --------------------------------------------------------------------
+
+def _file_sources(device):
+    """(label, loader) for every stored part of a device in the file backends,
+    each small enough to load at once (a segment, an archive, a CSV chunk)."""
+    for _, _, path in storage.list_segments(device=device):
+        yield path, lambda path=path: storage.read_segment(path)
+    for _, _, path in storage.list_archives(device=device):
+        yield path, lambda path=path: storage.read_archive(path)
+    for path in storage.legacy_csv_files(device=device):
+        yield from _csv_chunks(path)
+
+
+def _csv_chunks(path, chunk_bytes=16 * 1024 * 1024):
+    with open(path, "rb") as f:
+        header = f.readline()
+    fieldnames = header.decode("utf-8-sig").strip().split(",")
+
+    def load(lo, hi):
+        with open(path, "rb") as f:
+            f.seek(lo)
+            lines = f.read(hi - lo).decode("utf-8", errors="replace").splitlines()
+        return storage.csv_lines_to_columns(lines, fieldnames)
+
+    for lo, hi in chunk_ranges(path, chunk_bytes, offset=len(header)):
+        yield f"{path} [{lo}:{hi}]", lambda lo=lo, hi=hi: load(lo, hi)
+
+
+def migrate(db=None, device_ids=None, progress=None):
+    """Import the segments, archives and raw_sensorlog*.csv of every device
+    into the database, then rebuild its rollups. Returns {device: (read, new)}."""
+    db = db or connect()
+    summary = {}
+    for device in device_ids or storage.list_file_devices():
+        read = new = 0
+        for label, load in _file_sources(device):
+            cols = load()
+            for i in range(0, len(cols["t"]), INSERT_BATCH):
+                part = {k: v[i:i + INSERT_BATCH] for k, v in cols.items()}
+                with transaction(db):
+                    new += insert(db, device, part, fold=False)
+            read += len(cols["t"])
+            if progress:
+                progress(device, label, read, new)
+        if read:
+            rebuild_rollups(db, device)
+            summary[device] = (read, new)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=f"SQLite storage backend ({SQLITE_DB})")
+    sub = parser.add_subparsers(dest="command", required=True)
+    mig = sub.add_parser("migrate", help="import segments, archives and raw_sensorlog*.csv")
+    mig.add_argument("--device", action="append", help="only this device (repeatable)")
+    sub.add_parser("rebuild", help="recompute the rollup tables from the readings")
+    sub.add_parser("status", help="rows and time range per device")
+    args = parser.parse_args()
+    db = connect()
+
+    if args.command == "migrate":
+        start = time.perf_counter()
+        summary = migrate(db, args.device, progress=lambda d, label, read, new: print(
+            f"  {d}: {os.path.relpath(label)} ({read} read, {new} new)"))
+        checkpoint(db)
+        for device, (read, new) in summary.items():
+            print(f"{device}: {read} rows read, {new} imported")
+        print(f"done in {time.perf_counter() - start:.1f}s")
+        return 0
+    if args.command == "rebuild":
+        print(f"rebuilt rollups from {rebuild_rollups(db)} readings")
+        return 0
+
+    for device, n, lo, hi in db.execute("SELECT device, count(*), min(t), max(t) FROM readings GROUP BY device"):
+        print(f"{device}: {n} rows, {storage.format_ts(lo)} .. {storage.format_ts(hi)}")
+    print(f"{SQLITE_DB}: {os.path.getsize(SQLITE_DB) / 1e6:.1f} MB")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,9 +2,16 @@
 // Modular, documented version of your dashboard logic
 
 // ---- Global Constants ---- //
-const API_URL = "/api/history";
+const API_URL = "/api/history?filter_range=all&points=2000&format=columns&summary=1"; // server-side LTTB downsampling
+const EXPORT_URL = "/api/history?filter_range=all&rollup=raw";
+const LATEST_URL = "/api/sensor"; // newest stored reading (latest_store), not a chart point
+const RANGE_PARAMS = { "1h": "1h", "1d": "24h", "1w": "7d", "all": "all" };
 const ZOOM_START_KEY = "sensorChartZoomStart";
 const ZOOM_END_KEY = "sensorChartZoomEnd";
+const POLL_MS = 60 * 1000; // incremental refresh with ?since= cursors when SSE is unavailable
+
+let historyCursor = null; // cursor from the last /api/history response
+let currentRange = "all"; // RANGE_PARAMS key the chart was last loaded with
 
 // ---- Utility Functions ---- //
 
@@ -27,12 +34,13 @@ function makeCard(id, label, color) {
 }
 
 /**
- * Calculates the average `y` value of a dataset.
- * @param {Array} arr - Array of objects with `y` values.
- * @returns {string} Average rounded to 1 decimal place, or "--" if empty.
+ * Formats the mean of one metric from a history `summary`.
+ * @param {Object} summary - The `summary` of /api/history?summary=1.
+ * @param {string} key - The key to format (e.g., "temp_f").
+ * @returns {string} Mean rounded to 1 decimal place, or "--" if empty.
  */
-function calcAvg(arr) {
-  return arr.length ? (arr.reduce((sum, p) => sum + p.y, 0) / arr.length).toFixed(1) : "--";
+function summaryAvg(summary, key) {
+  return summary && summary[key] ? summary[key].mean.toFixed(1) : "--";
 }
 
 /**
@@ -41,7 +49,16 @@ function calcAvg(arr) {
  * @param {string} key - The key to map (e.g., "temp_f").
  */
 function mapData(data, key) {
-  return data.map((e) => ({ x: e.timestamp, y: e[key] }));
+  return data.map((e) => ({ x: Date.parse(e.timestamp), y: e[key] }));
+}
+
+/**
+ * Same as mapData for the columnar format ({t: [epoch seconds], temp_f: [...], ...}).
+ * @param {Object} cols - Columnar history from /api/history?format=columns.
+ * @param {string} key - The key to map (e.g., "temp_f").
+ */
+function mapColumns(cols, key) {
+  return cols.t.map((t, i) => ({ x: t * 1000, y: cols[key][i] }));
 }
 
 // ---- UI Update Functions ---- //
@@ -62,17 +79,37 @@ function buildSummaryCards(grid, styles) {
 }
 
 /**
- * Updates the values inside the summary cards.
+ * Shows a reading in the "Last Reading" card.
  * @param {Object} latest - Most recent reading.
- * @param {Object} datasets - Object containing arrays for each metric.
  */
-function updateSummaryCardValues(latest, datasets) {
+function updateLatestCard(latest) {
   document.getElementById("latest-val").textContent =
     `Temp: ${latest.temp_f}°F\nRH: ${latest.humidity}%\nLux: ${latest.lux}`;
-  document.getElementById("avgTemp-val").textContent = `${calcAvg(datasets.temp)}°F`;
-  document.getElementById("avgHum-val").textContent = `${calcAvg(datasets.hum)}%`;
-  document.getElementById("avgLux-val").textContent = calcAvg(datasets.lux);
-  document.getElementById("avgMoist-val").textContent = `${calcAvg(datasets.moist)}%`;
+}
+
+/**
+ * Fills the "Last Reading" card from /api/sensor. On long ranges the chart's
+ * last point is a rollup bucket mean, not the reading the sensor sent.
+ */
+function loadLatest() {
+  return fetch(LATEST_URL)
+    .then((r) => r.json())
+    .then((res) => {
+      if (res.status === "ok" && res.data) updateLatestCard(res.data);
+    })
+    .catch(() => {});
+}
+
+/**
+ * Updates the Avg cards. The chart only holds downsampled points (LTTB picks
+ * extremes, rollups are bucket means), so averages come from the server.
+ * @param {Object} summary - The `summary` of /api/history?summary=1.
+ */
+function updateAverageCards(summary) {
+  document.getElementById("avgTemp-val").textContent = `${summaryAvg(summary, "temp_f")}°F`;
+  document.getElementById("avgHum-val").textContent = `${summaryAvg(summary, "humidity")}%`;
+  document.getElementById("avgLux-val").textContent = summaryAvg(summary, "lux");
+  document.getElementById("avgMoist-val").textContent = `${summaryAvg(summary, "moisture")}%`;
 }
 
 /**
@@ -158,6 +195,90 @@ function saveZoom(chart) {
   localStorage.setItem(ZOOM_END_KEY, xAxis.max);
 }
 
+/**
+ * Re-fetches history for a range so the server can pick raw rows or a rollup level,
+ * then swaps the points into the existing chart and the range's averages into the cards.
+ * @param {Chart} chart - The Chart.js instance.
+ * @param {string} range - One of the RANGE_PARAMS keys.
+ */
+function loadRange(chart, range) {
+  return fetch(`/api/history?filter_range=${RANGE_PARAMS[range]}&points=2000&format=columns&summary=1`)
+    .then((r) => r.json())
+    .then((res) => {
+      if (res.status !== "ok" || !res.data || !Array.isArray(res.data.t)) return;
+      ["temp_f", "humidity", "lux", "moisture"].forEach((key, i) => {
+        chart.data.datasets[i].data = mapColumns(res.data, key);
+      });
+      updateAverageCards(res.summary);
+      historyCursor = res.cursor || historyCursor;
+      currentRange = range;
+    });
+}
+
+/**
+ * Adds readings to the chart: newer ones are appended, late ones (a device
+ * flushing its offline buffer) are merged in unless already plotted. Refreshes
+ * the "Last Reading" card.
+ * @param {Chart} chart - The Chart.js instance.
+ * @param {Array} rows - Readings sorted by time.
+ */
+function appendRows(chart, rows) {
+  const points = chart.data.datasets[0].data;
+  const lastX = points.length ? points.at(-1).x : -Infinity;
+  const fresh = rows.filter((r) => Date.parse(r.timestamp) > lastX);
+  const older = rows.filter((r) => Date.parse(r.timestamp) <= lastX);
+  let late = [];
+  if (older.length) {
+    const plotted = new Set(points.map((p) => p.x));
+    late = older.filter((r) => !plotted.has(Date.parse(r.timestamp)));
+  }
+  if (fresh.length === 0 && late.length === 0) return;
+  ["temp_f", "humidity", "lux", "moisture"].forEach((key, i) => {
+    const data = chart.data.datasets[i].data;
+    data.push(...mapData(late, key), ...mapData(fresh, key));
+    if (late.length) data.sort((a, b) => a.x - b.x);
+  });
+  if (fresh.length) updateLatestCard(fresh.at(-1));
+  chart.update("none");
+}
+
+/**
+ * Fetches only the readings stored since the last response (in write order,
+ * so late readings arrive too) and adds them to the chart. Unchanged history
+ * is answered with 304 (revalidated by the browser cache via ETag), so a quiet
+ * poll costs a few bytes. A cursor the server no longer knows reloads the range.
+ * @param {Chart} chart - The Chart.js instance.
+ */
+function pollHistory(chart) {
+  if (!historyCursor) return Promise.resolve();
+  return fetch(`/api/history?since=${encodeURIComponent(historyCursor)}`)
+    .then((r) => r.json())
+    .then((res) => {
+      if (res.status !== "ok") return loadRange(chart, currentRange).then(() => chart.update("none"));
+      if (!Array.isArray(res.data)) return;
+      historyCursor = res.cursor || historyCursor;
+      appendRows(chart, res.data);
+    })
+    .catch(() => {});
+}
+
+/**
+ * Subscribes to /api/stream and appends readings as they are accepted.
+ * After a reconnect or a "dropped" notice the gap is filled from history.
+ * @param {Chart} chart - The Chart.js instance.
+ */
+function openStream(chart) {
+  const source = new EventSource("/api/stream?device=default");
+  let resync = false;
+  source.addEventListener("reading", (e) => appendRows(chart, [JSON.parse(e.data)]));
+  source.addEventListener("dropped", () => pollHistory(chart));
+  source.addEventListener("error", () => { resync = true; });
+  source.addEventListener("open", () => {
+    if (resync) pollHistory(chart);
+    resync = false;
+  });
+}
+
 /**
  * Sets up event listeners for the time range buttons and reset zoom.
  * @param {Chart} chart - The Chart.js instance.
@@ -185,7 +306,7 @@ function setupChartControls(chart) {
 
       localStorage.removeItem(ZOOM_START_KEY);
       localStorage.removeItem(ZOOM_END_KEY);
-      chart.update("none");
+      loadRange(chart, range).finally(() => chart.update("none"));
     });
   });
 
@@ -214,20 +335,21 @@ function initDashboard() {
   fetch(API_URL)
     .then((r) => r.json())
     .then((res) => {
-      if (res.status !== "ok" || !Array.isArray(res.data) || res.data.length === 0) {
+      if (res.status !== "ok" || !res.data || !Array.isArray(res.data.t) || res.data.t.length === 0) {
         document.getElementById("latest-val").textContent = "No Data Available";
         return;
       }
 
       const data = res.data;
       const datasets = {
-        temp: mapData(data, "temp_f"),
-        hum: mapData(data, "humidity"),
-        lux: mapData(data, "lux"),
-        moist: mapData(data, "moisture")
+        temp: mapColumns(data, "temp_f"),
+        hum: mapColumns(data, "humidity"),
+        lux: mapColumns(data, "lux"),
+        moist: mapColumns(data, "moisture")
       };
 
-      updateSummaryCardValues(data.at(-1), datasets);
+      updateAverageCards(res.summary);
+      loadLatest();
       renderSparklines(datasets, styles);
 
       const chart = renderMainChart(datasets, styles);
@@ -272,20 +394,25 @@ function downloadCSV(csvContent, filename) {
 
 /**
  * Exports the sensor data as a CSV file when the button is clicked.
+ * The chart only holds downsampled points, so the full history is fetched on demand.
  */
-function setupExportCsvButton(data) {
+function setupExportCsvButton() {
   const button = document.getElementById("exportCsv");
 
   button.addEventListener("click", () => {
     // Define the columns we want to include in the CSV file
     const columns = ['timestamp', 'temp_f', 'humidity', 'lux', 'moisture'];
 
-    // Convert the data into CSV format
-    const csvContent = convertToCSV(data, columns);
+    fetch(EXPORT_URL)
+      .then((r) => r.json())
+      .then((res) => {
+        // Convert the data into CSV format
+        const csvContent = convertToCSV(res.data || [], columns);
 
-    // Trigger the download with a filename
-    const filename = 'sensor_data.csv';
-    downloadCSV(csvContent, filename);
+        // Trigger the download with a filename
+        const filename = 'sensor_data.csv';
+        downloadCSV(csvContent, filename);
+      });
   });
 }
 
@@ -303,27 +430,35 @@ function initDashboard() {
   fetch(API_URL)
     .then((r) => r.json())
     .then((res) => {
-      if (res.status !== "ok" || !Array.isArray(res.data) || res.data.length === 0) {
+      if (res.status !== "ok" || !res.data || !Array.isArray(res.data.t) || res.data.t.length === 0) {
         document.getElementById("latest-val").textContent = "No Data Available";
         return;
       }
 
       const data = res.data;
       const datasets = {
-        temp: mapData(data, "temp_f"),
-        hum: mapData(data, "humidity"),
-        lux: mapData(data, "lux"),
-        moist: mapData(data, "moisture")
+        temp: mapColumns(data, "temp_f"),
+        hum: mapColumns(data, "humidity"),
+        lux: mapColumns(data, "lux"),
+        moist: mapColumns(data, "moisture")
       };
 
-      updateSummaryCardValues(data.at(-1), datasets);
+      updateAverageCards(res.summary);
+      loadLatest();
       renderSparklines(datasets, styles);
 
       const chart = renderMainChart(datasets, styles);
       setupChartControls(chart);
 
       // Setup the Export CSV button
-      setupExportCsvButton(data);
+      setupExportCsvButton();
+
+      historyCursor = res.cursor || null;
+      if ("EventSource" in window) {
+        openStream(chart);
+      } else {
+        setInterval(() => pollHistory(chart), POLL_MS);
+      }
     })
     .catch(() => {
       document.getElementById("latest-val").textContent = "Error Loading Data";
@@ -0,0 +1,722 @@
+# storage.py
+# Time-partitioned columnar storage for sensor readings.
+#
+# Each segment covers one day (or hour) and lives in its own directory under
+# SEGMENT_DIR, holding one little-endian binary file per column:
+#
+#   segments/2025-08-20/t.i64        epoch seconds (int64)
+#   segments/2025-08-20/temp_f.f32   float32 values, same row order
+#   ...
+#
+# Appends are a few fixed-width writes under the segment's .lock, which first
+# cuts every column back to their common length (a crash between column
+# writes leaves a ragged tail), and a range query only opens the segments it
+# overlaps. The legacy raw_sensorlog*.csv files are still read.
+#
+# Old data moves to the archive tier (see compaction.py): one compressed file
+# per month, archive/2025-07.gea, made of blocks of ARCHIVE_BLOCK_ROWS rows
+# with a block index (offset, length, rows, t_min, t_max) at the end, so a
+# range read only decompresses the blocks it overlaps. read_range merges hot
+# segments, legacy CSVs and archives transparently.
+#
+# Storage is sharded per device: the default device lives directly under
+# LOG_DIR (so existing installs keep their paths), every other device under
+# LOG_DIR/devices/<device_id>/ with the same layout.
+#
+# Every append also goes to the device's write journal (see journal.py), which
+# the /api/history ?since= cursor follows. Appender.append returns the rows it
+# stored, which is all of them except with sqlite (one reading per second).
+#
+# STORAGE_BACKEND=sqlite keeps everything in one database instead (see
+# sqlite_store.py); Appender, read_range and list_devices hand over to it.
+import calendar
+import csv
+import fcntl
+import logging
+import os
+import re
+import shutil
+import struct
+import tempfile
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+import csv_index
+from settings import ARCHIVE_DIR, LOG_DIR, RAW_LOG_FILE, SEGMENT_DIR, SEGMENT_SPAN, STORAGE_BACKEND
+
+# optional: zstd archives (zlib otherwise)
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+METRICS = ("temp_f", "humidity", "lux", "moisture")
+PRECISION = {"temp_f": 2, "humidity": 2, "lux": 1, "moisture": 1}
+
+# segment span -> (directory name format, seconds)
+SPANS = {"day": ("%Y-%m-%d", 86400), "hour": ("%Y-%m-%dT%H", 3600)}
+
+TS_FILE = "t.i64"
+LOCK_FILE = ".lock"
+
+DEFAULT_DEVICE = "default"
+DEVICE_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,32}$")
+DEVICES_DIR = os.path.join(LOG_DIR, "devices")
+
+
+# -- devices -----------------------------------------------------------------
+
+def valid_device(device_id):
+    return isinstance(device_id, str) and bool(DEVICE_ID_RE.match(device_id))
+
+
+def device_root(device=DEFAULT_DEVICE):
+    if device == DEFAULT_DEVICE:
+        return LOG_DIR
+    if not valid_device(device):
+        raise ValueError(f"Invalid device_id: {device}")
+    return os.path.join(DEVICES_DIR, device)
+
+
+def segment_dir(device=DEFAULT_DEVICE):
+    return SEGMENT_DIR if device == DEFAULT_DEVICE else os.path.join(device_root(device), "segments")
+
+
+def archive_dir(device=DEFAULT_DEVICE):
+    return ARCHIVE_DIR if device == DEFAULT_DEVICE else os.path.join(device_root(device), "archive")
+
+
+def csv_log_file(device=DEFAULT_DEVICE):
+    return RAW_LOG_FILE if device == DEFAULT_DEVICE else os.path.join(device_root(device), "raw_sensorlog.csv")
+
+
+def list_devices():
+    if STORAGE_BACKEND == "sqlite":
+        import sqlite_store  # imports this module
+        return sqlite_store.list_devices()
+    return list_file_devices()
+
+
+def list_file_devices():
+    """Devices with a shard on disk (whatever the configured backend)."""
+    try:
+        names = sorted(n for n in os.listdir(DEVICES_DIR) if valid_device(n) and n != DEFAULT_DEVICE)
+    except FileNotFoundError:
+        names = []
+    return [DEFAULT_DEVICE, *names]
+
+
+# -- timestamps --------------------------------------------------------------
+
+def to_epoch(ts):
+    """Parse a logged timestamp into epoch seconds. Naive values are local time."""
+    if isinstance(ts, (int, float)):
+        return int(ts)
+    ts = ts.strip()
+    if len(ts) == 20 and ts[10] == "T" and ts[19] == "Z":
+        # fast path for the "YYYY-MM-DDTHH:MM:SSZ" format we write
+        return calendar.timegm((int(ts[0:4]), int(ts[5:7]), int(ts[8:10]),
+                                int(ts[11:13]), int(ts[14:16]), int(ts[17:19])))
+    try:
+        return int(datetime.fromisoformat(ts.replace("Z", "+00:00")).timestamp())
+    except ValueError:
+        # format written by the old FastAPI server
+        return int(datetime.strptime(ts, "%Y-%m-%d %I:%M:%S %p").timestamp())
+
+
+def format_ts(epoch):
+    return datetime.fromtimestamp(int(epoch), timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+# -- column helpers ----------------------------------------------------------
+
+def empty_columns():
+    cols = {"t": np.empty(0, dtype=np.int64)}
+    for m in METRICS:
+        cols[m] = np.empty(0, dtype=np.float32)
+    return cols
+
+
+def concat_columns(parts):
+    parts = [p for p in parts if len(p["t"])]
+    if not parts:
+        return empty_columns()
+    if len(parts) == 1:
+        return parts[0]
+    return {k: np.concatenate([p[k] for p in parts]) for k in parts[0]}
+
+
+def slice_columns(cols, start=None, end=None):
+    """Keep rows with start <= t < end and return them sorted by time."""
+    t = cols["t"]
+    mask = np.ones(len(t), dtype=bool)
+    if start is not None:
+        mask &= t >= start
+    if end is not None:
+        mask &= t < end
+    if not mask.all():
+        cols = {k: v[mask] for k, v in cols.items()}
+    t = cols["t"]
+    if len(t) > 1 and (np.diff(t) < 0).any():
+        order = np.argsort(t, kind="stable")
+        cols = {k: v[order] for k, v in cols.items()}
+    return cols
+
+
+def dedupe_columns(cols):
+    """Drop rows identical to another row in every column; sorted by time."""
+    if len(cols["t"]) < 2:
+        return cols
+    order = np.lexsort([cols[m] for m in reversed(METRICS)] + [cols["t"]])
+    cols = {k: v[order] for k, v in cols.items()}
+    keep = np.ones(len(order), dtype=bool)
+    keep[1:] = np.logical_or.reduce([v[1:] != v[:-1] for v in cols.values()])
+    return cols if keep.all() else {k: v[keep] for k, v in cols.items()}
+
+
+# -- segments ----------------------------------------------------------------
+
+def _span():
+    return SPANS.get(SEGMENT_SPAN, SPANS["day"])
+
+
+def _segment_path(epoch, device=DEFAULT_DEVICE):
+    fmt, _ = _span()
+    name = datetime.fromtimestamp(epoch, timezone.utc).strftime(fmt)
+    return os.path.join(segment_dir(device), name)
+
+
+def _parse_segment_name(name):
+    for fmt, seconds in SPANS.values():
+        try:
+            start = datetime.strptime(name, fmt).replace(tzinfo=timezone.utc).timestamp()
+        except ValueError:
+            continue
+        return int(start), int(start) + seconds
+    return None
+
+
+def list_segments(start=None, end=None, device=DEFAULT_DEVICE):
+    """Return [(seg_start, seg_end, path)] for segments overlapping [start, end)."""
+    root = segment_dir(device)
+    try:
+        names = os.listdir(root)
+    except FileNotFoundError:
+        return []
+    out = []
+    for name in sorted(names):
+        bounds = _parse_segment_name(name)
+        if bounds is None:
+            continue
+        lo, hi = bounds
+        if start is not None and hi <= start:
+            continue
+        if end is not None and lo >= end:
+            continue
+        out.append((lo, hi, os.path.join(root, name)))
+    return out
+
+
+def read_segment(path, start=None, end=None):
+    """Read a segment's columns, only loading the rows in [start, end) when the
+    segment is time-ordered (the normal case for live ingest)."""
+    try:
+        t = np.fromfile(os.path.join(path, TS_FILE), dtype="<i8")
+    except FileNotFoundError:
+        return empty_columns()
+
+    lo, hi = 0, len(t)
+    if (start is not None or end is not None) and len(t) and not (np.diff(t) < 0).any():
+        if start is not None:
+            lo = int(np.searchsorted(t, start, side="left"))
+        if end is not None:
+            hi = int(np.searchsorted(t, end, side="left"))
+        hi = max(lo, hi)
+    t = t[lo:hi]
+
+    cols = {"t": t}
+    for m in METRICS:
+        try:
+            cols[m] = np.fromfile(os.path.join(path, f"{m}.f32"), dtype="<f4",
+                                  offset=lo * 4, count=len(t))
+        except (FileNotFoundError, ValueError):
+            if not os.path.isdir(path):
+                return empty_columns()  # archived while we were reading; the archive has it
+            cols[m] = np.zeros(len(t), dtype=np.float32)
+    # a crash between column writes leaves a ragged tail; drop it
+    n = min(len(v) for v in cols.values())
+    return {k: v[:n] for k, v in cols.items()}
+
+
+# -- archive -------------------------------------------------------------------
+
+ARCHIVE_MAGIC = b"GEARC01\0"
+ARCHIVE_SUFFIX = ".gea"
+ARCHIVE_HEADER = struct.Struct("<8sB7x")  # magic, codec
+ARCHIVE_BLOCK = struct.Struct("<qqqqq")   # offset, length, rows, t_min, t_max
+ARCHIVE_FOOTER = struct.Struct("<qq8s")   # index offset, block count, magic
+ARCHIVE_BLOCK_ROWS = 4096
+CODECS = {"zlib": 0, "zstd": 1}
+
+_archive_indexes = {}  # path -> (stat, codec, blocks)
+
+
+def default_codec():
+    return "zstd" if zstandard is not None else "zlib"
+
+
+def _compress(codec, data):
+    if codec == CODECS["zstd"]:
+        return zstandard.ZstdCompressor(level=9).compress(data)
+    return zlib.compress(data, 9)
+
+
+def _decompress(codec, data):
+    if codec == CODECS["zstd"]:
+        if zstandard is None:
+            raise RuntimeError("archive is zstd-compressed but the zstandard module is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def month_bounds(epoch):
+    d = datetime.fromtimestamp(int(epoch), timezone.utc)
+    lo = datetime(d.year, d.month, 1, tzinfo=timezone.utc)
+    hi = datetime(d.year + d.month // 12, d.month % 12 + 1, 1, tzinfo=timezone.utc)
+    return int(lo.timestamp()), int(hi.timestamp())
+
+
+def archive_path(epoch, device=DEFAULT_DEVICE):
+    name = datetime.fromtimestamp(int(epoch), timezone.utc).strftime("%Y-%m")
+    return os.path.join(archive_dir(device), name + ARCHIVE_SUFFIX)
+
+
+def list_archives(start=None, end=None, device=DEFAULT_DEVICE):
+    """Return [(month_start, month_end, path)] for archives overlapping [start, end)."""
+    root = archive_dir(device)
+    try:
+        names = os.listdir(root)
+    except FileNotFoundError:
+        return []
+    out = []
+    for name in sorted(names):
+        if not name.endswith(ARCHIVE_SUFFIX):
+            continue
+        try:
+            month = datetime.strptime(name[:-len(ARCHIVE_SUFFIX)], "%Y-%m").replace(tzinfo=timezone.utc)
+        except ValueError:
+            continue
+        lo, hi = month_bounds(month.timestamp())
+        if start is not None and hi <= start:
+            continue
+        if end is not None and lo >= end:
+            continue
+        out.append((lo, hi, os.path.join(root, name)))
+    return out
+
+
+def archive_index(path):
+    """(codec, [(offset, length, rows, t_min, t_max)]) of an archive, cached
+    until the file is replaced."""
+    st = os.stat(path)
+    key = (st.st_ino, st.st_mtime_ns, st.st_size)
+    cached = _archive_indexes.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1], cached[2]
+    with open(path, "rb") as f:
+        magic, codec = ARCHIVE_HEADER.unpack(f.read(ARCHIVE_HEADER.size))
+        f.seek(-ARCHIVE_FOOTER.size, os.SEEK_END)
+        index_offset, count, tail = ARCHIVE_FOOTER.unpack(f.read(ARCHIVE_FOOTER.size))
+        if magic != ARCHIVE_MAGIC or tail != ARCHIVE_MAGIC:
+            raise ValueError(f"{path} is not an archive (or was truncated)")
+        f.seek(index_offset)
+        raw = f.read(count * ARCHIVE_BLOCK.size)
+    blocks = [ARCHIVE_BLOCK.unpack_from(raw, i * ARCHIVE_BLOCK.size) for i in range(count)]
+    _archive_indexes[path] = (key, codec, blocks)
+    return codec, blocks
+
+
+def _encode_block(cols):
+    # delta-encoded timestamps compress to almost nothing at a fixed interval
+    parts = [np.diff(cols["t"], prepend=0).astype("<i8").tobytes()]
+    parts += [cols[m].astype("<f4").tobytes() for m in METRICS]
+    return b"".join(parts)
+
+
+def _decode_block(data, rows):
+    cols = {"t": np.cumsum(np.frombuffer(data, dtype="<i8", count=rows))}
+    offset = rows * 8
+    for m in METRICS:
+        cols[m] = np.frombuffer(data, dtype="<f4", count=rows, offset=offset).copy()
+        offset += rows * 4
+    return cols
+
+
+def read_archive(path, start=None, end=None):
+    """Rows of an archive with start <= t < end, decompressing only the
+    blocks whose [t_min, t_max] overlaps the range."""
+    try:
+        codec, blocks = archive_index(path)
+        parts = []
+        with open(path, "rb") as f:
+            for offset, length, rows, lo, hi in blocks:
+                if start is not None and hi < start:
+                    continue
+                if end is not None and lo >= end:
+                    continue
+                f.seek(offset)
+                parts.append(_decode_block(_decompress(codec, f.read(length)), rows))
+    except FileNotFoundError:
+        return empty_columns()  # removed by retention
+    except (OSError, ValueError, RuntimeError, zlib.error) as e:
+        logger.error(f"[storage] failed reading archive {path}: {e}")
+        return empty_columns()
+    return slice_columns(concat_columns(parts), start, end)
+
+
+def write_archive(path, cols, codec=None):
+    """Replace `path` with an archive of `cols` (sorted by time), atomically."""
+    codec = CODECS[codec or default_codec()]
+    cols = slice_columns(cols)
+    n = len(cols["t"])
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=".archive-", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, codec))
+            index = []
+            for i in range(0, n, ARCHIVE_BLOCK_ROWS):
+                block = {k: v[i:i + ARCHIVE_BLOCK_ROWS] for k, v in cols.items()}
+                data = _compress(codec, _encode_block(block))
+                index.append((f.tell(), len(data), len(block["t"]), int(block["t"][0]), int(block["t"][-1])))
+                f.write(data)
+            index_offset = f.tell()
+            f.write(b"".join(ARCHIVE_BLOCK.pack(*b) for b in index))
+            f.write(ARCHIVE_FOOTER.pack(index_offset, len(index), ARCHIVE_MAGIC))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def remove_segment(path):
+    """Delete a segment directory. Writers holding its files notice the
+    unlinked lock file and reopen a fresh segment (see Appender)."""
+    shutil.rmtree(path, ignore_errors=True)
+
+
+# -- legacy CSV ----------------------------------------------------------------
+
+def read_csv_columns(path, start=None, end=None):
+    """Parse a raw_sensorlog CSV into columns, skipping junk rows.
+
+    Only the byte ranges the sparse index says can overlap [start, end) are read.
+    """
+    if not path or not os.path.exists(path) or os.path.getsize(path) == 0:
+        return empty_columns()
+
+    parts = []
+    with open(path, "rb") as f:
+        fieldnames = next(csv.reader([f.readline().decode("utf-8-sig")]), [])
+        for lo, hi in csv_index.byte_ranges(path, to_epoch, start, end):
+            f.seek(lo)
+            lines = f.read(hi - lo).decode("utf-8", errors="replace").splitlines()
+            parts.append(csv_lines_to_columns(lines, fieldnames, start, end))
+    return concat_columns(parts)
+
+
+def csv_lines_to_columns(lines, fieldnames, start=None, end=None, junk=None):
+    """Columns for CSV data lines (no header) with start <= t < end; junk rows
+    are skipped, or appended to the `junk` list as their raw lines."""
+    t, vals = [], {m: [] for m in METRICS}
+    reader = csv.DictReader(lines, fieldnames=fieldnames)
+    for row in reader:
+        try:
+            epoch = to_epoch(row.get("timestamp") or "")
+            if start is not None and epoch < start:
+                continue
+            if end is not None and epoch >= end:
+                continue
+            parsed = [float(row.get(m) or 0) if m == "moisture" else float(row[m]) for m in METRICS]
+        except (ValueError, TypeError, KeyError, AttributeError):
+            if junk is not None:
+                junk.append(lines[reader.line_num - 1])
+            continue
+        t.append(epoch)
+        for m, v in zip(METRICS, parsed):
+            vals[m].append(v)
+
+    cols = {"t": np.array(t, dtype=np.int64)}
+    for m in METRICS:
+        cols[m] = np.array(vals[m], dtype=np.float32)
+    return cols
+
+
+def legacy_csv_files(start=None, end=None, device=DEFAULT_DEVICE):
+    """raw_sensorlog.csv plus any raw_sensorlog_YYYY-MM-DD.csv overlapping the range."""
+    if device != DEFAULT_DEVICE:
+        path = csv_log_file(device)
+        return [path] if os.path.exists(path) else []
+    try:
+        names = os.listdir(LOG_DIR)
+    except FileNotFoundError:
+        return []
+    out = []
+    for name in sorted(names):
+        path = os.path.join(LOG_DIR, name)
+        if path == RAW_LOG_FILE:
+            out.append(path)
+            continue
+        if not (name.startswith("raw_sensorlog_") and name.endswith(".csv")):
+            continue
+        try:
+            day = datetime.strptime(name[len("raw_sensorlog_"):-len(".csv")], "%Y-%m-%d")
+        except ValueError:
+            continue
+        # file dates are local; pad a day either side for timezone skew
+        lo = (day - timedelta(days=1)).timestamp()
+        hi = (day + timedelta(days=2)).timestamp()
+        if start is not None and hi <= start:
+            continue
+        if end is not None and lo >= end:
+            continue
+        out.append(path)
+    return out
+
+
+# -- public API --------------------------------------------------------------
+
+def group_by_device(rows):
+    groups = {}
+    for row in rows:
+        groups.setdefault(row.get("device_id") or DEFAULT_DEVICE, []).append(row)
+    return groups
+
+
+def _align_columns(files):
+    """Cut a segment's column files (under its lock) back to the rows all of
+    them hold, so an append after a crash between column writes, or a partial
+    write, doesn't land misaligned."""
+    widths = [8] + [4] * len(METRICS)  # t.i64, then the .f32 columns
+    sizes = [os.fstat(f.fileno()).st_size for f, _ in files]
+    n = min(size // width for size, width in zip(sizes, widths))
+    for (f, _), size, width in zip(files, sizes, widths):
+        if size != n * width:
+            logger.warning(f"[storage] {f.name}: truncating a ragged tail ({size - n * width} bytes)")
+            os.ftruncate(f.fileno(), n * width)
+
+
+class Appender:
+    """Writes rows with the configured backend, keeping files open between calls.
+
+    A one-shot append (see `append`) opens and closes everything; the ingest
+    writer keeps one Appender for its lifetime so segment/CSV handles stay
+    open across group commits. Segment writes still take the segment flock
+    so a direct writer elsewhere can't interleave columns. A segment or CSV
+    that compaction archived or rewrote while it was open is reopened.
+    """
+
+    def __init__(self, max_open=32):
+        self.max_open = max_open
+        self._files = OrderedDict()  # path -> open file, LRU order
+        self._dirty = set()
+        self._db = None  # sqlite connection, opened on first append
+
+    def _open(self, path, mode):
+        f = self._files.get(path)
+        if f is not None:
+            self._files.move_to_end(path)
+            return f
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        f = open(path, mode, **({"newline": "", "encoding": "utf-8"} if "b" not in mode else {}))
+        self._files[path] = f
+        while len(self._files) > self.max_open:
+            old_path, old = self._files.popitem(last=False)
+            old.close()
+            self._dirty.discard(old_path)
+        return f
+
+    def _forget(self, prefix):
+        for path in [p for p in self._files if p == prefix or p.startswith(prefix + os.sep)]:
+            self._files.pop(path).close()
+            self._dirty.discard(path)
+
+    def append(self, rows):
+        """Write rows; returns the ones stored (with sqlite, a reading whose
+        device and second are already taken is skipped)."""
+        import journal  # imports this module
+        if isinstance(rows, dict):
+            rows = [rows]
+        if STORAGE_BACKEND == "sqlite":
+            import sqlite_store
+            if self._db is None:
+                self._db = sqlite_store.connect()
+            return sqlite_store.append(self._db, rows)  # one transaction, journal included
+        groups = group_by_device(rows)
+        for device, group in groups.items():
+            if STORAGE_BACKEND == "csv":
+                self._append_csv(group, device)
+            else:
+                self._append_segment(group, device)
+        # after the backend write, so a ?since= poller never sees a row before it is stored
+        for device, group in groups.items():
+            journal.append(group, device)
+        return rows
+
+    def _append_segment(self, rows, device):
+        by_segment = {}
+        for row in rows:
+            epoch = to_epoch(row["timestamp"])
+            by_segment.setdefault(_segment_path(epoch, device), []).append((epoch, row))
+
+        for path, items in by_segment.items():
+            ts = struct.pack(f"<{len(items)}q", *(e for e, _ in items))
+            values = {
+                m: struct.pack(f"<{len(items)}f", *(float(r.get(m, 0) or 0) for _, r in items))
+                for m in METRICS
+            }
+            while True:
+                files = [(self._open(os.path.join(path, TS_FILE), "ab"), ts)]
+                files += [(self._open(os.path.join(path, f"{m}.f32"), "ab"), values[m]) for m in METRICS]
+                # hold the segment lock so rows from concurrent writers stay aligned
+                lock = self._open(os.path.join(path, LOCK_FILE), "ab")
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if os.fstat(lock.fileno()).st_nlink:
+                    break
+                # compaction archived and removed this segment; start a new one
+                fcntl.flock(lock, fcntl.LOCK_UN)
+                self._forget(path)
+            try:
+                _align_columns(files)
+                for f, data in files:
+                    f.write(data)
+                    f.flush()
+                    self._dirty.add(f.name)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _append_csv(self, rows, device):
+        path = csv_log_file(device)
+        while True:
+            f = self._open(path, "a")
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if os.fstat(f.fileno()).st_ino == os.stat(path).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            # compaction replaced the file; write to the new one
+            fcntl.flock(f, fcntl.LOCK_UN)
+            self._forget(path)
+        w = csv.DictWriter(f, fieldnames=["timestamp", *METRICS])
+        try:
+            if f.tell() == 0:
+                w.writeheader()
+            for row in rows:
+                w.writerow({
+                    "timestamp": row["timestamp"],  # ideally "YYYY-MM-DDTHH:MM:SSZ"
+                    **{m: round(row[m], PRECISION[m]) for m in METRICS},
+                })
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+        self._dirty.add(path)
+        csv_index.refresh(path, to_epoch)
+
+    def sync(self):
+        """fsync every file written since the last sync."""
+        if self._db is not None:
+            import sqlite_store
+            sqlite_store.checkpoint(self._db)
+        for path in list(self._dirty):
+            f = self._files.get(path)
+            if f is not None:
+                os.fsync(f.fileno())
+        self._dirty.clear()
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files.clear()
+        self._dirty.clear()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+def append(rows):
+    """Persist one reading (dict) or a list of readings with the configured
+    backend, each into its device's shard (row["device_id"], default "default").
+    Returns the rows stored (see Appender.append)."""
+    appender = Appender()
+    try:
+        return appender.append(rows)
+    finally:
+        appender.close()
+
+
+def read_range(start=None, end=None, device=DEFAULT_DEVICE):
+    """Columns for one device's readings with start <= t < end (epoch seconds), sorted by time.
+
+    Hot tiers are read before the archive: rows compacted in between are then
+    seen twice rather than not at all, and the overlap is deduplicated.
+    """
+    if STORAGE_BACKEND == "sqlite":
+        import sqlite_store
+        return sqlite_store.read_range(start, end, device)
+    parts = [read_segment(path, start, end) for _, _, path in list_segments(start, end, device)]
+    for path in legacy_csv_files(start, end, device):
+        try:
+            parts.append(read_csv_columns(path, start, end))
+        except OSError as e:
+            logger.error(f"[storage] failed reading {path}: {e}")
+    archived = [read_archive(path, start, end) for _, _, path in list_archives(start, end, device)]
+    archived = [a for a in archived if len(a["t"])]
+    cols = slice_columns(concat_columns(parts + archived), start, end)
+    hot = [p for p in parts if len(p["t"])]
+    if archived and hot and min(p["t"].min() for p in hot) <= max(a["t"][-1] for a in archived):
+        # an archived segment left behind by an interrupted compaction, or a
+        # late reading for an archived day
+        cols = dedupe_columns(cols)
+    return cols
+
+
+def read_devices(devices, start=None, end=None, reader=None):
+    """{device: columns} for several devices, reading their shards in parallel.
+
+    `reader(start, end, device)` defaults to read_range; file reads release the
+    GIL, so threads overlap the I/O.
+    """
+    reader = reader or read_range
+    if len(devices) == 1:
+        return {devices[0]: reader(start, end, devices[0])}
+    with ThreadPoolExecutor(max_workers=min(len(devices), 8)) as pool:
+        futures = {d: pool.submit(reader, start, end, d) for d in devices}
+        return {d: f.result() for d, f in futures.items()}
+
+
+def columns_to_rows(cols):
+    """Row dicts in the shape /api/history has always returned."""
+    ts = [format_ts(t) for t in cols["t"].tolist()]
+    values = {m: np.round(cols[m].astype(np.float64), PRECISION[m]).tolist() for m in METRICS}
+    return [
+        {"timestamp": s, "display_time": s, **{m: values[m][i] for m in METRICS}}
+        for i, s in enumerate(ts)
+    ]
+
+
+def columns_to_arrays(cols):
+    """Compact columnar shape (?format=columns): epoch seconds in "t" and one
+    rounded array per metric, left as NumPy for the JSON encoder."""
+    out = {"t": cols["t"].astype(np.int64)}
+    for m in METRICS:
+        out[m] = np.round(cols[m].astype(np.float64), PRECISION[m])
+    return out
@@ -0,0 +1,225 @@
+# stream_hub.py
+# Fan-out of accepted readings to /api/stream (Server-Sent Events) clients in
+# every gunicorn worker.
+#
+# Each worker that has subscribers binds one Unix datagram socket under
+# logs/stream/<pid>.sock and runs one listener thread (a greenlet under the
+# gevent worker). `publish` sends every new reading once to each bound
+# socket. The listener formats the SSE frame once and hands the same bytes to
+# every local subscriber, so ten open tabs cost ten queue appends, not ten
+# reads or encodes.
+#
+# Backpressure is per client: each subscriber has a bounded queue. When a
+# slow client falls behind, its oldest frames are dropped and it gets a
+# "dropped" event so the page can resync from /api/history?since=. A worker
+# whose socket buffer is full simply misses that reading; publishers never block.
+#
+# The async FastAPI server (dashboard/fastapi) uses `subscribe_async`: the
+# listener thread hands frames to the event loop instead of waking a waiter.
+import asyncio
+import atexit
+import errno
+import json
+import logging
+import os
+import socket
+import threading
+from collections import deque
+
+from settings import STREAM_DIR
+from storage import DEFAULT_DEVICE
+
+logger = logging.getLogger("dashboard")
+
+CLIENT_QUEUE = int(os.getenv("STREAM_CLIENT_QUEUE", 100))
+KEEPALIVE = float(os.getenv("STREAM_KEEPALIVE", 15))
+MAX_DATAGRAM = 64 * 1024
+
+
+def frame(event, data):
+    """One SSE frame as bytes."""
+    return f"event: {event}\ndata: {data}\n\n".encode()
+
+
+class Subscriber:
+    def __init__(self, hub, device=None, maxsize=CLIENT_QUEUE):
+        self.hub = hub
+        self.device = device
+        self.dropped = 0
+        self._frames = deque()
+        self._maxsize = maxsize
+        self._cond = threading.Condition()
+
+    def put(self, device, data):
+        if self.device is not None and device != self.device:
+            return
+        with self._cond:
+            if len(self._frames) >= self._maxsize:
+                self._frames.popleft()
+                self.dropped += 1
+            self._frames.append(data)
+            self._cond.notify()
+
+    def get(self, timeout=KEEPALIVE):
+        """Frames queued since the last call (possibly none after `timeout`)."""
+        with self._cond:
+            if not self._frames:
+                self._cond.wait(timeout)
+            frames = list(self._frames)
+            self._frames.clear()
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            frames.insert(0, frame("dropped", json.dumps({"dropped": dropped})))
+        return frames
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class AsyncSubscriber(Subscriber):
+    """A subscriber read from an asyncio event loop; `put` may be called from
+    any thread."""
+
+    def __init__(self, hub, device=None, maxsize=CLIENT_QUEUE, loop=None):
+        super().__init__(hub, device, maxsize)
+        self._loop = loop or asyncio.get_running_loop()
+        self._ready = asyncio.Event()
+
+    def put(self, device, data):
+        if self.device is not None and device != self.device:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._put, data)
+        except RuntimeError:
+            pass  # loop closed; the stream is gone
+
+    def _put(self, data):
+        if len(self._frames) >= self._maxsize:
+            self._frames.popleft()
+            self.dropped += 1
+        self._frames.append(data)
+        self._ready.set()
+
+    async def get(self, timeout=KEEPALIVE):
+        """Frames queued since the last call (possibly none after `timeout`)."""
+        if not self._frames:
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self._ready.clear()
+        frames = list(self._frames)
+        self._frames.clear()
+        dropped, self.dropped = self.dropped, 0
+        if dropped:
+            frames.insert(0, frame("dropped", json.dumps({"dropped": dropped})))
+        return frames
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+class StreamHub:
+    def __init__(self, directory=STREAM_DIR):
+        self.directory = directory
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._sock = None
+        self._pid = None
+        self._send_sock = None
+        self._send_pid = None
+
+    # -- subscribers (this worker) ---------------------------------------------
+    def subscribe(self, device=None):
+        return self._add(Subscriber(self, device))
+
+    def subscribe_async(self, device=None):
+        """Subscribe from a coroutine; see AsyncSubscriber."""
+        return self._add(AsyncSubscriber(self, device))
+
+    def _add(self, sub):
+        with self._lock:
+            self._ensure_listener()
+            self._subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def subscribers(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def _ensure_listener(self):
+        # threads and sockets don't survive fork, so bind lazily per worker
+        if self._sock is not None and self._pid == os.getpid():
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{os.getpid()}.sock")
+        if os.path.exists(path):
+            os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        self._sock, self._pid = sock, os.getpid()
+        atexit.register(_unlink, path)
+        threading.Thread(target=self._listen, args=(sock,), name="stream-hub", daemon=True).start()
+
+    def _listen(self, sock):
+        while True:
+            try:
+                payload = sock.recv(MAX_DATAGRAM)
+            except OSError as e:
+                logger.error(f"[stream] listener stopped: {e}")
+                return
+            try:
+                device = json.loads(payload).get("device_id") or DEFAULT_DEVICE
+            except ValueError:
+                continue
+            data = frame("reading", payload.decode())
+            with self._lock:
+                subscribers = list(self._subscribers)
+            for sub in subscribers:
+                sub.put(device, data)
+
+    # -- publishing (any worker) -----------------------------------------------
+    def publish(self, readings):
+        """Broadcast the newest reading per device to every listening worker."""
+        if isinstance(readings, dict):
+            readings = [readings]
+        newest = {}
+        for r in readings:
+            newest[r.get("device_id") or DEFAULT_DEVICE] = r
+        try:
+            names = [n for n in os.listdir(self.directory) if n.endswith(".sock")]
+        except FileNotFoundError:
+            return  # nobody ever subscribed
+        if not names:
+            return
+        sock = self._sender()
+        for reading in newest.values():
+            payload = json.dumps(reading, default=float).encode()
+            for name in names:
+                path = os.path.join(self.directory, name)
+                try:
+                    sock.sendto(payload, path)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    _unlink(path)  # worker exited without cleaning up
+                except OSError as e:
+                    if e.errno not in (errno.EAGAIN, errno.ENOBUFS):
+                        raise
+                    logger.warning(f"[stream] {name} is backed up, dropped a reading")
+
+    def _sender(self):
+        if self._send_sock is None or self._send_pid != os.getpid():
+            self._send_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._send_sock.setblocking(False)
+            self._send_pid = os.getpid()
+        return self._send_sock
+
+
+hub = StreamHub()
@@ -0,0 +1,129 @@
+import numpy as np
+import pytest
+
+import anomaly
+from storage import format_ts
+
+CFG = anomaly.DEFAULT_ANOMALY
+T0 = 1_760_000_000
+
+
+def fresh():
+    return np.array([anomaly._EMPTY])[0]  # a writable record, like a slot's in the table
+
+
+def feed(metric, values, step=60, st=None, t0=T0):
+    """Run values through check() at `step`-second intervals; kinds per reading."""
+    st = fresh() if st is None else st
+    rule = CFG["metrics"][metric]
+    return st, [anomaly.check(rule, st, t0 + i * step, float(v), CFG) for i, v in enumerate(values)]
+
+
+def steady(n=30, level=70.0):
+    return [level + (0.2 if i % 2 else -0.2) for i in range(n)]
+
+
+def test_steady_readings_are_clean():
+    st, kinds = feed("temp_f", steady())
+    assert all(k == [] for k in kinds)
+    assert st["n"] == 30
+    assert st["mean"] == pytest.approx(70.0, abs=0.2)
+
+
+def test_spike_after_warmup():
+    st, kinds = feed("temp_f", steady() + [95.0], step=600)  # slow enough not to trip the rate rule
+    assert kinds[-1] == ["spike"]
+    assert st["n"] == 30  # the spike didn't move the model
+
+
+def test_no_spike_check_during_warmup():
+    _, kinds = feed("temp_f", steady(5) + [95.0], step=600)
+    assert kinds[-1] == []
+
+
+def test_rate_scales_with_the_interval():
+    _, fast = feed("temp_f", [70.0, 80.0], step=60)
+    _, slow = feed("temp_f", [70.0, 80.0], step=600)
+    assert fast[-1] == ["rate"]
+    assert slow[-1] == []
+
+
+def test_same_second_readings_skip_the_rate_rule():
+    _, kinds = feed("temp_f", [70.0, 80.0], step=0)
+    assert kinds[-1] == []
+
+
+def test_stuck_value():
+    _, kinds = feed("temp_f", [70.0] * 4, step=3600)
+    assert [k for k in kinds] == [[], [], ["stuck"], ["stuck"]]
+
+
+def test_stuck_ignores_listed_values():
+    _, kinds = feed("lux", [0.0] * 5, step=3600)
+    assert all(k == [] for k in kinds)
+
+
+def test_zero_after_a_real_mean_but_not_before():
+    _, kinds = feed("humidity", steady(level=50.0) + [0.0])
+    assert "zero" in kinds[-1]
+    _, first = feed("moisture", [0.0])
+    assert first == [[]]
+
+
+def test_sustained_shift_reseeds_the_model():
+    st, kinds = feed("temp_f", steady() + [90.0] * CFG["reseed"], step=600)
+    assert all(k == ["spike"] for k in kinds[30:-1])
+    assert kinds[-1] == []
+    assert st["mean"] == 90.0
+    assert st["run"] == 0
+
+
+def test_backfilled_reading_does_not_change_the_model():
+    st, _ = feed("temp_f", steady())
+    before = st.copy()
+    kinds = anomaly.check(CFG["metrics"]["temp_f"], st, T0 - 600, 70.1, CFG)
+    assert kinds == []
+    assert st.tobytes() == before.tobytes()
+
+
+def test_stale_model_restarts():
+    st, _ = feed("temp_f", steady())
+    kinds = anomaly.check(CFG["metrics"]["temp_f"], st, T0 + 30 * 60 + CFG["stale"] + 1, 40.0, CFG)
+    assert kinds == []
+    assert st["mean"] == 40.0
+
+
+def rows(device, values, step=60):
+    return [{"timestamp": format_ts(T0 + i * step), "device_id": device,
+             "temp_f": v, "humidity": 50.0 + i % 2, "lux": 10.0 * i, "moisture": 30.0 + i % 2}
+            for i, v in enumerate(values)]
+
+
+def test_screen_flags_and_keeps_state_across_calls(device):
+    kept, flagged = anomaly.screen(rows(device, steady()), mode="flag")
+    assert len(kept) == 30 and flagged == []
+    late = rows(device, steady(31) + [95.0])[-1:]
+    late[0]["timestamp"] = format_ts(T0 + 29 * 60 + 1800)  # within `stale`, too slow for a rate alert
+    kept, flagged = anomaly.screen(late, mode="flag")
+    assert kept == late
+    assert flagged == [(late[0], ["temp_f:spike"])]
+    info = anomaly.summary(device)[device]["temp_f"]
+    assert info["counts"]["spike"] == 1
+    assert info["last_anomaly"]["value"] == 95.0
+
+
+def test_quarantine_holds_anomalies_back(device):
+    batch = rows(device, steady() + [70.0, 71.0])
+    batch[-2]["humidity"] = 0.0
+    kept, flagged = anomaly.screen(batch, mode="quarantine")
+    assert len(kept) == 31
+    assert batch[-2] not in kept
+    assert "humidity:zero" in flagged[0][1]
+    with open(anomaly.QUARANTINE_FILE) as f:
+        assert device in f.read()
+
+
+def test_reset_forgets_a_device(device):
+    anomaly.screen(rows(device, steady(3)), mode="flag")
+    anomaly.reset(device)
+    assert anomaly.summary(device)[device] == {}
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+import daily_stats
+import storage
+
+DAY = 86400
+T0 = 1_760_000_000 // DAY * DAY  # a UTC midnight; the tests run with TZ=UTC
+D0 = T0 // DAY
+
+
+def rows(device, ts):
+    return [{"timestamp": storage.format_ts(int(t)), "device_id": device, "temp_f": 60.0 + t % 7,
+             "humidity": 50.0, "lux": 1000.0 + t % 11, "moisture": 30.0} for t in ts]
+
+
+def ingest(device, ts):
+    """Store readings and fold them into the day records, as ingest would."""
+    batch = rows(device, ts)
+    storage.append(batch)
+    daily_stats.update(batch)
+
+
+def from_raw(device, first, last):
+    cols = storage.read_range(None, (last + 1) * DAY, device)
+    recs = daily_stats.aggregate({k: np.asarray(v) for k, v in cols.items()})
+    return recs[recs["day"] >= first]
+
+
+def test_empty_store_is_covered_from_the_start(device):
+    ingest(device, range(T0, T0 + 2 * DAY, 300))
+    assert daily_stats.covered_from(device) == daily_stats._ALL_DAYS
+    ingest(device, range(T0 - DAY, T0, 300))  # backfill into a day before the first fold
+    recs = daily_stats.read_days(D0 - 1, D0 + 1, device)
+    raw = from_raw(device, D0 - 1, D0 + 1)
+    # backfilled readings add no light (see daily_stats.py)
+    sums = [f for f in daily_stats.RECORD.names if f not in ("dli", "light_s")]
+    assert recs[sums].tolist() == raw[sums].tolist()
+
+
+def test_days_with_older_readings_come_from_raw_rows(device, caplog):
+    storage.append(rows(device, range(T0, T0 + DAY + 3600, 300)))  # stored before any fold
+    ingest(device, range(T0 + DAY + 3600, T0 + 3 * DAY, 300))
+    assert daily_stats.covered_from(device) == D0 + 2
+    assert "python daily_stats.py rebuild" in caplog.text
+    assert daily_stats.read_days(D0 + 1, D0 + 1, device)["n"].tolist() == [288]
+    recs = daily_stats.read_days(D0, D0 + 2, device)
+    assert recs.tolist() == from_raw(device, D0, D0 + 2).tolist()
+
+
+def test_rebuild_covers_every_day(device):
+    storage.append(rows(device, range(T0, T0 + DAY, 600)))
+    ingest(device, range(T0 + DAY, T0 + 2 * DAY, 600))
+    daily_stats.rebuild()
+    assert daily_stats.covered_from(device) == daily_stats._ALL_DAYS
+    assert daily_stats.read_days(D0, D0, device)["n"].tolist() == [144]
+
+
+def test_prune_drops_days_that_ended_by_the_cutoff(device):
+    ingest(device, range(T0, T0 + 3 * DAY, 3600))
+    assert daily_stats.prune(T0 + DAY + 1800, device) == 1
+    assert daily_stats.read_days(device=device)["day"].tolist() == [D0 + 1, D0 + 2]
+    assert daily_stats.prune(T0 + DAY + 1800, device) == 0
+
+
+@pytest.mark.parametrize("args, message", [
+    ({"base": "warm"}, "base must be a number"),
+    ({"base": "nan"}, "base must be a number"),
+    ({"cap": "hot"}, "cap must be a number or 'none'"),
+    ({"window": "week"}, "window must be 1-90 days"),
+    ({"window": "91"}, "window must be 1-90 days"),
+])
+def test_parse_query_rejects_bad_numbers(args, message):
+    with pytest.raises(ValueError, match=message):
+        daily_stats.parse_query(args)
+
+
+def test_parse_query_cap_none():
+    assert daily_stats.parse_query({"cap": "None", "base": "40"})["cap"] is None
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from downsample import downsample, lttb_indices
+from storage import METRICS
+
+
+@pytest.fixture
+def cols():
+    rng = np.random.default_rng(5)
+    n = 5000
+    out = {"t": np.arange(1_760_000_000, 1_760_000_000 + 30 * n, 30, dtype=np.int64)}
+    for i, m in enumerate(METRICS):
+        # uncorrelated series, so per-metric picks would rarely coincide
+        out[m] = (np.sin(np.arange(n) / (50 + 40 * i)) * 10 * (i + 1) + rng.normal(0, 1, n)).astype(np.float32)
+    return out
+
+
+@pytest.mark.parametrize("method", ["lttb", "minmax"])
+@pytest.mark.parametrize("points", [3, 7, 8, 100, 999])
+def test_points_caps_the_row_count(cols, method, points):
+    out = downsample(cols, points=points, method=method)
+    assert 3 <= len(out["t"]) <= points
+    assert np.all(np.diff(out["t"]) > 0)
+    assert set(out) == set(cols)
+
+
+def test_lttb_keeps_the_ends_and_one_row_per_bucket(cols):
+    out = downsample(cols, points=200)
+    assert len(out["t"]) == 200
+    assert out["t"][0] == cols["t"][0] and out["t"][-1] == cols["t"][-1]
+
+
+def test_lttb_keeps_a_spike_in_any_metric(cols):
+    cols["lux"][2345] = 1e6
+    out = downsample(cols, points=50)
+    assert cols["t"][2345] in out["t"]
+
+
+def test_minmax_keeps_every_metric_extreme(cols):
+    out = downsample(cols, points=80, method="minmax")
+    for m in METRICS:
+        assert out[m].max() == cols[m].max()
+        assert out[m].min() == cols[m].min()
+
+
+def test_single_series_lttb_matches_the_2d_form(cols):
+    x = cols["t"].astype(np.float64)
+    y = cols["temp_f"].astype(np.float64)
+    assert lttb_indices(x, y, 60).tolist() == lttb_indices(x, y[None, :], 60).tolist()
+
+
+def test_resolution_buckets_by_time(cols):
+    out = downsample(cols, resolution=3600)
+    buckets = (out["t"] - cols["t"][0]) // 3600
+    assert np.bincount(buckets).max() <= 2 * len(METRICS)
+    assert len(np.unique(buckets)) == len(np.unique((cols["t"] - cols["t"][0]) // 3600))
+
+
+def test_small_inputs_are_returned_as_is(cols):
+    short = {k: v[:50] for k, v in cols.items()}
+    assert downsample(short, points=100) is short
@@ -0,0 +1,97 @@
+import pytest
+
+import journal
+import latest_store
+import sensor_utils
+import storage
+
+T0 = 1_760_000_000
+
+
+def write(device, *offsets, temp=70.0):
+    """Store readings at T0 + offsets the way ingest does (storage, then latest_store)."""
+    rows = [{"timestamp": storage.format_ts(T0 + dt), "device_id": device,
+             "temp_f": temp, "humidity": 50.0, "lux": 100.0, "moisture": 30.0} for dt in offsets]
+    storage.append(rows)
+    latest_store.record(rows)
+
+
+def since(cursor, device):
+    rows, nxt, err = sensor_utils.load_log_since(cursor, device=device)
+    assert err is None
+    return [storage.to_epoch(r["timestamp"]) - T0 for r in rows], nxt
+
+
+def test_cursor_of_an_unknown_device_sees_its_first_rows(device):
+    cursor = sensor_utils.current_cursor(device)
+    assert cursor == "w0"
+    write(device, 1, 2)
+    assert since(cursor, device) == ([1, 2], "w2")
+
+
+def test_cursor_returns_only_rows_written_after_it(device):
+    write(device, 10, 20)
+    cursor = sensor_utils.current_cursor(device)
+    assert since(cursor, device) == ([], cursor)
+    write(device, 30)
+    assert since(cursor, device) == ([30], "w3")
+
+
+def test_backfilled_rows_are_delivered(device):
+    write(device, 100, 200)
+    cursor = sensor_utils.current_cursor(device)
+    write(device, 50, 300)  # a device flushing its offline buffer, then a live reading
+    write(device, 150)
+    got, cursor = since(cursor, device)
+    assert got == [50, 150, 300]  # sorted by time
+    assert since(cursor, device) == ([], cursor)
+
+
+def test_rows_sharing_a_second_are_not_lost(device):
+    write(device, 5, 5)
+    cursor = sensor_utils.current_cursor(device)
+    write(device, 5, temp=71.0)
+    rows, _, _ = sensor_utils.load_log_since(cursor, device=device)
+    assert [r["temp_f"] for r in rows] == [71.0]
+
+
+def test_expired_cursor_is_an_error(device, monkeypatch):
+    monkeypatch.setattr(journal, "JOURNAL_ROWS", 2)
+    write(device, 1)
+    old = sensor_utils.current_cursor(device)
+    write(device, 2, 3, 4, 5)  # trims the journal past `old`
+    rows, nxt, err = sensor_utils.load_log_since(old, device=device)
+    assert rows == [] and nxt is None
+    assert "expired" in err
+    assert since(sensor_utils.current_cursor(device), device)[0] == []
+
+
+def test_cursor_from_the_future_is_an_error(device):
+    write(device, 1)
+    assert "expired" in sensor_utils.load_log_since("w99", device=device)[2]
+
+
+@pytest.mark.parametrize("value, expected", [
+    (str(T0 + 15), [20]),                    # epoch seconds: strictly newer
+    (storage.format_ts(T0 + 15), [20]),      # ISO-8601
+    (f"{T0 + 10}:1", [10, 20]),              # older "<epoch>:<n>" cursor: skip one row at T0 + 10
+])
+def test_timestamp_since_still_works(device, value, expected):
+    write(device, 10, 10, 20)
+    assert since(value, device) == (expected, "w3")
+
+
+def test_invalid_since_is_rejected():
+    with pytest.raises(ValueError):
+        sensor_utils.parse_cursor("yesterday-ish")
+
+
+def test_etag_changes_on_writes_and_retention_deletes(device):
+    write(device, 1)
+    etag = sensor_utils.history_etag("since=x", [device], relative=False)
+    assert sensor_utils.history_etag("since=x", [device], relative=False) == etag
+    write(device, -100)  # backfill: the latest reading doesn't change, the history does
+    after_backfill = sensor_utils.history_etag("since=x", [device], relative=False)
+    assert after_backfill != etag
+    latest_store.bump(device)  # what compaction does after dropping rows
+    assert sensor_utils.history_etag("since=x", [device], relative=False) != after_backfill
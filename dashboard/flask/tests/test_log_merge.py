@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+import log_merge
+from storage import format_ts
+
+T0 = 1_760_000_000
+
+
+@pytest.mark.parametrize("direction, expected", [
+    ("backward", [-1, 0, 0, 1, 2]),
+    ("forward", [0, 0, 1, -1, -1]),
+    ("nearest", [0, 0, 0, 1, 2]),
+])
+def test_match_directions(direction, expected):
+    other = np.array([10.0, 20.0, 30.0])
+    t = np.array([9.0, 10.0, 14.0, 22.0, 31.0])
+    assert log_merge.match(t, other, direction, tolerance=6).tolist() == expected
+
+
+def test_match_tolerance_and_ties():
+    other = np.array([10.0, 20.0])
+    assert log_merge.match(np.array([15.0]), other, "nearest", 5).tolist() == [0]  # tie: backward
+    assert log_merge.match(np.array([15.0]), other, "nearest", 4.9).tolist() == [-1]
+    assert log_merge.match(np.array([15.0]), np.array([]), "nearest", 5).tolist() == [-1]
+
+
+def write_log(path, header, rows):
+    with open(path, "w") as f:
+        f.write(header + "\n")
+        for t, value in rows:
+            f.write(f"{format_ts(int(t))},{value}\n")
+    return str(path)
+
+
+@pytest.fixture
+def logs(tmp_path):
+    primary = write_log(tmp_path / "sensor.csv", "timestamp,temp_f", [(T0, 70), (T0 + 10, 71), (T0 + 20, 72)])
+    other = write_log(tmp_path / "veml.csv", "timestamp,als", [(T0 + 9, 5), (T0 + 12, 6)])
+    return primary, other, str(tmp_path / "out.csv")
+
+
+@pytest.mark.parametrize("direction, als", [("backward", "5"), ("forward", "6"), ("nearest", "5")])
+def test_merge_directions(logs, direction, als):
+    primary, other, out = logs
+    counts = log_merge.merge_files([primary, other], out, direction=direction, tolerance=3, how="inner")
+    with open(out) as f:
+        assert f.read().splitlines() == ["timestamp,temp_f,als", f"{format_ts(T0 + 10)},71,{als}"]
+    assert counts["written"] == 1 and counts["unmatched"] == 2
+
+
+def test_left_merge_keeps_unmatched_rows(logs):
+    primary, other, out = logs
+    log_merge.merge_files([primary, other], out, direction="forward", tolerance=3, how="left")
+    with open(out) as f:
+        assert f.read().splitlines()[1:] == [f"{format_ts(T0)},70,", f"{format_ts(T0 + 10)},71,6", f"{format_ts(T0 + 20)},72,"]
+
+
+def test_invalid_arguments(logs):
+    primary, other, out = logs
+    with pytest.raises(ValueError):
+        log_merge.merge_files([primary, other], out, direction="sideways")
+    with pytest.raises(ValueError):
+        log_merge.merge_files([primary, other], out, how="outer")
+    with pytest.raises(ValueError):
+        log_merge.merge_files([primary], out)
+
+
+@pytest.mark.parametrize("direction", log_merge.DIRECTIONS)
+def test_chunked_merge_equals_in_memory_match(tmp_path, direction):
+    rng = np.random.default_rng(11)
+    ta = np.sort(rng.choice(np.arange(T0, T0 + 20_000), 3000, replace=False))
+    tb = np.sort(rng.choice(np.arange(T0, T0 + 20_000), 2000, replace=False))
+    primary = write_log(tmp_path / "a.csv", "timestamp,temp_f", zip(ta, range(len(ta))))
+    other = write_log(tmp_path / "b.csv", "timestamp,als", zip(tb, range(len(tb))))
+    out = str(tmp_path / "out.csv")
+
+    counts = log_merge.merge_files([primary, other], out, direction=direction, tolerance=4, how="left",
+                                   chunk_bytes=2048)
+
+    idx = log_merge.match(ta.astype(np.float64), tb.astype(np.float64), direction, 4)
+    expected = [f"{format_ts(int(t))},{i},{j if j >= 0 else ''}" for i, (t, j) in enumerate(zip(ta, idx))]
+    with open(out) as f:
+        assert f.read().splitlines()[1:] == expected
+    assert counts["unmatched"] == int((idx < 0).sum())
+    assert counts["a.late"] == counts["b.late"] == 0
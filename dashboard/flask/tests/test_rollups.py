@@ -0,0 +1,93 @@
+import numpy as np
+import pytest
+
+import rollups
+import sensor_utils
+import storage
+
+DAY = 86400
+T0 = 1_760_000_000 // DAY * DAY
+
+
+def ingest(device, ts, rng):
+    """Store readings and fold them into the rollups, in batches as ingest would."""
+    rows = [{"timestamp": storage.format_ts(int(t)), "device_id": device,
+             "temp_f": float(rng.integers(200, 320)) / 4, "humidity": float(rng.integers(80, 360)) / 4,
+             "lux": float(rng.integers(0, 4000)), "moisture": float(rng.integers(40, 200)) / 4} for t in ts]
+    for i in range(0, len(rows), 97):
+        storage.append(rows[i:i + 97])
+        rollups.update(rows[i:i + 97])
+    return rows
+
+
+@pytest.fixture
+def history(device):
+    rng = np.random.default_rng(7)
+    ts = np.sort(rng.choice(np.arange(T0, T0 + 3 * DAY, 20), size=3000, replace=False))
+    ingest(device, ts, rng)
+    return device
+
+
+@pytest.mark.parametrize("level", ["1m", "1h", "1d"])
+def test_summary_from_rollups_matches_raw(history, level):
+    start, end = T0 + DAY, T0 + 3 * DAY  # aligned to every level
+    from_rollup = rollups.summarize(rollups.read_records(level, start, end, history))
+    from_raw = sensor_utils.summarize(storage.read_range(start, end, history))
+    assert from_rollup == from_raw
+
+
+@pytest.mark.parametrize("level", ["1m", "1h", "1d"])
+def test_bucket_records_match_raw_buckets(history, level):
+    width = rollups.LEVELS[level]
+    recs = rollups.read_records(level, device=history)
+    raw = storage.read_range(device=history)
+    buckets = raw["t"] // width * width
+    assert recs["t"].tolist() == np.unique(buckets).tolist()
+    for rec in recs[:: max(1, len(recs) // 25)]:
+        sel = buckets == rec["t"]
+        assert rec["n"] == sel.sum()
+        assert rec["last_t"] == raw["t"][sel][-1]
+        for m in storage.METRICS:
+            v = raw[m][sel].astype(np.float64)
+            assert rec[f"{m}_sum"] == pytest.approx(v.sum())
+            assert rec[f"{m}_min"] == v.min()
+            assert rec[f"{m}_max"] == v.max()
+            assert rec[f"{m}_last"] == v[-1]
+
+
+def test_out_of_order_folds_equal_one_aggregate(device):
+    rng = np.random.default_rng(3)
+    ts = np.arange(T0, T0 + 7200, 30)
+    ingest(device, ts[len(ts) // 2:], rng)
+    ingest(device, ts[:len(ts) // 2], rng)  # backfill after newer rows
+    recs = rollups.read_records("1h", device=device)
+    expected = rollups.aggregate(storage.read_range(device=device), 3600)
+    assert recs.tolist() == expected.tolist()
+
+
+def test_history_summary_is_the_same_for_rollup_and_raw(history):
+    via_rollup, via_raw = {}, {}
+    _, err = sensor_utils.load_log_data("all", rollup="1h", device=history, summary=via_rollup)
+    assert err is None
+    _, err = sensor_utils.load_log_data("all", rollup="raw", device=history, summary=via_raw)
+    assert err is None
+    assert via_rollup == via_raw
+    assert via_raw["n"] == 3000
+
+
+def test_auto_level_waits_for_complete_rollups(device):
+    storage.append([{"timestamp": storage.format_ts(T0), "device_id": device,
+                     "temp_f": 1, "humidity": 1, "lux": 1, "moisture": 1}])
+    # older readings stored before any fold: the levels can't be trusted yet
+    ingest(device, [T0 + 5 * DAY], np.random.default_rng(1))
+    assert not rollups.is_complete(device)
+    assert rollups.pick_level(T0, T0 + 30 * DAY, device=device) == "raw"
+
+
+def test_prune_drops_buckets_that_end_by_the_cutoff(history):
+    removed = rollups.prune(T0 + DAY + 1800, history)
+    assert removed > 0
+    assert rollups.read_records("1d", device=history)["t"].tolist() == [T0 + DAY, T0 + 2 * DAY]
+    assert rollups.read_records("1h", device=history)["t"][0] == T0 + DAY
+    assert rollups.read_records("1m", device=history)["t"][0] >= T0 + DAY + 1800
+    assert rollups.read_records("1m", device=history)["t"][0] < T0 + DAY + 3600
@@ -0,0 +1,67 @@
+import pytest
+
+import ingest_writer
+import journal
+import sqlite_store
+import storage
+
+T0 = 1_760_000_000
+
+
+def rows(device, *offsets, temp=70.0):
+    return [{"timestamp": storage.format_ts(T0 + dt), "device_id": device,
+             "temp_f": temp, "humidity": 50.0, "lux": 100.0, "moisture": 30.0} for dt in offsets]
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = sqlite_store.connect(str(tmp_path / "sensors.db"))
+    yield db
+    db.close()
+
+
+def since(db, seq, device):
+    cols, nxt = sqlite_store.journal_since(seq, device, db)
+    return (cols["t"] - T0).tolist(), nxt
+
+
+def test_append_returns_the_rows_stored(db, device):
+    first = rows(device, 1, 2, 2)
+    assert sqlite_store.append(db, first) == [first[0], first[1]]  # first of a second wins
+    again = rows(device, 2, 3, temp=71.0) + rows("other", 2)
+    assert sqlite_store.append(db, again) == again[1:]
+    assert sqlite_store.read_range(device=device, db=db)["temp_f"].tolist() == [70.0, 70.0, 71.0]
+
+
+def test_only_stored_rows_are_journaled_and_rolled_up(db, device):
+    sqlite_store.append(db, rows(device, 10, 20))
+    cursor = sqlite_store.journal_end(device, db)
+    assert cursor == 2
+    sqlite_store.append(db, rows(device, 20, 5))  # a retry, then a backfill
+    assert since(db, cursor, device) == ([5], 3)
+    assert since(db, 0, device) == ([10, 20, 5], 3)
+    assert sqlite_store.read_records("1d", device=device, db=db)["n"].sum() == 3
+
+
+def test_journal_cursors_expire(db, device, monkeypatch):
+    monkeypatch.setattr(journal, "JOURNAL_ROWS", 2)
+    sqlite_store.append(db, rows(device, 1))
+    old = sqlite_store.journal_end(device, db)
+    sqlite_store.append(db, rows(device, 2, 3, 4))  # trims the journal past `old`
+    with pytest.raises(journal.CursorExpired):
+        sqlite_store.journal_since(old, device, db)
+    with pytest.raises(journal.CursorExpired):
+        sqlite_store.journal_since(99, device, db)
+    assert since(db, sqlite_store.journal_end(device, db), device) == ([], 4)
+
+
+def test_journal_skips_rows_deleted_by_retention(db, device):
+    sqlite_store.append(db, rows(device, 1, 2, 3))
+    sqlite_store.prune(db, T0 + 2)
+    assert since(db, 0, device) == ([2, 3], 3)
+
+
+def test_writer_reply_skips_rows_by_index():
+    batch = [{"n": i} for i in range(4)]
+    assert ingest_writer.skip_rows(batch, [1, 3]) == [batch[0], batch[2]]
+    assert ingest_writer.skip_rows(batch, None) is batch
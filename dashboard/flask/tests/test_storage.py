@@ -0,0 +1,86 @@
+import os
+
+import numpy as np
+import pytest
+
+import storage
+
+DAY = 86400
+T0 = 1_760_000_000 // DAY * DAY  # midnight UTC
+
+
+def rows(device, ts, base=0.0):
+    return [{"timestamp": storage.format_ts(t), "device_id": device, "temp_f": 60 + base + i,
+             "humidity": 40.5 + i, "lux": 1000.0 * i, "moisture": 30.0} for i, t in enumerate(ts)]
+
+
+def test_segment_round_trip_across_days(device):
+    ts = [T0 + 10, T0 + 20, T0 + DAY + 5, T0 + 2 * DAY + 1]
+    storage.append(rows(device, ts))
+
+    cols = storage.read_range(device=device)
+    assert cols["t"].tolist() == ts
+    assert cols["temp_f"].tolist() == [60, 61, 62, 63]
+    assert cols["humidity"].dtype == np.float32
+    assert np.allclose(cols["humidity"], [40.5, 41.5, 42.5, 43.5])
+    assert len(storage.list_segments(device=device)) == 3
+
+
+def test_read_range_is_half_open(device):
+    ts = [T0 + 10, T0 + 20, T0 + 30]
+    storage.append(rows(device, ts))
+    assert storage.read_range(T0 + 10, T0 + 30, device)["t"].tolist() == [T0 + 10, T0 + 20]
+    assert storage.read_range(T0 + 31, None, device)["t"].tolist() == []
+
+
+def test_appender_keeps_files_open_between_appends(device):
+    w = storage.Appender()
+    try:
+        w.append(rows(device, [T0 + 1]))
+        w.append(rows(device, [T0 + 2], base=10))
+        w.sync()
+    finally:
+        w.close()
+    cols = storage.read_range(device=device)
+    assert cols["t"].tolist() == [T0 + 1, T0 + 2]
+    assert cols["temp_f"].tolist() == [60, 70]
+
+
+def test_csv_round_trip(device, monkeypatch):
+    monkeypatch.setattr(storage, "STORAGE_BACKEND", "csv")
+    ts = [T0 + 5, T0 + 6]
+    storage.append(rows(device, ts))
+    cols = storage.read_range(device=device)
+    assert cols["t"].tolist() == ts
+    assert cols["lux"].tolist() == [0.0, 1000.0]
+    assert os.path.exists(storage.csv_log_file(device))
+
+
+def test_ragged_tail_is_cut_before_appending(device, caplog):
+    storage.append(rows(device, [T0 + 1, T0 + 2, T0 + 3]))
+    seg = storage._segment_path(T0, device)
+    # a crash between column writes: t.i64 got a fourth row, humidity half a value
+    with open(os.path.join(seg, storage.TS_FILE), "ab") as f:
+        f.write(np.int64(T0 + 4).tobytes())
+    with open(os.path.join(seg, "humidity.f32"), "ab") as f:
+        f.write(b"\x00\x00")
+    assert len(storage.read_range(device=device)["t"]) == 3  # the torn row isn't read
+
+    storage.append(rows(device, [T0 + 5, T0 + 6], base=100))
+
+    cols = storage.read_range(device=device)
+    assert cols["t"].tolist() == [T0 + 1, T0 + 2, T0 + 3, T0 + 5, T0 + 6]
+    assert cols["temp_f"].tolist() == [60, 61, 62, 160, 161]
+    assert cols["humidity"].tolist() == [40.5, 41.5, 42.5, 40.5, 41.5]
+    sizes = {name: os.path.getsize(os.path.join(seg, name)) for name in os.listdir(seg) if name != storage.LOCK_FILE}
+    assert sizes.pop(storage.TS_FILE) == 5 * 8
+    assert set(sizes.values()) == {5 * 4}
+    assert "ragged tail" in caplog.text
+
+
+@pytest.mark.parametrize("span", ["day", "hour"])
+def test_segment_names_follow_the_span(device, monkeypatch, span):
+    monkeypatch.setattr(storage, "SEGMENT_SPAN", span)
+    storage.append(rows(device, [T0 + 1, T0 + 3601]))
+    assert len(storage.list_segments(device=device)) == (1 if span == "day" else 2)
+    assert storage.read_range(device=device)["t"].tolist() == [T0 + 1, T0 + 3601]
@@ -0,0 +1,91 @@
+import math
+
+import pytest
+
+import sensor_utils
+from sensor_utils import MAX_CLOCK_SKEW, validate_readings
+
+NOW = 1_760_000_000
+
+
+def reading(**overrides):
+    return {"temp_f": 70.0, "humidity": 50.0, "lux": 100.0, "moisture": 30.0, **overrides}
+
+
+def errors(items, **kw):
+    _, rejected = validate_readings(items, now=NOW, **kw)
+    return {r["index"]: r["error"] for r in rejected}
+
+
+def test_valid_reading_is_normalized():
+    rows, rejected = validate_readings([reading(temp_f="71.5", lux=3)], now=NOW)
+    assert rejected == []
+    assert rows == [{"timestamp": "2025-10-09T08:53:20Z", "device_id": "default",
+                     "temp_f": 71.5, "humidity": 50.0, "lux": 3.0, "moisture": 30.0}]
+
+
+def test_empty_batch():
+    assert validate_readings([], now=NOW) == ([], [])
+
+
+@pytest.mark.parametrize("item, message", [
+    ("not a dict", "JSON object"),
+    (None, "JSON object"),
+    ({"temp_f": 70, "humidity": 50, "lux": 1}, "moisture is missing"),
+    (reading(humidity=""), "humidity is missing or not numeric"),
+    (reading(humidity="  "), "humidity is missing or not numeric"),
+    (reading(lux="bright"), "lux is missing or not numeric"),
+    (reading(temp_f=float("nan")), "temp_f is missing or not numeric"),
+    (reading(temp_f="inf"), "temp_f is missing or not numeric"),
+    (reading(moisture=None), "moisture is missing or not numeric"),
+    (reading(timestamp="yesterday"), "timestamp is not ISO-8601"),
+    (reading(timestamp=NOW + MAX_CLOCK_SKEW + 1), "in the future"),
+    (reading(device_id="bad id!"), "device_id must be"),
+    (reading(device_id="x" * 33), "device_id must be"),
+])
+def test_rejections(item, message):
+    assert message in errors([reading(), item])[1]
+
+
+def test_one_bad_item_does_not_reject_the_batch():
+    rows, rejected = validate_readings([reading(), reading(lux="x"), reading()], now=NOW)
+    assert len(rows) == 2
+    assert [r["index"] for r in rejected] == [1]
+
+
+@pytest.mark.parametrize("ts", [NOW - 60, NOW - 60.0, "2025-10-09T08:52:20Z", "2025-10-09T10:52:20+02:00"])
+def test_timestamp_forms(ts):
+    rows, rejected = validate_readings([reading(timestamp=ts)], now=NOW)
+    assert rejected == []
+    assert rows[0]["timestamp"] == "2025-10-09T08:52:20Z"
+
+
+def test_missing_timestamp_gets_now_and_small_skew_is_allowed():
+    rows, _ = validate_readings([reading(timestamp=""), reading(timestamp=NOW + MAX_CLOCK_SKEW)], now=NOW)
+    assert [r["timestamp"] for r in rows] == ["2025-10-09T08:53:20Z", "2025-10-09T08:58:20Z"]
+
+
+def test_rows_come_back_sorted_by_time_keeping_arrival_order_on_ties():
+    items = [reading(timestamp=NOW - 10, lux=1), reading(timestamp=NOW - 30, lux=2), reading(timestamp=NOW - 10, lux=3)]
+    rows, _ = validate_readings(items, now=NOW)
+    assert [r["lux"] for r in rows] == [2, 1, 3]
+
+
+def test_device_id_is_kept():
+    rows, _ = validate_readings([reading(device_id="bed-2_north")], now=NOW)
+    assert rows[0]["device_id"] == "bed-2_north"
+
+
+def test_range_check_is_opt_in(monkeypatch):
+    implausible = reading(humidity=140.0, moisture=-5)
+    assert errors([implausible]) == {}
+    monkeypatch.setattr(sensor_utils, "INGEST_RANGE_CHECK", True)
+    message = errors([implausible, reading(temp_f=257.0)])
+    assert list(message) == [0]
+    assert "humidity" in message[0]
+
+
+def test_values_are_floats():
+    rows, _ = validate_readings([reading(lux=10, moisture=True)], now=NOW)
+    assert all(isinstance(rows[0][m], float) and not math.isnan(rows[0][m])
+               for m in ("temp_f", "humidity", "lux", "moisture"))
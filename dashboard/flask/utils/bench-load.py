@@ -0,0 +1,466 @@
+# bench-load.py
+# Load and latency benchmark: simulated ESP32 nodes plus dashboard clients
+# against the real server, with local stand-ins for the MQTT broker and ntfy.
+#
+# Run from dashboard/flask:
+#   python utils/bench-load.py --devices 20 --interval 1 --dashboards 4 --duration 30
+#   python utils/bench-load.py --target http://127.0.0.1:8000 ...   # an already running server
+#   python utils/bench-load.py --server both --devices 50 --dashboards 8    # Flask/gevent vs FastAPI/uvicorn
+#
+# Without --target the server is started with gunicorn.conf.py in a scratch
+# LOG_DIR/CONFIG_FILE, pointed at an in-process MQTT broker stub and a fake
+# ntfy HTTP server, and stopped afterwards. Each simulated device wakes every
+# --interval seconds (or the `sleep` it fetched from /api/config with
+# --use-config-sleep) and does what the firmware does: a conditional
+# GET /api/config, then POST /api/sensor. Dashboard clients cycle through the
+# history ranges the page offers. --seed makes the device jitter and values
+# repeatable.
+#
+# --server picks the deployment: "flask" (gunicorn.conf.py here, gevent
+# workers), "fastapi" (../fastapi/gunicorn.conf.py, uvicorn workers) or "both",
+# which runs the same load against each in turn, on the same storage and
+# worker count, and prints the FastAPI run against the Flask one.
+#
+# Prints throughput and p50/p95/p99 latency per endpoint and writes the full
+# results as JSON (--output; with --server both, one file per server with the
+# server name appended); --compare old.json prints the change against an
+# earlier run.
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVERS = {
+    # name: (directory with its gunicorn.conf.py, app)
+    "flask": (HERE, "dashboard:app"),
+    "fastapi": (os.path.join(os.path.dirname(HERE), "fastapi"), "main:app"),
+}
+RANGES = ("1h", "24h", "7d", "all")
+
+
+# -- MQTT broker stub -----------------------------------------------------------
+# Just enough MQTT 3.1.1 for paho: CONNACK, PUBACK for QoS 1, SUBACK, PINGRESP.
+
+class _MqttHandler(socketserver.BaseRequestHandler):
+    def _read(self, n):
+        buf = b""
+        while len(buf) < n:
+            chunk = self.request.recv(n - len(buf))
+            if not chunk:
+                raise ConnectionError
+            buf += chunk
+        return buf
+
+    def handle(self):
+        stats = self.server.stats
+        try:
+            while True:
+                header = self._read(1)[0]
+                length, shift = 0, 0
+                while True:
+                    b = self._read(1)[0]
+                    length |= (b & 0x7F) << shift
+                    shift += 7
+                    if not b & 0x80:
+                        break
+                body = self._read(length) if length else b""
+                kind = header >> 4
+                if kind == 1:  # CONNECT
+                    self.request.sendall(b"\x20\x02\x00\x00")
+                    stats["connects"] += 1
+                elif kind == 3:  # PUBLISH
+                    stats["messages"] += 1
+                    qos = (header >> 1) & 3
+                    if qos:
+                        topic_len = int.from_bytes(body[:2], "big")
+                        self.request.sendall(b"\x40\x02" + body[2 + topic_len:4 + topic_len])
+                elif kind == 8:  # SUBSCRIBE
+                    self.request.sendall(b"\x90\x03" + body[:2] + b"\x00")
+                elif kind == 12:  # PINGREQ
+                    self.request.sendall(b"\xd0\x00")
+                elif kind == 14:  # DISCONNECT
+                    return
+        except (ConnectionError, OSError):
+            return
+
+
+class MqttStub(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _MqttHandler)
+        self.stats = defaultdict(int)
+
+
+# -- fake ntfy ------------------------------------------------------------------
+
+class _NtfyHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        self.server.stats["posts"] += 1
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, *args):
+        pass
+
+
+class NtfyStub(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, delay=0.0):
+        super().__init__(("127.0.0.1", 0), _NtfyHandler)
+        self.delay = delay
+        self.stats = defaultdict(int)
+
+
+def _serve(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# -- measurement ----------------------------------------------------------------
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+        self.bytes = defaultdict(int)
+
+    def add(self, key, seconds, status, size):
+        with self._lock:
+            self.latencies[key].append(seconds * 1000)
+            self.statuses[key][status] += 1
+            self.bytes[key] += size
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+
+class Client:
+    """One HTTP connection; `keepalive=False` reconnects per request like the ESP32."""
+
+    def __init__(self, base, recorder, keepalive=True):
+        u = urlsplit(base)
+        self.host, self.port = u.hostname, u.port or 80
+        self.recorder = recorder
+        self.keepalive = keepalive
+        self.conn = None
+
+    def request(self, key, method, path, body=None, headers=None):
+        headers = dict(headers or {})
+        if body is not None:
+            body = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+        start = time.perf_counter()
+        try:
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            self.conn.request(method, path, body=body, headers=headers)
+            resp = self.conn.getresponse()
+            data = resp.read()
+            status = resp.status
+            etag = resp.getheader("ETag")
+        except (OSError, http.client.HTTPException) as e:
+            self.recorder.add(key, time.perf_counter() - start, type(e).__name__, 0)
+            self.close()
+            return None, None, None
+        self.recorder.add(key, time.perf_counter() - start, status, len(data))
+        if not self.keepalive:
+            self.close()
+        return status, data, etag
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def device_loop(i, args, base, recorder, stop, rng):
+    device_id = f"bench{i:03d}"
+    client = Client(base, recorder, keepalive=False)
+    etag, sleep = None, args.interval
+    temp, moisture = rng.uniform(60, 80), rng.uniform(15, 40)
+    time.sleep(rng.uniform(0, args.interval))  # spread the first wakes
+    while not stop.is_set():
+        status, data, new_etag = client.request("GET /api/config", "GET", "/api/config",
+                                                headers={"If-None-Match": etag} if etag else None)
+        if status == 200:
+            etag = new_etag
+            if args.use_config_sleep:
+                sleep = float(json.loads(data).get("data", {}).get("sleep", sleep))
+        temp += rng.uniform(-0.5, 0.5)
+        moisture = min(60, max(5, moisture + rng.uniform(-1, 1)))
+        client.request("POST /api/sensor", "POST", "/api/sensor", body={
+            "device_id": device_id,
+            "temp_f": round(temp, 2), "humidity": round(rng.uniform(30, 70), 2),
+            "lux": round(rng.uniform(0, 20000), 1), "moisture": round(moisture, 1),
+        })
+        stop.wait(sleep * rng.uniform(0.9, 1.1))
+
+
+def dashboard_loop(i, args, base, recorder, stop, rng):
+    client = Client(base, recorder)
+    ranges = list(args.ranges)
+    rng.shuffle(ranges)
+    n = 0
+    while not stop.is_set():
+        r = ranges[n % len(ranges)]
+        n += 1
+        client.request(f"GET /api/history {r} {args.format}", "GET",
+                       f"/api/history?filter_range={r}&points={args.points}&format={args.format}",
+                       headers={"Accept-Encoding": "gzip"})
+        if args.dashboard_interval:
+            stop.wait(args.dashboard_interval)
+    client.close()
+
+
+def seed_history(base, args, recorder):
+    """Backfill --seed-hours of one-minute readings per device via /api/sensor/batch."""
+    client = Client(base, recorder)
+    now = int(time.time())
+    rng = random.Random(args.seed)
+    for i in range(args.devices):
+        rows = [{
+            "device_id": f"bench{i:03d}",
+            "timestamp": now - m * 60,
+            "temp_f": round(70 + rng.uniform(-5, 5), 2), "humidity": 50.0,
+            "lux": 1000.0, "moisture": 30.0,
+        } for m in range(int(args.seed_hours * 60), 0, -1)]
+        for k in range(0, len(rows), 5000):
+            client.request("seed", "POST", "/api/sensor/batch", body=rows[k:k + 5000])
+    # the default device is what /api/history reads without ?device=
+    rows = [{"timestamp": now - m * 60, "temp_f": 70.0, "humidity": 50.0, "lux": 1000.0, "moisture": 30.0}
+            for m in range(int(args.seed_hours * 60), 0, -1)]
+    for k in range(0, len(rows), 5000):
+        client.request("seed", "POST", "/api/sensor/batch", body=rows[k:k + 5000])
+    client.close()
+
+
+# -- server under test ----------------------------------------------------------
+
+def start_server(args, server, scratch, mqtt_port, ntfy_port):
+    port = _free_port()
+    config = os.path.join(scratch, "config.json")
+    shutil.copy(os.path.join(HERE, "config.json"), config)
+    env = {
+        **os.environ,
+        "LOG_DIR": os.path.join(scratch, "logs"),
+        "CONFIG_FILE": config,
+        "MQTT_BROKER": "127.0.0.1", "MQTT_PORT": str(mqtt_port), "MQTT_USER": "", "MQTT_PASSWORD": "",
+        "DISABLE_MQTT": "false",
+        "NTFY_HOST": f"http://127.0.0.1:{ntfy_port}", "NTFY_TOPIC": "bench", "NTFY_TOKEN": "bench",
+    }
+    os.makedirs(env["LOG_DIR"], exist_ok=True)
+    cmd = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "-b", f"127.0.0.1:{port}",
+           "--access-logfile", "/dev/null", "--error-logfile", os.path.join(scratch, "gunicorn.log"),
+           "--log-level", "warning"]
+    if args.workers:
+        cmd += ["-w", str(args.workers)]
+    if args.worker_class:
+        cmd += ["-k", args.worker_class]
+    cwd, app = SERVERS[server]
+    proc = subprocess.Popen(cmd + [app], cwd=cwd, env=env)
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            http.client.HTTPConnection("127.0.0.1", port, timeout=1).request("GET", "/api/status")
+            return proc, base
+        except OSError:
+            time.sleep(0.2)
+    proc.terminate()
+    sys.exit("server did not start; see " + os.path.join(scratch, "gunicorn.log"))
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _git_rev():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def summarize(recorder, elapsed):
+    endpoints = {}
+    for key in sorted(recorder.latencies):
+        if key == "seed":
+            continue
+        lat = sorted(recorder.latencies[key])
+        endpoints[key] = {
+            "requests": len(lat),
+            "throughput_rps": round(len(lat) / elapsed, 2),
+            "p50_ms": round(percentile(lat, 50), 2),
+            "p95_ms": round(percentile(lat, 95), 2),
+            "p99_ms": round(percentile(lat, 99), 2),
+            "max_ms": round(lat[-1], 2),
+            "mean_bytes": round(recorder.bytes[key] / len(lat)),
+            "statuses": {str(k): v for k, v in recorder.statuses[key].items()},
+        }
+    return endpoints
+
+
+def _delta(old, new):
+    if not old:
+        return f"{new} (new)"
+    return f"{old} -> {new} ({(new - old) / old * 100:+.0f}%)"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load and latency benchmark for the dashboard server")
+    parser.add_argument("--target", help="base URL of a running server (default: start one)")
+    parser.add_argument("--server", choices=(*SERVERS, "both"), default="flask",
+                        help="deployment to start without --target; both runs them head to head")
+    parser.add_argument("--devices", type=int, default=10)
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between device wakes")
+    parser.add_argument("--use-config-sleep", action="store_true", help="wake every `sleep` seconds from /api/config")
+    parser.add_argument("--dashboards", type=int, default=2)
+    parser.add_argument("--dashboard-interval", type=float, default=0.0, help="pause between history requests")
+    parser.add_argument("--ranges", nargs="+", default=list(RANGES))
+    parser.add_argument("--format", choices=("rows", "columns"), default="columns")
+    parser.add_argument("--points", type=int, default=2000)
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--seed-hours", type=float, default=24.0, help="history to backfill first (0 to skip)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workers", type=int, help="override gunicorn workers")
+    parser.add_argument("--worker-class", help="override gunicorn worker class")
+    parser.add_argument("--ntfy-delay-ms", type=float, default=50.0, help="latency of the fake ntfy server")
+    parser.add_argument("--output", help="write JSON results here")
+    parser.add_argument("--label", help="free-form tag stored with the results")
+    parser.add_argument("--compare", help="earlier --output file to diff p50/p95/throughput against")
+    args = parser.parse_args()
+    if args.target and args.server == "both":
+        parser.error("--server both starts the servers itself; drop --target")
+
+    runs = {}
+    for server in (SERVERS if args.server == "both" else (args.server,)):
+        if args.server == "both":
+            print(f"\n== {server} ==" if runs else f"== {server} ==")
+        results = runs[server] = bench(args, server)
+        report(results)
+        if args.compare:
+            with open(args.compare) as f:
+                compare(json.load(f), results, args.compare)
+        if args.output:
+            path = args.output
+            if args.server == "both":
+                root, ext = os.path.splitext(path)
+                path = f"{root}-{server}{ext or '.json'}"
+            with open(path, "w") as f:
+                json.dump(results, f, indent=2)
+            print(f"results written to {path}")
+    if args.server == "both":
+        print()
+        compare(runs["flask"], runs["fastapi"], "flask/gevent")
+
+
+def bench(args, server):
+    """Run the load against `server` (or --target); returns the results."""
+    started_at = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    mqtt = _serve(MqttStub())
+    ntfy = _serve(NtfyStub(args.ntfy_delay_ms / 1000))
+    scratch = proc = None
+    if args.target:
+        base = args.target.rstrip("/")
+    else:
+        scratch = tempfile.mkdtemp(prefix="garden-bench-")
+        proc, base = start_server(args, server, scratch, mqtt.server_address[1], ntfy.server_address[1])
+
+    recorder = Recorder()
+    try:
+        if args.seed_hours > 0:
+            t = time.perf_counter()
+            seed_history(base, args, recorder)
+            print(f"seeded {args.seed_hours:g}h of history for {args.devices + 1} devices "
+                  f"in {time.perf_counter() - t:.1f}s")
+
+        stop = threading.Event()
+        threads = [threading.Thread(target=device_loop, daemon=True,
+                                    args=(i, args, base, recorder, stop, random.Random(args.seed * 1000 + i)))
+                   for i in range(args.devices)]
+        threads += [threading.Thread(target=dashboard_loop, daemon=True,
+                                     args=(i, args, base, recorder, stop, random.Random(args.seed * 2000 + i)))
+                    for i in range(args.dashboards)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        time.sleep(args.duration)
+        stop.set()
+        for t in threads:
+            t.join(timeout=35)
+        elapsed = time.perf_counter() - start
+        time.sleep(1)  # let background MQTT/ntfy delivery drain
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait(timeout=30)
+        if scratch is not None:
+            shutil.rmtree(scratch, ignore_errors=True)
+        mqtt.shutdown()
+        ntfy.shutdown()
+
+    return {
+        "label": args.label,
+        "server": None if args.target else server,
+        "started_at": started_at,
+        "git_rev": _git_rev(),
+        "python": platform.python_version(),
+        "params": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "elapsed_s": round(elapsed, 2),
+        "endpoints": summarize(recorder, elapsed),
+        "mqtt": dict(mqtt.stats),
+        "ntfy": dict(ntfy.stats),
+    }
+
+
+def report(results):
+    print(f"{'endpoint':<36} {'req':>7} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'bytes':>9}  statuses")
+    for key, e in results["endpoints"].items():
+        print(f"{key:<36} {e['requests']:>7} {e['throughput_rps']:>8} {e['p50_ms']:>8} {e['p95_ms']:>8} "
+              f"{e['p99_ms']:>8} {e['mean_bytes']:>9}  {e['statuses']}")
+    print(f"mqtt stub: {results['mqtt'].get('messages', 0)} messages over {results['mqtt'].get('connects', 0)} "
+          f"connections; ntfy stub: {results['ntfy'].get('posts', 0)} posts")
+
+
+def compare(before, results, name):
+    print(f"\nvs {name} ({before.get('label') or before.get('server') or before.get('git_rev')}):")
+    for key, e in results["endpoints"].items():
+        old = before.get("endpoints", {}).get(key)
+        if old:
+            print(f"{key:<36} p50 {_delta(old['p50_ms'], e['p50_ms'])}  p95 {_delta(old['p95_ms'], e['p95_ms'])}  "
+                  f"req/s {_delta(old['throughput_rps'], e['throughput_rps'])}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+# bench-startup.py
+# Worker boot benchmark: import time of the app, first-request latency and
+# memory per worker, so startup regressions show up before they reach the Pi.
+#
+# Run from dashboard/flask:
+#   python utils/bench-startup.py                      # report only
+#   python utils/bench-startup.py --max-import-ms 600 --max-rss-mb 90
+#
+# Each run imports the app in a fresh interpreter (with -X importtime), then
+# issues the first requests through the Flask test client. With --fork N the
+# warm process forks N children the way gunicorn's preload_app does and
+# reports the memory each child dirties on its first request (its private,
+# unshared cost). Exits 1 if a budget is exceeded or a forbidden module
+# (pandas by default) was imported on the request path.
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = r'''
+import gc, json, os, sys, time
+t0 = time.perf_counter()
+import dashboard
+t1 = time.perf_counter()
+
+def kib(field, path="/proc/self/status"):
+    with open(path) as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    return 0
+
+def first_requests(client):
+    out = {}
+    for url in URLS:
+        t = time.perf_counter()
+        client.get(url)
+        out[url] = (time.perf_counter() - t) * 1000
+    return out
+
+URLS = json.loads(sys.argv[1])
+FORK = int(sys.argv[2])
+result = {"import_ms": (t1 - t0) * 1000, "rss_after_import_kib": kib("VmRSS")}
+client = dashboard.app.test_client()
+
+children = []
+if FORK:
+    gc.freeze()
+    for _ in range(FORK):
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            first_requests(client)
+            private = sum(kib(k, "/proc/self/smaps_rollup") for k in ("Private_Clean", "Private_Dirty"))
+            os.write(w, json.dumps({"private_kib": private}).encode())
+            os._exit(0)
+        os.close(w)
+        with os.fdopen(r) as f:
+            children.append(json.loads(f.read() or "{}"))
+        os.waitpid(pid, 0)
+
+result["first_request_ms"] = first_requests(client)
+result["rss_after_requests_kib"] = kib("VmRSS")
+result["children"] = children
+result["modules"] = sorted(m for m in sys.modules if "." not in m)
+print(json.dumps(result))
+'''
+
+
+def run_once(urls, fork):
+    env = {**os.environ, "DISABLE_MQTT": "1", "INGEST_WRITER": "direct"}
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE, json.dumps(urls), str(fork)],
+        cwd=HERE, env=env, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        sys.exit(f"probe failed:\n{proc.stderr[-2000:]}")
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result["importtime"] = _parse_importtime(proc.stderr)
+    return result
+
+
+def _parse_importtime(stderr):
+    """{module: cumulative microseconds} for the app and its direct imports,
+    from -X importtime output (nesting is indented two spaces per level)."""
+    out = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not name.strip() or not cumulative.strip().isdigit():
+            continue
+        if len(name) - len(name.lstrip()) <= 3:
+            out[name.strip()] = int(cumulative)
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import-time, first-request and per-worker memory benchmark")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--fork", type=int, default=2, help="preload-style children to measure (0 to skip)")
+    parser.add_argument("--url", action="append", dest="urls",
+                        help="first requests to time (default: /dashboard, /api/sensor, /api/history?filter_range=24h)")
+    parser.add_argument("--max-import-ms", type=float)
+    parser.add_argument("--max-first-request-ms", type=float)
+    parser.add_argument("--max-rss-mb", type=float)
+    parser.add_argument("--max-worker-private-mb", type=float)
+    parser.add_argument("--forbid", action="append", default=None,
+                        help="module that must not be imported by the app (default: pandas)")
+    parser.add_argument("--json", action="store_true", help="print the raw results")
+    args = parser.parse_args()
+    urls = args.urls or ["/dashboard", "/api/sensor", "/api/history?filter_range=24h"]
+    forbid = args.forbid or ["pandas"]
+
+    runs = [run_once(urls, args.fork) for _ in range(args.runs)]
+    if args.json:
+        print(json.dumps(runs, indent=2))
+
+    import_ms = statistics.median(r["import_ms"] for r in runs)
+    first_ms = statistics.median(sum(r["first_request_ms"].values()) for r in runs)
+    rss_mb = statistics.median(r["rss_after_requests_kib"] for r in runs) / 1024
+    private = [c["private_kib"] for r in runs for c in r["children"] if "private_kib" in c]
+    private_mb = statistics.median(private) / 1024 if private else None
+
+    print(f"import dashboard:      {import_ms:8.1f} ms  (median of {args.runs})")
+    for url in urls:
+        print(f"  first {url:<32} {statistics.median(r['first_request_ms'][url] for r in runs):8.1f} ms")
+    print(f"RSS after first reqs:  {rss_mb:8.1f} MB")
+    if private_mb is not None:
+        print(f"private per worker:    {private_mb:8.1f} MB  (forked from a warm parent)")
+    print("slowest imports (cumulative):")
+    slowest = sorted(runs[-1]["importtime"].items(), key=lambda kv: kv[1], reverse=True)[:8]
+    for name, us in slowest:
+        print(f"  {name:<24} {us / 1000:8.1f} ms")
+
+    failures = []
+    loaded = set(runs[-1]["modules"])
+    failures += [f"{m} imported on the request path" for m in forbid if m in loaded]
+    if args.max_import_ms is not None and import_ms > args.max_import_ms:
+        failures.append(f"import {import_ms:.0f} ms > {args.max_import_ms:.0f} ms")
+    if args.max_first_request_ms is not None and first_ms > args.max_first_request_ms:
+        failures.append(f"first requests {first_ms:.0f} ms > {args.max_first_request_ms:.0f} ms")
+    if args.max_rss_mb is not None and rss_mb > args.max_rss_mb:
+        failures.append(f"RSS {rss_mb:.1f} MB > {args.max_rss_mb:.1f} MB")
+    if args.max_worker_private_mb is not None and private_mb is not None and private_mb > args.max_worker_private_mb:
+        failures.append(f"worker private {private_mb:.1f} MB > {args.max_worker_private_mb:.1f} MB")
+    for f in failures:
+        print(f"FAIL: {f}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
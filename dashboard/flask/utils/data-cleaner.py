@@ -1,41 +1,72 @@
-import pandas as pd
+# data-cleaner.py
+# Clean a raw_sensorlog CSV: drop blank lines, repeated headers, rows with the
+# wrong number of fields, unparseable timestamps, non-numeric values and
+# readings outside the plausible sensor ranges. Kept lines are written
+# unchanged, and the drops per rule are reported.
+#
+#   python utils/data-cleaner.py                                  # raw_sensorlog.csv -> clean_sensorlog.csv
+#   python utils/data-cleaner.py logs/raw_sensorlog.csv -o clean.csv --jobs 4
+#   python utils/data-cleaner.py in.csv --since 2025-07-02 --range lux=0:65535 --json
+#
+# The log is streamed in --chunk-mb pieces (see log_cleaner.py), so memory
+# use doesn't grow with the file. --since/--until replace the hard-coded
+# cutoffs of trim_sensorlog.sh and log-filter.py.
+import argparse
+import json
 import os
+import sys
+import time
 
-# Check file exists
-if not os.path.exists("raw_sensorlog.csv"):
-    raise FileNotFoundError("raw_sensorlog.csv not found")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-# Load raw CSV
-df = pd.read_csv("raw_sensorlog.csv")
+import log_cleaner  # noqa: E402
+from storage import to_epoch  # noqa: E402
 
-# Drop rows with repeated headers / junk data
-df = df[df.applymap(lambda x: isinstance(x, (int, float)) or str(x).replace('.', '', 1).isdigit()).all(axis=1)]
 
-# Reset index
-df.reset_index(drop=True, inplace=True)
+def parse_range(value):
+    metric, _, bounds = value.partition("=")
+    lo, _, hi = bounds.partition(":")
+    if metric not in log_cleaner.RANGES or not _:
+        raise argparse.ArgumentTypeError(f"expected <metric>=<lo>:<hi> with metric in {', '.join(log_cleaner.RANGES)}")
+    return metric, (float(lo) if lo else float("-inf"), float(hi) if hi else float("inf"))
 
-# Must have at least 5 columns: timestamp, temp_f, humidity, lux, moisture
-if df.shape[1] < 5:
-    raise ValueError("Expected at least 5 columns:timestamp, temp_f, humidity, lux, moisture.")
 
-# Rename columns
-df.columns = ['timestamp', 'temp_f', 'humidity', 'lux', 'moisture'] + [f'extra_{i}' for i in range(5, df.shape[1])]
-df = df[['timestamp', 'temp_f', 'humidity', 'lux', 'moisture']]
+def main():
+    parser = argparse.ArgumentParser(description="Chunked, vectorized sensor log cleaner")
+    parser.add_argument("input", nargs="?", default="raw_sensorlog.csv")
+    parser.add_argument("-o", "--output", default="clean_sensorlog.csv")
+    parser.add_argument("--chunk-mb", type=float, default=log_cleaner.CHUNK_BYTES / 2**20)
+    parser.add_argument("--jobs", type=int, default=1, help="clean chunks in this many processes")
+    parser.add_argument("--since", help="drop rows before this time (ISO-8601 or epoch seconds)")
+    parser.add_argument("--until", help="drop rows at or after this time")
+    parser.add_argument("--range", action="append", type=parse_range, default=[],
+                        help="override a plausible range, e.g. lux=0:65535 (repeatable; empty side = unbounded)")
+    parser.add_argument("--no-range", action="store_true", help="skip the range checks")
+    parser.add_argument("--json", action="store_true", help="print the counts as JSON")
+    args = parser.parse_args()
 
-# Convert timestamp to datetime 
-df['timestamp'] = pd.to_datetime(df['timestamp'], errors='coerce')
+    if not os.path.exists(args.input):
+        sys.exit(f"{args.input} not found")
+    ranges = {} if args.no_range else {**log_cleaner.RANGES, **dict(args.range)}
+    epoch = lambda v: None if v is None else int(float(v)) if v.replace(".", "", 1).isdigit() else to_epoch(v)
 
-# Convert other columns to numeric
-for col in df.columns:
-    if col != "timestamp":
-        df[col] = pd.to_numeric(df[col], errors='coerce')
+    start = time.perf_counter()
+    counts = log_cleaner.clean_file(args.input, args.output, chunk_bytes=int(args.chunk_mb * 2**20), ranges=ranges,
+                                    since=epoch(args.since), until=epoch(args.until), jobs=args.jobs)
+    elapsed = time.perf_counter() - start
+    size = os.path.getsize(args.input)
 
-# Drop rows with NaN
-df.dropna(inplace=True)
+    if args.json:
+        print(json.dumps({"input": args.input, "output": args.output, "seconds": round(elapsed, 3),
+                          "bytes": size, **{k: counts[k] for k in ("rows", "kept", *log_cleaner.RULES)}}))
+        return 0
+    print(f"{counts['rows']} rows in {elapsed:.2f}s ({size / 2**20 / max(elapsed, 1e-9):.0f} MB/s), "
+          f"kept {counts['kept']}, saved as '{args.output}'")
+    for rule in log_cleaner.RULES:
+        if counts[rule]:
+            print(f"  dropped {counts[rule]:>10}  {rule}")
+    return 0
 
-# Drop rows with 0 or negative in any column
-df = df[(df[['temp_f', 'humidity', 'lux', 'moisture']]> 0).all(axis=1)]
 
-# Save cleaned output
-df.to_csv("clean_sensorlog.csv", index=False)
-print("file saved as 'clean_sensorlog.csv'")
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,16 +1,67 @@
-import pandas as pd
-
-raw = pd.read_csv("logs/raw_sensorlog.csv", parse_dates=["timestamp"])
-veml = pd.read_csv("logs/veml-debug.csv", parse_dates=["timestamp"])
-
-# Merge on timestamp (within 1s tolerance)
-merged = pd.merge_asof(
-    raw.sort_values("timestamp"),
-    veml.sort_values("timestamp"),
-    on="timestamp",
-    tolerance=pd.Timedelta("1s"),
-    direction="nearest"
-)
-
-merged.dropna(inplace=True)
-merged.to_csv("logs/merged_for_training.csv", index=False)
+# merge-logs.py
+# Align any number of CSV logs on time into one table, e.g. a VEML7700
+# calibration set from the sensor log and the VEML debug log. The first log
+# drives: each of its rows gets the nearest (or last / next) row of every
+# other log within --tolerance seconds.
+#
+#   python utils/merge-logs.py                                   # the old behaviour
+#   python utils/merge-logs.py logs/raw_sensorlog.csv logs/veml-debug.csv logs/soil.csv \
+#       -o train.csv --tolerance 5 --direction backward --since 2025-07-01
+#
+# Logs are streamed in --chunk-mb pieces (see log_merge.py), so memory use
+# doesn't grow with the history. Run data-cleaner.py on a log first to drop
+# malformed or implausible rows; the merge only skips lines without a
+# parseable timestamp.
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import log_merge  # noqa: E402
+from storage import to_epoch  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Streaming time-aligned merge of CSV logs")
+    parser.add_argument("logs", nargs="*", default=["logs/raw_sensorlog.csv", "logs/veml-debug.csv"],
+                        help="CSV logs with a timestamp column; the first one drives the output")
+    parser.add_argument("-o", "--output", default="logs/merged_for_training.csv")
+    parser.add_argument("--tolerance", type=float, default=1.0, help="max seconds between matched rows")
+    parser.add_argument("--direction", choices=log_merge.DIRECTIONS, default="nearest")
+    parser.add_argument("--how", choices=("inner", "left"), default="inner",
+                        help="inner: drop rows without a match in every log; left: keep them with empty fields")
+    parser.add_argument("--since", help="only rows from this time (ISO-8601 or epoch seconds)")
+    parser.add_argument("--until", help="only rows before this time")
+    parser.add_argument("--chunk-mb", type=float, default=log_merge.CHUNK_BYTES / 2**20)
+    parser.add_argument("--json", action="store_true", help="print the counts as JSON")
+    args = parser.parse_args()
+
+    if len(args.logs) < 2:
+        parser.error("need at least two logs")
+    for path in args.logs:
+        if not os.path.exists(path):
+            sys.exit(f"{path} not found")
+    epoch = lambda v: None if v is None else int(float(v)) if v.replace(".", "", 1).isdigit() else to_epoch(v)
+
+    start = time.perf_counter()
+    counts = log_merge.merge_files(args.logs, args.output, direction=args.direction, tolerance=args.tolerance,
+                                   how=args.how, since=epoch(args.since), until=epoch(args.until),
+                                   chunk_bytes=int(args.chunk_mb * 2**20))
+    elapsed = time.perf_counter() - start
+    size = sum(os.path.getsize(p) for p in args.logs)
+
+    if args.json:
+        print(json.dumps({"output": args.output, "seconds": round(elapsed, 3), "bytes": size, **counts}))
+        return 0
+    print(f"{counts['written']} rows in {elapsed:.2f}s ({size / 2**20 / max(elapsed, 1e-9):.0f} MB/s read), "
+          f"{counts['unmatched']} without a match in every log, saved as '{args.output}'")
+    for key in sorted(k for k in counts if "." in k):
+        print(f"  {key:<32} {counts[key]:>10}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -12,6 +12,7 @@ constexpr const char* SERVER_URL2 = "http://<SERVER-IP>:8000/api/sensor";
 
 // ===== Compile-time constants (safe in header) =====
 #define DEFAULT_SLEEP_SEC 300             // human-friendly fallback (seconds)
+#define DEVICE_ID "default"               // unique per node (letters, digits, '-', '_'), e.g. "bed-2"
 constexpr uint32_t CONNECT_TIMEOUT_MS = 10000;   // WiFi HTTP timeouts, etc.
 constexpr int INITIAL_RSSI = -999;
 
@@ -39,6 +39,7 @@ RTC_DATA_ATTR bool rtc_scanned = false;
 RTC_DATA_ATTR uint8_t rtc_networkIndex = 0;
 RTC_DATA_ATTR int rtc_currentZone = VEML_ZONE_BRIGHT;
 RTC_DATA_ATTR int rtc_confirmCount = 0;
+RTC_DATA_ATTR char rtc_cfgEtag[48] = "";   // ETag of the last applied config (survives deep sleep)
 
 // ---------- OTA state ----------
 static bool otaStarted = false;
@@ -213,12 +214,22 @@ bool fetchConfig() {
   http.setTimeout(10000);
   http.begin(CONFIG_URL);
   http.addHeader("Accept", "application/json");
+  // revalidate instead of re-downloading: the server answers 304 with no body while unchanged
+  if (rtc_cfgEtag[0]) http.addHeader("If-None-Match", rtc_cfgEtag);
+  const char* etagHeader[] = { "ETag" };
+  http.collectHeaders(etagHeader, 1);
   Serial.printf("Fetching configuration...");
 
   int code = http.GET();
   if (code < 0) { Serial.printf("[ERROR] HTTP GET failed: %s\n", http.errorToString(code).c_str()); http.end(); netBusy=false; return false; }
+  if (code == 304) {
+    Serial.printf("[INFO] Config unchanged (304, ver=%u, sleep=%us)\n", cfg_version, sleep_sec);
+    http.end(); netBusy = false;
+    return true;
+  }
   if (code != 200){ Serial.printf("[ERROR] HTTP %d fetching config, falling back to defaults.\n", code); http.end(); netBusy=false; return false; }
 
+  String etag = http.header("ETag");
   JsonDocument doc;
   DeserializationError err = deserializeJson(doc, http.getStream());
   http.end(); netBusy = false;
@@ -255,6 +266,9 @@ bool fetchConfig() {
   Serial.printf("[INFO] parsed sleep=%u, version=%u (current sleep=%u, ver=%u)\n",
                 new_sec, new_ver, sleep_sec, cfg_version);
 
+  // remember what was accepted so the next wake can revalidate with If-None-Match
+  strlcpy(rtc_cfgEtag, etag.c_str(), sizeof(rtc_cfgEtag));
+
   bool changed = (new_sec != sleep_sec) || (new_ver > cfg_version);
   if (!changed) {
     Serial.printf("[INFO] Config unchanged (ver=%u, sleep=%us)\n", cfg_version, sleep_sec);
@@ -332,6 +346,7 @@ void sensorTask(void *pvParameters) {
     char isoTime[25];
     strftime(isoTime, sizeof(isoTime), "%Y-%m-%dT%H:%M:%SZ", gmtime(&nowTime));
 
+    doc["device_id"] = DEVICE_ID;
     doc["timestamp"] = isoTime;
     doc["temp_f"]    = tempF;
     doc["humidity"]  = humidity;